@@ -1,15 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import copy
 import datetime
 import json
 import logging
 import os
+import queue
 import sys
+import threading
+import time
 from collections import defaultdict
 
-import boto3
-
 from inotify_simple import INotify, flags
 
 try:
@@ -20,28 +22,34 @@ except ImportError:
 from tabulate import tabulate
 
 from s4 import VERSION
+from s4 import daemon
 from s4 import sync
+from s4 import transfer
 from s4 import utils
-from s4.clients import local, s3
+from s4.clients import is_ignored_key, local, s3
 
 
 CONFIG_FOLDER_PATH = os.path.expanduser('~/.config/s4')
 CONFIG_FILE_PATH = os.path.join(CONFIG_FOLDER_PATH, 'sync.conf')
 
 
-def get_s3_client(target, aws_access_key_id, aws_secret_access_key, region_name):
+def get_s3_client(
+    target, aws_access_key_id, aws_secret_access_key, region_name, jobs=1, **options
+):
     s3_uri = s3.parse_s3_uri(target)
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id=aws_access_key_id,
-        aws_secret_access_key=aws_secret_access_key,
-        region_name=region_name,
+    s3_client = s3.get_boto_client(
+        aws_access_key_id,
+        aws_secret_access_key,
+        region_name,
+        max_pool_connections=s3.get_pool_size(options) * jobs,
     )
-    return s3.S3SyncClient(s3_client, s3_uri.bucket, s3_uri.key)
+    return s3.S3SyncClient(s3_client, s3_uri.bucket, s3_uri.key, **options)
 
 
-def get_local_client(target):
-    return local.LocalSyncClient(target)
+def get_local_client(target, stat_cache=None, hash_cache=None, fsync='never'):
+    return local.LocalSyncClient(
+        target, stat_cache=stat_cache, hash_cache=hash_cache, fsync=fsync,
+    )
 
 
 def main(arguments):
@@ -72,12 +80,58 @@ def main(arguments):
     daemon_parser.add_argument('targets', nargs='*')
     daemon_parser.add_argument('--read-delay', default=1000, type=int)
     daemon_parser.add_argument('--conflicts', default='ignore', choices=['1', '2', 'ignore'])
+    daemon_parser.add_argument(
+        '--reconcile-interval',
+        default=3600,
+        type=int,
+        help=(
+            'Seconds between full reconciliations of each target. These are skipped '
+            'when no events could have been missed. Use 0 to disable'
+        ),
+    )
+    daemon_parser.add_argument(
+        '--remote-interval',
+        default=60,
+        type=int,
+        help=(
+            'Seconds between checks whether the S3 side of a target was changed by '
+            'another machine, which then triggers a full reconciliation'
+        ),
+    )
+
+    daemon_parser.add_argument(
+        '--watcher',
+        default='auto',
+        choices=['auto', 'inotify', 'poll'],
+        help=(
+            'How to detect changes. "poll" works on file systems where inotify does not '
+            'see remote changes (NFS, SMB, FUSE) and "auto" picks it for those'
+        ),
+    )
+    daemon_parser.add_argument(
+        '--poll-interval',
+        default=5,
+        type=float,
+        help='Seconds between each check for changes when polling',
+    )
 
     subparsers.add_parser('add', help="Add a new Target to synchronise")
 
     sync_parser = subparsers.add_parser('sync', help="Synchronise Targets with S3")
     sync_parser.add_argument('targets', nargs='*')
     sync_parser.add_argument('--conflicts', default=None, choices=['1', '2', 'ignore'])
+    sync_parser.add_argument(
+        '--parallel', '-p',
+        default=1,
+        type=int,
+        help='Number of targets to sync at the same time',
+    )
+    sync_parser.add_argument(
+        '--total-jobs',
+        default=None,
+        type=int,
+        help='Most transfers in flight across all targets synced with --parallel',
+    )
 
     edit_parser = subparsers.add_parser('edit', help="Edit Target details")
     edit_parser.add_argument('target')
@@ -100,6 +154,11 @@ def main(arguments):
     remove_parser = subparsers.add_parser('rm', help="Remove a Target")
     remove_parser.add_argument('target')
 
+    gc_parser = subparsers.add_parser(
+        'gc', help="Delete chunks no longer used by any file of a Target",
+    )
+    gc_parser.add_argument('target')
+
     args = parser.parse_args(arguments)
 
     if args.log_level == 'DEBUG':
@@ -141,6 +200,8 @@ def main(arguments):
             rm_command(args, config, logger)
         elif args.command == 'daemon':
             daemon_command(args, config, logger)
+        elif args.command == 'gc':
+            gc_command(args, config, logger)
         else:
             parser.print_help()
     except KeyboardInterrupt:
@@ -164,27 +225,88 @@ def set_config(config):
         json.dump(config, fp, indent=4)
 
 
-def get_clients(entry):
-    target_1 = entry['local_folder']
-    target_2 = entry['s3_uri']
-    aws_access_key_id = entry['aws_access_key_id']
-    aws_secret_access_key = entry['aws_secret_access_key']
-    region_name = entry['region_name']
+def is_s3_uri(target):
+    return s3.parse_s3_uri(target) is not None
+
 
+def get_client(target, entry):
     # append trailing slashes to prevent incorrect prefix matching on s3
-    if not target_1.endswith('/'):
-        target_1 += '/'
-    if not target_2.endswith('/'):
-        target_2 += '/'
+    if not target.endswith('/'):
+        target += '/'
+
+    if is_s3_uri(target):
+        return get_s3_client(
+            target,
+            entry['aws_access_key_id'],
+            entry['aws_secret_access_key'],
+            entry['region_name'],
+            jobs=entry.get('max_jobs') or entry.get('jobs', 1),
+            **get_s3_options(entry)
+        )
+    else:
+        return get_local_client(
+            target,
+            stat_cache=entry.get('stat_cache'),
+            hash_cache=entry.get('hash_cache', 'sqlite'),
+            fsync=entry.get('fsync', 'never'),
+        )
+
 
-    client_1 = get_local_client(target_1)
-    client_2 = get_s3_client(target_2, aws_access_key_id, aws_secret_access_key, region_name)
+def get_clients(entry):
+    # the "local folder" may also be an s3 uri to keep two buckets or prefixes in sync
+    client_1 = get_client(entry['local_folder'], entry)
+    client_2 = get_client(entry['s3_uri'], entry)
     return client_1, client_2
 
 
+def get_s3_options(entry):
+    options = {}
+    chunking = entry.get('chunking')
+    if chunking is True:
+        options['chunking'] = {}
+    elif chunking:
+        options['chunking'] = chunking
+
+    for name in (
+        'download_part_size', 'download_concurrency', 'copy_concurrency', 'transfer',
+        'put_object_threshold',
+    ):
+        if name in entry:
+            options[name] = entry[name]
+
+    if entry.get('verify_hashes') or entry.get('detect_renames'):
+        options['store_hashes'] = True
+    return options
+
+
+def set_bandwidth_limits(config):
+    # limits in bytes per second shared by all targets, optionally per time of day
+    bandwidth = config.get('bandwidth', {})
+    transfer.bandwidth.configure(
+        upload=bandwidth.get('upload'),
+        download=bandwidth.get('download'),
+        schedule=bandwidth.get('schedule', ()),
+    )
+
+
+def get_worker_options(entry):
+    return {
+        'fast_path': entry.get('fast_path', False),
+        'verify_hashes': entry.get('verify_hashes', False),
+        'detect_renames': entry.get('detect_renames', False),
+        'jobs': entry.get('jobs', 1),
+        'max_jobs': entry.get('max_jobs'),
+        'scheduling': entry.get('scheduling', 'alphabetical'),
+        'large_file_size': entry.get('large_file_size', sync.SyncWorker.DEFAULT_LARGE_FILE_SIZE),
+        'large_jobs': entry.get('large_jobs', 1),
+        'pipeline': entry.get('pipeline', False),
+        'checkpoint_interval': entry.get('checkpoint_interval', 60),
+    }
+
+
 def get_sync_worker(entry):
     client_1, client_2 = get_clients(entry)
-    return sync.SyncWorker(client_1, client_2)
+    return sync.SyncWorker(client_1, client_2, **get_worker_options(entry))
 
 
 class INotifyRecursive(INotify):
@@ -199,6 +321,27 @@ class INotifyRecursive(INotify):
         return results
 
 
+def get_notifier(args, paths):
+    if args.watcher == 'auto':
+        use_polling = not all(daemon.supports_inotify(path) for path in paths)
+    else:
+        use_polling = args.watcher == 'poll'
+
+    if use_polling:
+        return daemon.PollingNotifier(interval=args.poll_interval)
+    else:
+        return INotifyRecursive()
+
+
+def get_event_key(event, path, root):
+    """
+    Returns the key relative to the target root that an inotify event refers to.
+    """
+    path = os.fsdecode(path)
+    name = os.fsdecode(event.name)
+    return os.path.relpath(os.path.join(path, name), root)
+
+
 def daemon_command(args, config, logger, terminator=lambda x: False):
     all_targets = list(config['targets'].keys())
     if not args.targets:
@@ -216,41 +359,244 @@ def daemon_command(args, config, logger, terminator=lambda x: False):
             logger.info("Unknown target: %s", target)
             return
 
-    notifier = INotifyRecursive()
-    watch_flags = flags.CREATE | flags.DELETE | flags.MODIFY
+    set_bandwidth_limits(config)
+
+    # targets between two s3 uris have nothing to watch and are only reconciled
+    watched = [
+        target for target in targets
+        if not is_s3_uri(config['targets'][target]['local_folder'])
+    ]
+    notifier = get_notifier(args, [config['targets'][target]['local_folder'] for target in watched])
+    logger.debug('Using %s to watch for changes', notifier)
+    watch_flags = (
+        flags.CREATE | flags.DELETE | flags.MODIFY | flags.ATTRIB |
+        flags.MOVED_FROM | flags.MOVED_TO
+    )
+    policy = daemon.ReconciliationPolicy(
+        args.reconcile_interval, remote_interval=args.remote_interval,
+    )
 
     watch_map = {}
 
+    def get_remote_fingerprint(target):
+        entry = config['targets'][target]
+        try:
+            return get_client(entry['s3_uri'], entry).get_fingerprint()
+        except Exception as e:
+            logger.debug('Could not check %s for remote changes: %s', target, e)
+            return None
+
+    def run_sync(target, keys=None):
+        entry = config['targets'][target]
+        try:
+            worker = get_sync_worker(entry)
+            if keys is None:
+                logger.info('Syncing {}'.format(worker))
+                worker.sync(conflict_choice=args.conflicts)
+                policy.reconciled(target)
+            else:
+                logger.debug('Syncing %s keys for %s', len(keys), worker)
+                worker.sync(conflict_choice=args.conflicts, keys=keys)
+            policy.synced(target, worker.client_2.get_synced_fingerprint())
+        except Exception as e:
+            logger.error("There was an error syncing '%s': %s", target, e)
+            policy.mark_dirty(target, daemon.ReconciliationPolicy.ERROR)
+            if keys is None:
+                policy.failed(target)
+
+        if target not in watched:
+            policy.mark_dirty(target, daemon.ReconciliationPolicy.UNWATCHED)
+
     for target in targets:
         entry = config['targets'][target]
         path = entry['local_folder']
-        logger.info("Watching %s", path)
-        for wd in notifier.add_watches(path.encode('utf8'), watch_flags):
-            watch_map[wd] = target
+        if target in watched:
+            logger.info("Watching %s", path)
+            for wd, wd_path in notifier.add_watches(path.encode('utf8'), watch_flags).items():
+                watch_map[wd] = (target, wd_path)
+        else:
+            logger.info("Syncing %s every %s seconds", target, args.reconcile_interval)
 
         # Check for any pending changes
-        worker = get_sync_worker(entry)
-        worker.sync(conflict_choice=args.conflicts)
+        policy.add_target(target)
+        run_sync(target)
 
     index = 0
     while not terminator(index):
         index += 1
 
         to_run = defaultdict(set)
-        for event in notifier.read(read_delay=args.read_delay):
-            target = watch_map[event.wd]
+        full_run = set()
+        events = notifier.read(timeout=policy.get_timeout(), read_delay=args.read_delay)
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                logger.warning('Event queue overflowed, some changes may have been missed')
+                policy.mark_all_dirty(daemon.ReconciliationPolicy.OVERFLOW)
+                continue
 
-            # Dont bother running for .index
-            if event.name != '.index':
-                to_run[target].add(event.name)
+            if event.wd not in watch_map:
+                continue
 
-        for target, keys in to_run.items():
-            entry = config['targets'][target]
-            worker = get_sync_worker(entry)
+            target, path = watch_map[event.wd]
+            root = config['targets'][target]['local_folder']
+
+            if event.mask & flags.ISDIR:
+                # Files may have been added before the new directory is watched, so it is
+                # safer to scan the entire target than to guess its contents
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    new_path = os.fsencode(os.path.join(os.fsdecode(path), event.name))
+                    try:
+                        new_watches = notifier.add_watches(new_path, watch_flags)
+                    except OSError:
+                        # directory was removed again before we could watch it
+                        new_watches = {}
+                    for wd, wd_path in new_watches.items():
+                        watch_map[wd] = (target, wd_path)
+                full_run.add(target)
+                continue
 
-            # Should ideally be setting keys to sync
-            logger.info('Syncing {}'.format(worker))
-            worker.sync(conflict_choice=args.conflicts)
+            key = get_event_key(event, path, root)
+            if not is_ignored_key(key, local.LocalSyncClient.DEFAULT_IGNORE_FILES):
+                to_run[target].add(key)
+
+        for target in sorted(full_run):
+            run_sync(target)
+
+        for target, keys in sorted(to_run.items()):
+            if target not in full_run:
+                run_sync(target, keys)
+
+        for target in policy.get_due_targets(get_remote_fingerprint):
+            logger.info('Running full reconciliation for %s', target)
+            with utils.lower_io_priority():
+                run_sync(target)
+
+
+class LogBuffer(logging.Filter):
+    """
+    Holds back the log records of every thread working on a target (see
+    utils.log_context) until they are replayed together.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.records = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        name = utils.get_log_context()
+        if name is None:
+            return True
+        # the same record passes through every handler it propagates to
+        if not getattr(record, 'buffered', False):
+            record.buffered = True
+            with self._lock:
+                self.records[name].append(record)
+        return False
+
+    def replay(self, name):
+        with self._lock:
+            records = self.records.pop(name, [])
+        for record in records:
+            logging.getLogger(record.name).handle(record)
+
+
+def get_handlers(logger):
+    """
+    Returns the handlers records of logger and of the root logger are passed to.
+    """
+    handlers = list(logging.getLogger().handlers)
+    while logger is not None:
+        handlers.extend(handler for handler in logger.handlers if handler not in handlers)
+        if not logger.propagate:
+            break
+        logger = logger.parent
+    return handlers
+
+
+def sync_target(name, entry, args, logger, show_progress=True):
+    """
+    Syncs a single target and returns whether it succeeded.
+    """
+    try:
+        client_1, client_2 = get_clients(entry)
+        worker = sync.SyncWorker(
+            client_1, client_2, show_progress=show_progress, **get_worker_options(entry)
+        )
+
+        logger.info('Syncing %s [%s <=> %s]', name, client_1.get_uri(), client_2.get_uri())
+        worker.sync(conflict_choice=args.conflicts)
+    except Exception as e:
+        if args.log_level == "DEBUG":
+            logger.exception(e)
+        else:
+            logger.error("There was an error syncing '%s': %s", name, e)
+        return False
+    return True
+
+
+def sync_parallel(names, config, args, logger):
+    """
+    Syncs up to args.parallel targets at the same time, with at most args.total_jobs
+    transfers in flight across all of them. The log messages of each target are shown
+    together once it is done, followed by a summary of all targets.
+    """
+    transfer.job_budget.configure(args.total_jobs)
+    if args.conflicts is None:
+        # there is no way to ask about conflicts of several targets at once
+        logger.info('Skipping conflicts, use --conflicts to resolve them')
+        args = copy.copy(args)
+        args.conflicts = 'ignore'
+
+    pending = queue.Queue()
+    for name in names:
+        pending.put(name)
+    results = {}
+    output_lock = threading.Lock()
+    buffer = LogBuffer()
+
+    def run():
+        while True:
+            try:
+                name = pending.get_nowait()
+            except queue.Empty:
+                return
+
+            started_at = time.monotonic()
+            with utils.log_context(name):
+                success = sync_target(
+                    name, config['targets'][name], args, logger, show_progress=False,
+                )
+            results[name] = (success, time.monotonic() - started_at)
+
+            with output_lock:
+                buffer.replay(name)
+
+    # daemon threads do not hold up quitting, interrupted targets resume from their journal
+    started_at = time.monotonic()
+    threads = [
+        threading.Thread(target=run, name='s4 sync {}'.format(index), daemon=True)
+        for index in range(min(args.parallel, len(names)))
+    ]
+    handlers = get_handlers(logger)
+    for handler in handlers:
+        handler.addFilter(buffer)
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        for handler in handlers:
+            handler.removeFilter(buffer)
+
+    rows = [
+        (name, 'synced' if success else 'failed', '{:.1f}s'.format(seconds))
+        for name, (success, seconds) in sorted(results.items())
+    ]
+    logger.info('')
+    logger.info(tabulate(rows, headers=['Target', 'Result', 'Time']))
+    logger.info('Synced %s targets in %.1fs', len(results), time.monotonic() - started_at)
 
 
 def sync_command(args, config, logger):
@@ -260,25 +606,20 @@ def sync_command(args, config, logger):
     else:
         targets = args.targets
 
-    try:
-        for name in sorted(targets):
-            if name not in config['targets']:
-                logger.info('"%s" is an unknown target. Choices are: %s', name, all_targets)
-                continue
-
-            entry = config['targets'][name]
-            client_1, client_2 = get_clients(entry)
-
-            try:
-                worker = sync.SyncWorker(client_1, client_2)
+    set_bandwidth_limits(config)
+    names = []
+    for name in sorted(targets):
+        if name not in config['targets']:
+            logger.info('"%s" is an unknown target. Choices are: %s', name, all_targets)
+        else:
+            names.append(name)
 
-                logger.info('Syncing %s [%s <=> %s]', name, client_1.get_uri(), client_2.get_uri())
-                worker.sync(conflict_choice=args.conflicts)
-            except Exception as e:
-                if args.log_level == "DEBUG":
-                    logger.exception(e)
-                else:
-                    logger.error("There was an error syncing '%s': %s", name, e)
+    try:
+        if args.parallel > 1 and len(names) > 1:
+            sync_parallel(names, config, args, logger)
+        else:
+            for name in names:
+                sync_target(name, config['targets'][name], args, logger)
 
     except KeyboardInterrupt:
         logger.warning('Quitting due to Keyboard Interrupt...')
@@ -415,5 +756,25 @@ def rm_command(args, config, logger):
     set_config(config)
 
 
+def gc_command(args, config, logger):
+    if 'targets' not in config:
+        logger.info('You have not added any targets yet')
+        return
+    if args.target not in config['targets']:
+        all_targets = sorted(list(config['targets'].keys()))
+        logger.info('"%s" is an unknown target', args.target)
+        logger.info('Choices are: %s', all_targets)
+        return
+
+    for client in get_clients(config['targets'][args.target]):
+        if not isinstance(client, s3.S3SyncClient):
+            continue
+        deleted = client.delete_unreferenced_chunks()
+        logger.info(
+            'Deleted %s unreferenced chunks (%s bytes) from %s',
+            len(deleted), sum(obj['Size'] for obj in deleted), client.get_uri(),
+        )
+
+
 if __name__ == '__main__':
     main(sys.argv[1:])
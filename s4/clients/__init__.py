@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import fnmatch
 
 
 class SyncState(object):
@@ -44,14 +45,34 @@ class SyncState(object):
 
 
 class SyncObject(object):
-    def __init__(self, fp, total_size, timestamp):
+    def __init__(self, fp, total_size, timestamp, hash=None, hasher=None):
         self.fp = fp
         self.total_size = total_size
         self.timestamp = timestamp
+        # md5 hex digest of the contents, if it is known without reading them
+        self.hash = hash
+        # optionally computes the hash when it is unknown, e.g. through a local HashCache
+        self.hasher = hasher
 
     def __repr__(self):
         return 'SyncObject<{}, {}, {}>'.format(self.fp, self.total_size, self.timestamp)
 
+    def close(self):
+        # S3 response bodies only return their connection to the pool once closed
+        close = getattr(self.fp, 'close', None)
+        if close is not None:
+            close()
+
+
+def is_ignored_key(key, ignore_files):
+    # Check if any subdirectories match the ignore patterns
+    key_parts = key.split('/')
+    for part in key_parts:
+        if any(fnmatch.fnmatch(part, pattern) for pattern in ignore_files):
+            return True
+    else:
+        return False
+
 
 def get_sync_state(index_local, real_local, remote):
     # convert to int because not all clients support float precision
@@ -99,6 +120,25 @@ class SyncClient(object):
     def delete(self, key):
         raise NotImplementedError()
 
+    def rename(self, source_key, key):
+        raise NotImplementedError()
+
+    def get_size(self, key):
+        raise NotImplementedError()
+
+    def copy_from(self, client, key):
+        """
+        copies key from another client without its contents passing through this host.
+        returns False if that is not possible between the two clients.
+        """
+        return False
+
+    def get_hash(self, key):
+        """
+        returns the md5 hex digest of the contents of key, or None if it is not known.
+        """
+        raise NotImplementedError()
+
     def get_local_keys(self):
         raise NotImplementedError()
 
@@ -129,6 +169,13 @@ class SyncClient(object):
     def get_all_real_local_timestamps(self):
         raise NotImplementedError()
 
+    def iter_real_local_timestamps(self):
+        """
+        Yields the same keys and timestamps as get_all_real_local_timestamps. Clients
+        which list their keys in parts yield each part as soon as it has been listed.
+        """
+        return iter(self.get_all_real_local_timestamps().items())
+
     def get_all_keys(self):
         local_keys = self.get_local_keys()
         index_keys = self.get_index_keys()
@@ -154,6 +201,21 @@ class SyncClient(object):
     def flush_index(self):
         raise NotImplementedError()
 
+    def get_fingerprint(self):
+        """
+        returns a cheap value which changes whenever anything on this client may
+        have changed, or None if the client cannot provide one.
+        """
+        return None
+
+    def get_synced_fingerprint(self):
+        """
+        returns the fingerprint of this client as it was when the current sync looked
+        at it, updated with the changes the sync made itself, or None if unknown.
+        Changes made by anything else in the meantime are not part of it.
+        """
+        return None
+
     def get_action(self, key):
         """
         returns the action to perform on this key based on its
@@ -164,6 +226,18 @@ class SyncClient(object):
         remote_timestamp = self.get_remote_timestamp(key)
         return get_sync_state(index_local_timestamp, real_local_timestamp, remote_timestamp)
 
+    def get_actions(self, keys):
+        """
+        returns the actions to perform for a specific set of keys. This avoids a full
+        scan of the client and is used for incremental syncs of known keys.
+        """
+        results = {}
+        for key in keys:
+            if is_ignored_key(key, self.ignore_files):
+                continue
+            results[key] = self.get_action(key)
+        return results
+
     def get_all_actions(self):
         real_local_timestamps = self.get_all_real_local_timestamps()
         index_local_timestamps = self.get_all_index_local_timestamps()
@@ -184,3 +258,24 @@ class SyncClient(object):
             )
 
         return results
+
+    def iter_actions(self):
+        """
+        Yields the same keys and actions as get_all_actions, each as soon as the key has
+        been listed. Keys which are only found in the index follow at the end.
+        """
+        index_local_timestamps = self.get_all_index_local_timestamps()
+        remote_timestamps = self.get_all_remote_timestamps()
+
+        listed = set()
+        for key, real_local_timestamp in self.iter_real_local_timestamps():
+            listed.add(key)
+            yield key, get_sync_state(
+                index_local_timestamps.get(key),
+                real_local_timestamp,
+                remote_timestamps.get(key),
+            )
+
+        for key, index_local_timestamp in index_local_timestamps.items():
+            if key not in listed:
+                yield key, get_sync_state(index_local_timestamp, None, remote_timestamps.get(key))
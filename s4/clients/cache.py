@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import fnmatch
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Use the built-in version of scandir/walk if possible, otherwise
+# use the scandir module version
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+
+from s4 import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+_state_locks = {}
+_state_locks_lock = threading.Lock()
+
+
+def get_state_lock(path):
+    """
+    Returns the lock everything in this process holds while reading, changing and
+    writing back the state file at path, e.g. targets synced in parallel.
+    """
+    with _state_locks_lock:
+        return _state_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+def write_json(path, data):
+    """
+    Atomically writes gzip compressed json data next to its final destination.
+    """
+    parent = os.path.dirname(path)
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    fd, temp_path = tempfile.mkstemp(dir=parent, prefix='.s4tmp-')
+    try:
+        with gzip.open(temp_path, 'wt') as fp:
+            json.dump(data, fp)
+        os.replace(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+    finally:
+        os.close(fd)
+
+
+def read_json(path, default=None):
+    try:
+        with gzip.open(path, 'rt') as fp:
+            return json.load(fp)
+    except (IOError, OSError, ValueError) as e:
+        if os.path.exists(path):
+            logger.warning('Ignoring unreadable cache %s: %s', path, e)
+        return default
+
+
+class StatCache(object):
+    """
+    Persistent cache of the directory tree below a LocalSyncClient folder. For every
+    directory the mtime, the list of sub directories and the stats of each file are
+    stored. The listing of a directory whose mtime has not changed since the last scan
+    is reused instead of being read again.
+
+    In VERIFY mode the files of unchanged directories are still re-stat'ed, which only
+    saves the directory listings. In TRUST mode their cached stats are reused too, so a
+    scan of an unchanged tree costs a single stat per directory. Files modified in place
+    do not change the mtime of their directory, so TRUST mode will only notice them once
+    something else changes in that directory.
+    """
+    VERIFY = 'verify'
+    TRUST = 'trust'
+    VERSION = 1
+
+    def __init__(self, path, mode=VERIFY):
+        if mode not in (self.VERIFY, self.TRUST):
+            raise ValueError('Unknown stat cache mode', mode)
+        self.path = path
+        self.mode = mode
+        self.directories = {}
+        self.ignore_files = None
+        self.dirty = False
+        self.load()
+
+    def __repr__(self):
+        return 'StatCache<{}, {}>'.format(self.path, self.mode)
+
+    def load(self):
+        data = read_json(self.path, default={})
+        if data.get('version') != self.VERSION:
+            data = {}
+        self.directories = data.get('directories', {})
+        self.ignore_files = data.get('ignore_files')
+        self.dirty = False
+
+    def save(self):
+        if not self.dirty:
+            return
+        logger.debug('Writing stat cache with %s directories', len(self.directories))
+        write_json(self.path, {
+            'version': self.VERSION,
+            'ignore_files': self.ignore_files,
+            'directories': self.directories,
+        })
+        self.dirty = False
+
+    def _list_directory(self, path, ignore_files):
+        files = {}
+        dirs = []
+        for item in scandir(path):
+            if any(fnmatch.fnmatch(item.name, pattern) for pattern in ignore_files):
+                logger.debug('Ignoring %s', item)
+                continue
+            try:
+                if item.is_dir():
+                    dirs.append(item.name)
+                else:
+                    stat = item.stat()
+                    files[item.name] = [stat.st_mtime, stat.st_size]
+            except OSError:
+                # removed while we were scanning
+                continue
+        return files, sorted(dirs)
+
+    def _restat_files(self, path, files):
+        results = {}
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                # removed without the directory mtime changing
+                return None
+            results[name] = [stat.st_mtime, stat.st_size]
+        return results
+
+    def scan(self, root, ignore_files):
+        """
+        Returns a dictionary of all keys below root along with their modified timestamps.
+        """
+        ignore_files = sorted(set(ignore_files))
+        if ignore_files != self.ignore_files:
+            logger.debug('Ignore patterns changed, invalidating stat cache')
+            self.directories = {}
+            self.ignore_files = ignore_files
+            self.dirty = True
+
+        results = {}
+        directories = {}
+        reused = 0
+        stack = ['']
+        while stack:
+            relative_path = stack.pop()
+            full_path = os.path.join(root, relative_path)
+            try:
+                mtime_ns = os.stat(full_path).st_mtime_ns
+            except OSError:
+                continue
+
+            cached = self.directories.get(relative_path)
+            entry = None
+            if (
+                cached is not None and
+                cached['mtime_ns'] == mtime_ns and
+                mtime_ns < cached['scanned_at'] - utils.RACY_WINDOW_NS
+            ):
+                entry = cached
+                if self.mode == self.VERIFY:
+                    files = self._restat_files(full_path, cached['files'])
+                    if files is None:
+                        entry = None
+                    elif files != cached['files']:
+                        entry = dict(cached, files=files)
+                        self.dirty = True
+
+            if entry is None:
+                scanned_at = int(time.time() * 10**9)
+                try:
+                    files, dirs = self._list_directory(full_path, ignore_files)
+                except OSError:
+                    continue
+                entry = {
+                    'mtime_ns': mtime_ns,
+                    'scanned_at': scanned_at,
+                    'files': files,
+                    'dirs': dirs,
+                }
+                self.dirty = True
+            else:
+                reused += 1
+
+            directories[relative_path] = entry
+            for name, (mtime, size) in entry['files'].items():
+                results[os.path.join(relative_path, name)] = mtime
+            stack.extend(os.path.join(relative_path, name) for name in entry['dirs'])
+
+        if set(directories) != set(self.directories):
+            self.dirty = True
+        self.directories = directories
+
+        logger.debug(
+            'Scanned %s directories (%s unchanged) with %s files',
+            len(directories), reused, len(results),
+        )
+        return results
+
+
+def hash_file(path, buffer_size=1024 * 1024):
+    with open(path, 'rb') as fp:
+        return hash_fp(fp, buffer_size)
+
+
+def hash_fp(fp, buffer_size=1024 * 1024):
+    digest = hashlib.md5()
+    while True:
+        data = fp.read(buffer_size)
+        if not data:
+            break
+        digest.update(data)
+    return digest.hexdigest()
+
+
+def get_stat_key(stat):
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class HashCache(object):
+    """
+    Persistent cache of the md5 hashes of local files. Each entry is validated against
+    the device, inode, size and nanosecond mtime of the file, so a file is hashed at
+    most once per modification no matter how many syncs or targets look at it.
+
+    Hashes are either stored in a sqlite database shared by all targets or in the
+    user.s4.md5 extended attribute of each file. File systems which do not support
+    extended attributes fall back to the database.
+    """
+    SQLITE = 'sqlite'
+    XATTR = 'xattr'
+    XATTR_NAME = 'user.s4.md5'
+    DATABASE_FILE_NAME = 'hashes.sqlite'
+
+    def __init__(self, storage=SQLITE, path=None):
+        if storage not in (self.SQLITE, self.XATTR):
+            raise ValueError('Unknown hash cache storage', storage)
+        self.storage = storage
+        self.path = path or utils.get_state_path(self.DATABASE_FILE_NAME)
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'HashCache<{}>'.format(self.storage)
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            parent = os.path.dirname(self.path)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS hashes ('
+                '    device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER, md5 TEXT,'
+                '    PRIMARY KEY (device, inode)'
+                ')'
+            )
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _get_xattr(self, path, stat):
+        try:
+            value = os.getxattr(path, self.XATTR_NAME).decode('ascii')
+        except OSError:
+            return None
+        tokens = value.split(':')
+        if len(tokens) == 4 and tokens[:3] == [str(v) for v in get_stat_key(stat)[1:]]:
+            return tokens[3]
+        return None
+
+    def _set_xattr(self, path, stat, md5):
+        value = '{}:{}:{}:{}'.format(stat.st_ino, stat.st_size, stat.st_mtime_ns, md5)
+        try:
+            os.setxattr(path, self.XATTR_NAME, value.encode('ascii'))
+            return True
+        except OSError as e:
+            if e.errno not in (errno.ENOTSUP, errno.EPERM, errno.EACCES, errno.EROFS):
+                raise
+            logger.debug('Extended attributes not writable for %s, using database', path)
+            return False
+
+    def _get_database(self, stat):
+        with self._lock:
+            row = self.connection.execute(
+                'SELECT size, mtime_ns, md5 FROM hashes WHERE device = ? AND inode = ?',
+                (stat.st_dev, stat.st_ino),
+            ).fetchone()
+        if row is not None and tuple(row[:2]) == (stat.st_size, stat.st_mtime_ns):
+            return row[2]
+        return None
+
+    def _set_database(self, stat, md5):
+        with self._lock:
+            with self.connection:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)',
+                    get_stat_key(stat) + (md5,),
+                )
+
+    def get(self, path, stat=None):
+        """
+        Returns the cached hash of path if it is still valid, otherwise None.
+        """
+        if stat is None:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+
+        result = None
+        if self.storage == self.XATTR:
+            result = self._get_xattr(path, stat)
+        if result is None:
+            result = self._get_database(stat)
+        return result
+
+    def set(self, path, md5, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+        if self.storage == self.XATTR and self._set_xattr(path, stat, md5):
+            return
+        self._set_database(stat, md5)
+
+    def get_hash(self, path):
+        """
+        Returns the hash of path, only reading its contents if the cached value is stale.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        result = self.get(path, stat)
+        if result is not None:
+            return result
+
+        result = hash_file(path)
+        # do not store anything if the file was modified while hashing it
+        if get_stat_key(os.stat(path)) == get_stat_key(stat):
+            self.set(path, result, stat)
+        return result
+
+
+class UploadState(object):
+    """
+    Persistent record of the multipart uploads in progress, keyed by the uri of their
+    destination, so that uploads interrupted by a crash or a dropped connection can
+    continue where they stopped on the next sync.
+    """
+    FILE_NAME = 'uploads'
+
+    def __init__(self, path=None):
+        self.path = path or utils.get_state_path(self.FILE_NAME)
+        # shared with the UploadState of every other S3 target
+        self._lock = get_state_lock(self.path)
+
+    def __repr__(self):
+        return 'UploadState<{}>'.format(self.path)
+
+    def get(self, uri):
+        with self._lock:
+            return read_json(self.path, default={}).get(uri)
+
+    def set(self, uri, value):
+        with self._lock:
+            data = read_json(self.path, default={})
+            data[uri] = value
+            write_json(self.path, data)
+
+    def remove(self, uri):
+        with self._lock:
+            data = read_json(self.path, default={})
+            if data.pop(uri, None) is not None:
+                write_json(self.path, data)
+
+
+class Journal(object):
+    """
+    Append-only record of a sync session with one json document per line, e.g. the
+    deferred calls it planned and the keys whose calls completed. Nothing is ever
+    rewritten in place, so a crash at any point leaves a journal that can be read back
+    up to its last complete line.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fp = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Journal<{}>'.format(self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def read(self):
+        records = []
+        try:
+            with open(self.path, 'rt') as fp:
+                for line in fp:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        # the last line written before a crash may be incomplete
+                        logger.warning('Ignoring truncated entry in %s', self.path)
+                        break
+        except (IOError, OSError) as e:
+            if os.path.exists(self.path):
+                logger.warning('Ignoring unreadable journal %s: %s', self.path, e)
+        return records
+
+    def start(self, records=()):
+        """
+        Atomically replaces the journal with records and opens it for appending.
+        """
+        parent = os.path.dirname(self.path)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+        with self._lock:
+            self._close()
+            fd, temp_path = tempfile.mkstemp(dir=parent, prefix='.s4tmp-')
+            try:
+                with os.fdopen(fd, 'wt') as fp:
+                    for record in records:
+                        fp.write(json.dumps(record) + '\n')
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(temp_path, self.path)
+            except Exception:
+                os.remove(temp_path)
+                raise
+            self._fp = open(self.path, 'at')
+
+    def append(self, record):
+        with self._lock:
+            self._fp.write(json.dumps(record) + '\n')
+
+    def sync(self):
+        """
+        Makes everything appended so far durable.
+        """
+        with self._lock:
+            if self._fp is not None:
+                self._fp.flush()
+                os.fsync(self._fp.fileno())
+
+    def _close(self):
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def remove(self):
+        with self._lock:
+            self._close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
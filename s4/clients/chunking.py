@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+
+# numpy is optional, without it chunk boundaries are searched one byte at a time
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+# Deterministic table of random values for the gear hash. This must never change,
+# otherwise chunk boundaries (and therefore deduplication) change with it.
+GEAR = [
+    int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], 'big')
+    for i in range(256)
+]
+
+if numpy is not None:
+    GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint64)
+
+MANIFEST_VERSION = 1
+
+# most bytes hashed at once when searching for boundaries with numpy
+SEARCH_BLOCK_SIZE = 1024 * 1024
+
+
+class Chunker(object):
+    """
+    Content defined chunking using a gear rolling hash (as used by FastCDC). Chunk
+    boundaries depend only on the contents around them, so inserting or removing data
+    only changes the chunks around the modification instead of every following one.
+    """
+    def __init__(self, min_size=1024 * 1024, avg_size=4 * 1024 * 1024, max_size=16 * 1024 * 1024):
+        if not min_size <= avg_size <= max_size:
+            raise ValueError('Chunk sizes must satisfy min_size <= avg_size <= max_size')
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+
+        # The highest bits of the gear hash depend on the most bytes, so use those
+        bits = max(1, (avg_size - min_size).bit_length() - 1)
+        self.mask = ((1 << bits) - 1) << (64 - bits)
+
+    def __repr__(self):
+        return 'Chunker<min={}, avg={}, max={}>'.format(self.min_size, self.avg_size, self.max_size)
+
+    def find_boundary(self, data, offset, length):
+        """
+        Returns the length of the chunk starting at data[offset] given that `length`
+        bytes are available.
+        """
+        end = min(length, self.max_size)
+        if end <= self.min_size:
+            return end
+
+        if numpy is not None:
+            index = self._search_vectorised(data, offset + self.min_size, offset + end)
+        else:
+            index = self._search(data, offset + self.min_size, offset + end)
+
+        if index is None:
+            return end
+        return index - offset + 1
+
+    def _search(self, data, start, stop):
+        gear = GEAR
+        mask = self.mask
+        h = 0
+        for i in range(start, stop):
+            h = ((h << 1) + gear[data[i]]) & MASK_64
+            if not h & mask:
+                return i
+        return None
+
+    def _search_vectorised(self, data, start, stop):
+        # The gear hash at i is sum(GEAR[data[i - k]] << k for k in range(64)) modulo
+        # 2**64, so it can be computed for a whole block by doubling the number of
+        # bytes summed up six times instead of rolling it one byte at a time.
+        mask = numpy.uint64(self.mask)
+        values = numpy.frombuffer(data, dtype=numpy.uint8)
+        for block_start in range(start, stop, SEARCH_BLOCK_SIZE):
+            block_stop = min(block_start + SEARCH_BLOCK_SIZE, stop)
+            # bytes before start are not part of the hash, like in _search
+            context = min(block_start - start, 63)
+            h = GEAR_ARRAY[values[block_start - context:block_stop]]
+            shift = 1
+            while shift < 64:
+                h[shift:] += h[:-shift] << numpy.uint64(shift)
+                shift *= 2
+
+            matches = numpy.flatnonzero((h[context:] & mask) == 0)
+            if len(matches):
+                return block_start + int(matches[0])
+        return None
+
+    def iter_chunks(self, fp):
+        """
+        Yields the content defined chunks read from a file like object.
+        """
+        buffer = b''
+        eof = False
+        while True:
+            while not eof and len(buffer) < self.max_size:
+                data = fp.read(self.max_size)
+                if not data:
+                    eof = True
+                else:
+                    buffer += data
+
+            if not buffer:
+                return
+
+            # Only cut at the end of the data available if nothing more can be read
+            size = self.find_boundary(buffer, 0, len(buffer))
+            yield buffer[:size]
+            buffer = buffer[size:]
+
+
+def dump_manifest(size, md5, chunks):
+    return json.dumps({
+        'version': MANIFEST_VERSION,
+        'size': size,
+        'md5': md5,
+        'chunks': chunks,
+    }).encode('utf-8')
+
+
+def load_manifest(data):
+    manifest = json.loads(data.decode('utf-8'))
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unknown manifest version', manifest.get('version'))
+    return manifest
+
+
+class ChunkedReader(object):
+    """
+    File like object which reads the contents of a chunked file one chunk at a time.
+    `get_chunk` is called with the hash of each chunk and returns its data.
+    """
+    def __init__(self, chunks, get_chunk):
+        self.chunks = list(chunks)
+        self.get_chunk = get_chunk
+        self._index = 0
+        self._buffer = b''
+        self.closed = False
+
+    def read(self, size=-1):
+        while (size < 0 or len(self._buffer) < size) and self._index < len(self.chunks):
+            chunk_hash, _ = self.chunks[self._index]
+            self._buffer += self.get_chunk(chunk_hash)
+            self._index += 1
+
+        if size < 0:
+            size = len(self._buffer)
+        result, self._buffer = self._buffer[:size], self._buffer[size:]
+        return result
+
+    def close(self):
+        self.closed = True
+        self._buffer = b''
@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 
+import errno
+import fcntl
 import fnmatch
+import functools
 import gzip
+import hashlib
 import json
 import logging
 import os
-import shutil
+import stat
 import tempfile
+import threading
 
 # Use the built-in version of scandir/walk if possible, otherwise
 # use the scandir module version
@@ -19,7 +24,7 @@ import filelock
 
 import magic
 
-from s4.clients import SyncClient, SyncObject
+from s4.clients import SyncClient, SyncObject, cache
 
 logger = logging.getLogger(__name__)
 
@@ -43,20 +48,123 @@ def traverse(path, ignore_files=None):
             yield item.name
 
 
+# ioctl which shares the extents of one file with another on copy-on-write file
+# systems (btrfs, xfs, ...), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+
+# errors meaning a copy method is not available for the given pair of files
+UNSUPPORTED_COPY_ERRORS = (
+    errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY, errno.EOPNOTSUPP, errno.EBADF,
+)
+
+
+def get_file_descriptor(fp):
+    """
+    Returns the file descriptor of fp if it is backed by a regular file, otherwise None.
+    """
+    try:
+        fd = fp.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(os.fstat(fd).st_mode):
+        return None
+    return fd
+
+
+def clone_file(source_fd, dest_fd):
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, source_fd)
+        return True
+    except OSError as e:
+        if e.errno not in UNSUPPORTED_COPY_ERRORS:
+            raise
+        return False
+
+
+def _copy_file_range(source_fd, dest_fd, offset, count):
+    return os.copy_file_range(source_fd, dest_fd, count, offset)
+
+
+def _sendfile(source_fd, dest_fd, offset, count):
+    return os.sendfile(dest_fd, source_fd, offset, count)
+
+
+def copy_file(source_fd, dest_fd, offset=0, callback=None, block_size=64 * 1024 * 1024):
+    """
+    Copies the contents of source_fd starting at offset to dest_fd without passing them
+    through user space. A reflink clone is tried first, followed by copy_file_range
+    and sendfile. Returns the number of bytes copied or None if none of these methods
+    are supported, in which case nothing was written.
+    """
+    size = os.fstat(source_fd).st_size - offset
+    if offset == 0 and clone_file(source_fd, dest_fd):
+        logger.debug('Cloned %s bytes', size)
+        if callback is not None:
+            callback(size)
+        return size
+
+    for method in (_copy_file_range, _sendfile):
+        copied = 0
+        try:
+            while True:
+                count = method(source_fd, dest_fd, offset + copied, block_size)
+                if count == 0:
+                    break
+                copied += count
+                if callback is not None:
+                    callback(count)
+            return copied
+        except (AttributeError, OSError) as e:
+            if copied or getattr(e, 'errno', errno.ENOSYS) not in UNSUPPORTED_COPY_ERRORS:
+                raise
+    return None
+
+
 class LocalSyncClient(SyncClient):
-    DEFAULT_IGNORE_FILES = ['.index', '.s4lock']
+    DEFAULT_IGNORE_FILES = ['.index', '.s4lock', '.s4cache', '.s4tmp-*']
     LOCK_FILE_NAME = '.s4lock'
-
-    def __init__(self, path):
+    STAT_CACHE_FILE_NAME = '.s4cache'
+    TEMP_FILE_PREFIX = '.s4tmp-'
+    BUFFER_SIZE = 1024 * 1024
+
+    # fsync policies for files written by put
+    FSYNC_NEVER = 'never'
+    FSYNC_FILE = 'file'
+    FSYNC_FULL = 'full'
+
+    def __init__(self, path, stat_cache=None, hash_cache=None, fsync=FSYNC_NEVER):
+        if fsync not in (self.FSYNC_NEVER, self.FSYNC_FILE, self.FSYNC_FULL):
+            raise ValueError('Unknown fsync policy', fsync)
         self.path = path
+        self.fsync = fsync
+        # copy buffers are reused between puts, one per thread
+        self._buffers = threading.local()
+        # timestamps found by the last full scan, kept up to date with our own changes
+        self._scanned_timestamps = None
         self.reload_index()
         self.reload_ignore_files()
         self._lock = filelock.FileLock(self.lock_file)
+        if stat_cache is not None:
+            self.stat_cache = cache.StatCache(self.get_uri(self.STAT_CACHE_FILE_NAME), stat_cache)
+        else:
+            self.stat_cache = None
+        if hash_cache is not None:
+            self.hash_cache = cache.HashCache(hash_cache)
+        else:
+            self.hash_cache = None
 
     @property
     def lock_file(self):
         return self.get_uri(self.LOCK_FILE_NAME)
 
+    def fsync_directory(self, path):
+        # makes the rename of a file into the directory durable
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     def ensure_path(self, path):
         parent = os.path.dirname(path)
         if not os.path.exists(parent):
@@ -94,28 +202,91 @@ class LocalSyncClient(SyncClient):
     def index_path(self):
         return os.path.join(self.path, '.index')
 
+    def get_buffer(self):
+        buffer = getattr(self._buffers, 'buffer', None)
+        if buffer is None:
+            buffer = self._buffers.buffer = bytearray(self.BUFFER_SIZE)
+        return buffer
+
+    def write_contents(self, fd, fp, callback=None):
+        """
+        Copies the contents of fp to the file descriptor fd. Returns the number of bytes
+        written.
+        """
+        buffer = self.get_buffer()
+        view = memoryview(buffer)
+        readinto = getattr(fp, 'readinto', None)
+        total = 0
+        while True:
+            if readinto is not None:
+                size = readinto(buffer)
+                data = view[:size]
+            else:
+                data = fp.read(len(buffer))
+                size = len(data)
+            if not size:
+                break
+
+            written = 0
+            while written < size:
+                written += os.write(fd, data[written:])
+            total += size
+            if callback is not None:
+                callback(size)
+        return total
+
+    def copy_local_file(self, fd, fp, callback=None):
+        """
+        Copies fp to fd inside the kernel if it is a local file (e.g. when syncing two
+        local folders). Returns False if the contents have to be copied by hand.
+        """
+        source_fd = get_file_descriptor(fp)
+        if source_fd is None:
+            return False
+        return copy_file(source_fd, fd, fp.tell(), callback) is not None
+
     def put(self, key, sync_object, callback=None):
         path = os.path.join(self.path, key)
         self.ensure_path(path)
 
-        BUFFER_SIZE = 4096
-        fd, temp_path = tempfile.mkstemp()
+        # Writing next to the destination means the final rename is atomic and the
+        # contents never have to be copied between file systems
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=self.TEMP_FILE_PREFIX,
+        )
 
         try:
-            with open(temp_path, 'wb') as fp1:
-                while True:
-                    data = sync_object.fp.read(BUFFER_SIZE)
-                    fp1.write(data)
-                    if callback is not None:
-                        callback(len(data))
-                    if len(data) < BUFFER_SIZE:
-                        break
-            shutil.move(temp_path, path)
-        except Exception:
+            if hasattr(sync_object.fp, 'write_to'):
+                # objects which can be downloaded in parallel write themselves in place
+                sync_object.fp.write_to(fd, callback)
+            elif not self.copy_local_file(fd, sync_object.fp, callback):
+                if sync_object.total_size:
+                    try:
+                        os.posix_fallocate(fd, 0, sync_object.total_size)
+                    except (AttributeError, OSError):
+                        pass
+                written = self.write_contents(fd, sync_object.fp, callback)
+                if written != sync_object.total_size:
+                    # do not leave preallocated space behind if the source was shorter
+                    os.ftruncate(fd, written)
+
+            if self.fsync != self.FSYNC_NEVER:
+                os.fsync(fd)
+            os.close(fd)
+            fd = None
+            os.replace(temp_path, path)
+            self._update_scanned_timestamp(key)
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
             os.remove(temp_path)
             raise
-        finally:
-            os.close(fd)
+
+        if self.fsync == self.FSYNC_FULL:
+            self.fsync_directory(os.path.dirname(path))
+
+        if self.hash_cache is not None and sync_object.hash is not None:
+            self.hash_cache.set(path, sync_object.hash)
 
         self.set_remote_timestamp(key, sync_object.timestamp)
 
@@ -124,18 +295,66 @@ class LocalSyncClient(SyncClient):
         if os.path.exists(path):
             fp = open(path, 'rb')
             stat = os.stat(path)
-            return SyncObject(fp, stat.st_size, stat.st_mtime)
+            if self.hash_cache is not None:
+                md5 = self.hash_cache.get(path, stat)
+            else:
+                md5 = None
+            return SyncObject(
+                fp, stat.st_size, stat.st_mtime, hash=md5,
+                hasher=functools.partial(self.hash_open_file, path, fp),
+            )
         else:
             return None
 
+    def hash_open_file(self, path, fp):
+        """
+        Returns the md5 of the whole contents of fp (seeking back afterwards) and stores it
+        in the hash cache, unless the file was modified while it was read.
+        """
+        stat = os.fstat(fp.fileno())
+        start = fp.tell()
+        fp.seek(0)
+        result = cache.hash_fp(fp)
+        fp.seek(start)
+        if (
+            self.hash_cache is not None and
+            cache.get_stat_key(os.fstat(fp.fileno())) == cache.get_stat_key(stat)
+        ):
+            self.hash_cache.set(path, result, stat)
+        return result
+
     def delete(self, key):
         path = os.path.join(self.path, key)
         if os.path.exists(path):
             os.remove(path)
+            self._update_scanned_timestamp(key)
             return True
         else:
             return False
 
+    def rename(self, source_key, key):
+        path = os.path.join(self.path, key)
+        self.ensure_path(path)
+        os.replace(os.path.join(self.path, source_key), path)
+        self._update_scanned_timestamp(source_key)
+        self._update_scanned_timestamp(key)
+
+    def get_size(self, key):
+        path = os.path.join(self.path, key)
+        if os.path.exists(path):
+            return os.path.getsize(path)
+        else:
+            return None
+
+    def get_hash(self, key):
+        path = os.path.join(self.path, key)
+        if not os.path.exists(path):
+            return None
+        elif self.hash_cache is not None:
+            return self.hash_cache.get_hash(path)
+        else:
+            return cache.hash_file(path)
+
     def reload_index(self):
         self.index = self._load_index()
 
@@ -166,13 +385,22 @@ class LocalSyncClient(SyncClient):
             logger.debug('Using plaintext encoding for writing index')
             method = open
 
-        fd, temp_path = tempfile.mkstemp()
-        with method(temp_path, 'wt') as fp:
-            json.dump(self.index, fp)
-
-        os.close(fd)
-
-        shutil.move(temp_path, self.index_path())
+        self.ensure_path(self.index_path())
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix=self.TEMP_FILE_PREFIX)
+        try:
+            # encoded in one go, deferred calls running in other threads may update the
+            # index while it is checkpointed
+            data = json.dumps(self.index)
+            with method(temp_path, 'wt') as fp:
+                fp.write(data)
+            if self.fsync != self.FSYNC_NEVER:
+                os.fsync(fd)
+            os.replace(temp_path, self.index_path())
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        finally:
+            os.close(fd)
 
     def get_local_keys(self):
         return list(traverse(self.path, ignore_files=self.ignore_files))
@@ -187,14 +415,59 @@ class LocalSyncClient(SyncClient):
     def get_index_keys(self):
         return self.index.keys()
 
+    def _update_scanned_timestamp(self, key):
+        if self._scanned_timestamps is None:
+            return
+        timestamp = self.get_real_local_timestamp(key)
+        if timestamp is None:
+            self._scanned_timestamps.pop(key, None)
+        else:
+            self._scanned_timestamps[key] = timestamp
+
+    def _get_fingerprint(self, timestamps):
+        digest = hashlib.sha1()
+        for key, timestamp in sorted(timestamps.items()):
+            digest.update('{}\0{}\0'.format(key, timestamp).encode('utf-8'))
+
+        index_timestamp = self.get_real_local_timestamp('.index')
+        digest.update('.index\0{}'.format(index_timestamp).encode('utf-8'))
+        return digest.hexdigest()
+
+    def get_fingerprint(self):
+        return self._get_fingerprint(self.get_all_real_local_timestamps())
+
+    def get_synced_fingerprint(self):
+        if self._scanned_timestamps is None:
+            return None
+        # only the index is written after the scan without going through put or delete
+        return self._get_fingerprint(dict(self._scanned_timestamps))
+
     def get_index_local_timestamp(self, key):
         return self.index.get(key, {}).get('local_timestamp')
 
     def get_all_real_local_timestamps(self):
+        if self.stat_cache is not None:
+            result = self.stat_cache.scan(self.path, self.ignore_files)
+            self.stat_cache.save()
+        else:
+            result = {}
+            for key in self.get_local_keys():
+                result[key] = self.get_real_local_timestamp(key)
+        self._scanned_timestamps = dict(result)
+        return result
+
+    def iter_real_local_timestamps(self):
+        if self.stat_cache is not None:
+            # the cache only knows which directories changed once all of them were scanned
+            for item in super(LocalSyncClient, self).iter_real_local_timestamps():
+                yield item
+            return
+
         result = {}
-        for key in self.get_local_keys():
+        for key in traverse(self.path, ignore_files=self.ignore_files):
             result[key] = self.get_real_local_timestamp(key)
-        return result
+            yield key, result[key]
+        self._scanned_timestamps = result
 
     def get_all_remote_timestamps(self):
         return {key: value.get('remote_timestamp') for key, value in self.index.items()}
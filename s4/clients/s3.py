@@ -1,24 +1,88 @@
 # -*- coding: utf-8 -*-
+import base64
 import collections
 import copy
-import fnmatch
+import hashlib
 import json
 import logging
 import os
+import threading
+import time
 import zlib
+from concurrent import futures
 
+import boto3
+from boto3.s3.transfer import TransferConfig
+
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 import magic
 
+from s4 import transfer as transfer_module
 from s4 import utils
-from s4.clients import SyncClient, SyncObject
+from s4.clients import SyncClient, SyncObject, cache, is_ignored_key
+from s4.clients import chunking as chunking_module
 
 
 logger = logging.getLogger(__name__)
 
 
 S3Uri = collections.namedtuple('S3Uri', ['bucket', 'key'])
+BotoClient = collections.namedtuple('BotoClient', ['session', 'client', 'max_pool_connections'])
+
+# botocore's default, shared clients never use fewer connections than this
+DEFAULT_MAX_POOL_CONNECTIONS = 10
+
+_boto_clients = {}
+_boto_clients_lock = threading.Lock()
+
+
+def get_boto_client(
+    aws_access_key_id, aws_secret_access_key, region_name,
+    max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+):
+    """
+    Returns a boto3 S3 client shared by every target with the same credentials and
+    region, so that their connections are reused instead of opened again for each
+    sync. A new client with a larger pool replaces the shared one when a target needs
+    more connections than it has.
+    """
+    key = (aws_access_key_id, aws_secret_access_key, region_name)
+    max_pool_connections = max(max_pool_connections, DEFAULT_MAX_POOL_CONNECTIONS)
+    with _boto_clients_lock:
+        entry = _boto_clients.get(key)
+        if entry is not None and entry.max_pool_connections >= max_pool_connections:
+            return entry.client
+
+        if entry is None:
+            session = boto3.session.Session(
+                aws_access_key_id=aws_access_key_id,
+                aws_secret_access_key=aws_secret_access_key,
+                region_name=region_name,
+            )
+        else:
+            session = entry.session
+        # adaptive retries also limit the request rate on the client once S3 throttles
+        client = session.client('s3', config=Config(
+            max_pool_connections=max_pool_connections,
+            retries={'mode': 'adaptive'},
+        ))
+        _boto_clients[key] = BotoClient(session, client, max_pool_connections)
+        return client
+
+
+def get_pool_size(options):
+    """
+    Returns the number of connections an S3SyncClient created with the given options
+    may have open at the same time.
+    """
+    transfer = options.get('transfer') or {}
+    return max(
+        options.get('download_concurrency', S3SyncClient.DEFAULT_DOWNLOAD_CONCURRENCY),
+        options.get('copy_concurrency', S3SyncClient.DEFAULT_COPY_CONCURRENCY),
+        transfer.get('max_concurrency', transfer_module.DEFAULT_MAX_CONCURRENCY),
+    )
 
 
 def parse_s3_uri(uri):
@@ -34,26 +98,203 @@ def parse_s3_uri(uri):
     return S3Uri(bucket, key)
 
 
-def is_ignored_key(key, ignore_files):
-    # Check if any subdirectories match the ignore patterns
-    key_parts = key.split('/')
-    for part in key_parts:
-        if any(fnmatch.fnmatch(part, pattern) for pattern in ignore_files):
-            return True
-    else:
+def get_response_hash(response):
+    """
+    Returns the md5 hash of an object from a head_object or get_object response
+    """
+    metadata_hash = response.get('Metadata', {}).get(S3SyncClient.HASH_METADATA_KEY)
+    if metadata_hash is not None:
+        return metadata_hash
+
+    etag = response.get('ETag', '').strip('"')
+    if not etag or '-' in etag:
+        # multipart upload, the ETag is not the md5 of the contents
+        return None
+    return etag
+
+
+def get_total_size(response):
+    """
+    Returns the size of the whole object from a (possibly ranged) get_object response.
+    """
+    content_range = response.get('ContentRange')
+    if content_range:
+        return int(content_range.rsplit('/', 1)[1])
+    return response['ContentLength']
+
+
+class RangedReader(object):
+    """
+    File like object for a large object of which only the first part has been requested.
+    Reading it sequentially fetches everything after that part with a single request,
+    while write_to fetches the remaining parts concurrently with ranged GETs.
+    """
+    def __init__(self, body, total_size, part_size, concurrency, get_range):
+        self.body = body
+        self.first_size = part_size
+        self.total_size = total_size
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.get_range = get_range
+        self._stream = body
+        self._rest = None
+        self.closed = False
+
+    def _next_stream(self):
+        if self._rest is None:
+            self._rest = self.get_range(self.first_size, self.total_size - 1)
+            return self._rest
+        return None
+
+    def read(self, size=-1):
+        results = []
+        while size != 0 and self._stream is not None:
+            data = self._stream.read(size if size > 0 else None)
+            if not data:
+                self._stream = self._next_stream()
+                continue
+            transfer_module.bandwidth.download(len(data))
+            results.append(data)
+            if size > 0:
+                size -= len(data)
+        return b''.join(results)
+
+    def write_to(self, fd, callback=None):
+        """
+        Writes the contents to the file descriptor fd, fetching up to `concurrency`
+        parts at a time. The file is preallocated so that parts can be written in place.
+        """
+        try:
+            os.posix_fallocate(fd, 0, self.total_size)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, self.total_size)
+
+        def write(data, offset):
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(fd, view, offset)
+                view = view[written:]
+                offset += written
+
+        def fetch(offset):
+            end = min(offset + self.part_size, self.total_size) - 1
+            data = self.get_range(offset, end).read()
+            transfer_module.bandwidth.download(len(data))
+            write(data, offset)
+            return len(data)
+
+        data = self.body.read()
+        transfer_module.bandwidth.download(len(data))
+        write(data, 0)
+        if callback is not None:
+            callback(len(data))
+
+        offsets = range(self.first_size, self.total_size, self.part_size)
+        with utils.ThreadPoolExecutor(self.concurrency) as executor:
+            for size in executor.map(fetch, offsets):
+                if callback is not None:
+                    callback(size)
+
+    def close(self):
+        self.closed = True
+        self.body.close()
+        if self._rest is not None:
+            self._rest.close()
+
+
+def _is_seekable(fp):
+    try:
+        return fp.seekable()
+    except AttributeError:
         return False
 
 
+def _get_stat_key(fp):
+    try:
+        return cache.get_stat_key(os.fstat(fp.fileno()))
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
 class S3SyncClient(SyncClient):
-    DEFAULT_IGNORE_FILES = ['.index', '.s4lock']
+    DEFAULT_IGNORE_FILES = ['.index', '.s4lock', '.s4cache', '.s4tmp-*']
+    HASH_METADATA_KEY = 's4-md5'
+    # set on chunk manifests, holds the size of the contents they describe
+    CHUNKED_METADATA_KEY = 's4-chunked'
+    CHUNKS_FOLDER_NAME = '.chunks'
+    DEFAULT_CHUNK_THRESHOLD = 64 * 1024 * 1024
+    # S3 rejects multipart uploads with parts (other than the last) below 5MB
+    MIN_PART_SIZE = 5 * 1024 * 1024
+    MAX_COPY_PART_SIZE = 5 * 1024 * 1024 * 1024
+    MAX_PARTS = 10000
+    APPEND_PART_SIZE = 8 * 1024 * 1024
+    # larger files are uploaded in parts which are recorded so the upload can be resumed
+    RESUMABLE_THRESHOLD = 64 * 1024 * 1024
+    RESUMABLE_PART_SIZE = 16 * 1024 * 1024
+    # unfinished multipart uploads older than this are considered abandoned
+    ABANDONED_UPLOAD_TIMEOUT = 7 * 24 * 60 * 60
+    # younger chunks may belong to a file whose manifest has not been written yet
+    UNREFERENCED_CHUNK_TIMEOUT = 24 * 60 * 60
+    DEFAULT_DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+    DEFAULT_DOWNLOAD_CONCURRENCY = 4
+    COPY_PART_SIZE = 512 * 1024 * 1024
+    DEFAULT_COPY_CONCURRENCY = 8
+    # smaller files are sent with a single put_object instead of a managed transfer
+    DEFAULT_PUT_OBJECT_THRESHOLD = 8 * 1024 * 1024
 
-    def __init__(self, boto, bucket, prefix):
+    def __init__(
+        self, boto, bucket, prefix, chunking=None,
+        download_part_size=DEFAULT_DOWNLOAD_PART_SIZE,
+        download_concurrency=DEFAULT_DOWNLOAD_CONCURRENCY,
+        copy_concurrency=DEFAULT_COPY_CONCURRENCY,
+        transfer=None,
+        put_object_threshold=DEFAULT_PUT_OBJECT_THRESHOLD,
+        store_hashes=False,
+    ):
         self.boto = boto
         self.bucket = bucket
         self.prefix = prefix
+        # objects larger than a part are downloaded with concurrent ranged GETs
+        self.download_part_size = download_part_size
+        self.download_concurrency = download_concurrency
+        self.copy_concurrency = copy_concurrency
+        self.put_object_threshold = put_object_threshold
+        # read large files whose source does not know their hash before uploading them,
+        # multipart ETags are no md5 so verify_hashes and detect_renames need it stored
+        self.store_hashes = store_hashes
+
+        # TransferConfig options for uploads, optionally tuned for every file
+        options = dict(transfer or {})
+        adaptive = options.pop('adaptive', False)
+        unknown = set(options) - set(transfer_module.TRANSFER_OPTIONS)
+        if unknown:
+            raise ValueError('Unknown transfer options', sorted(unknown))
+        self.transfer_options = options
+        if adaptive:
+            self.tuner = transfer_module.get_tuner(
+                self.get_uri(),
+                options.get('max_concurrency', transfer_module.DEFAULT_MAX_CONCURRENCY),
+            )
+        else:
+            self.tuner = None
         # These are lazy loaded as needed
         self._index = None
+        # ETag of the index as last loaded or written by this client
+        self._index_etag = None
         self._ignore_files = None
+        self._chunk_hashes = None
+        self._uploads = None
+        self._aborted_abandoned_uploads = False
+        # object sizes seen while listing, saves a request per key when comparing contents
+        self._sizes = {}
+
+        if chunking is not None:
+            options = dict(chunking)
+            self.chunk_threshold = options.pop('threshold', self.DEFAULT_CHUNK_THRESHOLD)
+            self.chunker = chunking_module.Chunker(**options)
+        else:
+            self.chunk_threshold = None
+            self.chunker = None
 
     def lock(self):
         pass
@@ -83,30 +324,736 @@ class S3SyncClient(SyncClient):
     def index(self, value):
         self._index = value
 
-    def put(self, key, sync_object, callback=None):
-        self.boto.upload_fileobj(
+    def chunk_path(self, chunk_hash):
+        return os.path.join(self.prefix, self.CHUNKS_FOLDER_NAME, chunk_hash)
+
+    def is_chunk_path(self, path):
+        # only the chunk store at the top of the prefix, not folders of the user with that name
+        return path.startswith(self.chunk_path(''))
+
+    @property
+    def chunk_hashes(self):
+        """
+        Hashes of all chunks already stored under the prefix, listed once per client.
+        """
+        if self._chunk_hashes is None:
+            self._chunk_hashes = set()
+            paginator = self.boto.get_paginator('list_objects_v2')
+            page_iterator = paginator.paginate(
+                Bucket=self.bucket,
+                Prefix=self.chunk_path(''),
+            )
+            for page in page_iterator:
+                for obj in page.get('Contents', []):
+                    self._chunk_hashes.add(os.path.basename(obj['Key']))
+        return self._chunk_hashes
+
+    def get_chunk(self, chunk_hash):
+        resp = self.boto.get_object(
+            Bucket=self.bucket,
+            Key=self.chunk_path(chunk_hash),
+        )
+        data = resp['Body'].read()
+        transfer_module.bandwidth.download(len(data))
+        if hashlib.sha256(data).hexdigest() != chunk_hash:
+            raise ValueError('Corrupt chunk', chunk_hash)
+        return data
+
+    def get_referenced_chunks(self, key):
+        """
+        Returns the hashes of the chunks key refers to, which are none unless it is a
+        chunk manifest.
+        """
+        response = self.head(key)
+        if response is None or self.CHUNKED_METADATA_KEY not in response.get('Metadata', {}):
+            return []
+        resp = self.get_object(key)
+        manifest = chunking_module.load_manifest(resp['Body'].read())
+        return [chunk_hash for chunk_hash, _ in manifest['chunks']]
+
+    def delete_unreferenced_chunks(self):
+        """
+        Deletes the chunks which no manifest below the prefix refers to any more and which
+        were stored more than UNREFERENCED_CHUNK_TIMEOUT seconds ago. Returns the listing
+        entries of the deleted chunks.
+        """
+        chunk_prefix = self.chunk_path('')
+        chunks = {}
+        keys = []
+        for obj in self.list_objects():
+            if obj['Key'].startswith(chunk_prefix):
+                chunks[os.path.basename(obj['Key'])] = obj
+            else:
+                keys.append(os.path.relpath(obj['Key'], self.prefix))
+
+        referenced = set()
+        with utils.ThreadPoolExecutor(max_workers=self.download_concurrency) as executor:
+            for chunk_hashes in executor.map(self.get_referenced_chunks, keys):
+                referenced.update(chunk_hashes)
+
+        cutoff = time.time() - self.UNREFERENCED_CHUNK_TIMEOUT
+        unreferenced = sorted(
+            chunk_hash for chunk_hash, obj in chunks.items()
+            if chunk_hash not in referenced and utils.to_timestamp(obj['LastModified']) < cutoff
+        )
+        # delete_objects accepts up to 1000 keys per request
+        for index in range(0, len(unreferenced), 1000):
+            self.boto.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    'Objects': [
+                        {'Key': self.chunk_path(chunk_hash)}
+                        for chunk_hash in unreferenced[index:index + 1000]
+                    ],
+                    'Quiet': True,
+                },
+            )
+
+        if self._chunk_hashes is not None:
+            self._chunk_hashes.difference_update(unreferenced)
+        logger.debug('Deleted %s unreferenced chunks of %s', len(unreferenced), self)
+        return [chunks[chunk_hash] for chunk_hash in unreferenced]
+
+    def put_chunked(self, key, sync_object, callback=None):
+        """
+        Uploads the chunks of sync_object missing from the chunk store followed by a
+        manifest listing them in order.
+        """
+        md5 = hashlib.md5()
+        chunks = []
+        total_size = 0
+        uploaded = 0
+        for data in self.chunker.iter_chunks(sync_object.fp):
+            md5.update(data)
+            chunk_hash = hashlib.sha256(data).hexdigest()
+            if chunk_hash not in self.chunk_hashes:
+                transfer_module.bandwidth.upload(len(data))
+                self.boto.put_object(
+                    Bucket=self.bucket,
+                    Key=self.chunk_path(chunk_hash),
+                    Body=data,
+                )
+                self.chunk_hashes.add(chunk_hash)
+                uploaded += len(data)
+            chunks.append([chunk_hash, len(data)])
+            total_size += len(data)
+            if callback is not None:
+                callback(len(data))
+
+        logger.debug(
+            'Uploaded %s of %s bytes in %s chunks for %s', uploaded, total_size, len(chunks), key,
+        )
+        md5 = md5.hexdigest()
+        self.boto.put_object(
             Bucket=self.bucket,
             Key=os.path.join(self.prefix, key),
-            Fileobj=sync_object.fp,
-            Callback=callback,
+            Body=chunking_module.dump_manifest(total_size, md5, chunks),
+            Metadata={
+                self.HASH_METADATA_KEY: md5,
+                self.CHUNKED_METADATA_KEY: str(total_size),
+            },
         )
-        self.set_remote_timestamp(key, sync_object.timestamp)
 
-    def get(self, key):
+    def get_appended_object(self, key, sync_object):
+        """
+        Returns the head_object response for key if sync_object only appends data to it,
+        otherwise None. On success sync_object.fp is left positioned at the start of the
+        appended data.
+        """
+        fp = sync_object.fp
+        if sync_object.total_size <= self.MIN_PART_SIZE or not _is_seekable(fp):
+            return None
+
+        response = self.head(key)
+        if response is None or self.CHUNKED_METADATA_KEY in response.get('Metadata', {}):
+            return None
+
+        size = response['ContentLength']
+        remote_hash = get_response_hash(response)
+        if remote_hash is None or not self.MIN_PART_SIZE <= size < sync_object.total_size:
+            return None
+
+        start = fp.tell()
+        digest = hashlib.md5()
+        remaining = size
+        while remaining > 0:
+            data = fp.read(min(remaining, self.APPEND_PART_SIZE))
+            if not data:
+                break
+            digest.update(data)
+            remaining -= len(data)
+
+        if remaining > 0 or digest.hexdigest() != remote_hash:
+            fp.seek(start)
+            return None
+
+        # only the appended data is read twice to store the hash of the new contents
+        appended_start = fp.tell()
+        while True:
+            data = fp.read(self.APPEND_PART_SIZE)
+            if not data:
+                break
+            digest.update(data)
+        fp.seek(appended_start)
+        if sync_object.hash is None:
+            sync_object.hash = digest.hexdigest()
+        return response
+
+    def put_appended(self, key, sync_object, response, callback=None):
+        """
+        Builds the new contents of key with a multipart upload which copies the existing
+        object server side and only uploads the data appended to it.
+        """
+        fp = sync_object.fp
+        path = os.path.join(self.prefix, key)
+        size = response['ContentLength']
+        copy_source = {'Bucket': self.bucket, 'Key': path}
+
+        extra_args = {}
+        if sync_object.hash is not None:
+            extra_args['Metadata'] = {self.HASH_METADATA_KEY: sync_object.hash}
+
+        upload = self.boto.create_multipart_upload(Bucket=self.bucket, Key=path, **extra_args)
+        upload_id = upload['UploadId']
+        parts = []
         try:
-            resp = self.boto.get_object(
+            copy_parts = -(-size // self.MAX_COPY_PART_SIZE)
+            copy_part_size = -(-size // copy_parts)
+            for offset in range(0, size, copy_part_size):
+                end = min(offset + copy_part_size, size)
+                result = self.boto.upload_part_copy(
+                    Bucket=self.bucket,
+                    Key=path,
+                    UploadId=upload_id,
+                    PartNumber=len(parts) + 1,
+                    CopySource=copy_source,
+                    CopySourceRange='bytes={}-{}'.format(offset, end - 1),
+                    # fail if the object changed since its contents were compared
+                    CopySourceIfMatch=response['ETag'],
+                )
+                parts.append({
+                    'ETag': result['CopyPartResult']['ETag'],
+                    'PartNumber': len(parts) + 1,
+                })
+            if callback is not None:
+                callback(size)
+
+            tail_size = sync_object.total_size - size
+            part_size = max(self.APPEND_PART_SIZE, -(-tail_size // (self.MAX_PARTS - len(parts))))
+            while True:
+                data = fp.read(part_size)
+                if not data:
+                    break
+                transfer_module.bandwidth.upload(len(data))
+                result = self.boto.upload_part(
+                    Bucket=self.bucket,
+                    Key=path,
+                    UploadId=upload_id,
+                    PartNumber=len(parts) + 1,
+                    Body=data,
+                )
+                parts.append({'ETag': result['ETag'], 'PartNumber': len(parts) + 1})
+                if callback is not None:
+                    callback(len(data))
+
+            self.boto.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=path,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+            )
+        except BaseException:
+            self.boto.abort_multipart_upload(Bucket=self.bucket, Key=path, UploadId=upload_id)
+            raise
+
+        logger.debug('Appended %s bytes to %s', sync_object.total_size - size, key)
+
+    @property
+    def uploads(self):
+        if self._uploads is None:
+            self._uploads = cache.UploadState()
+        return self._uploads
+
+    def get_transfer_options(self, size):
+        options = {
+            'multipart_threshold': transfer_module.DEFAULT_MULTIPART_THRESHOLD,
+            'multipart_chunksize': transfer_module.DEFAULT_MULTIPART_CHUNKSIZE,
+            'max_concurrency': transfer_module.DEFAULT_MAX_CONCURRENCY,
+        }
+        options.update(self.transfer_options)
+        if self.tuner is not None:
+            options.update(self.tuner.get_options(size))
+        return options
+
+    def abort_abandoned_uploads(self):
+        """
+        Aborts multipart uploads below the prefix which were started more than
+        ABANDONED_UPLOAD_TIMEOUT seconds ago. S3 keeps charging for their parts otherwise.
+        """
+        if self._aborted_abandoned_uploads:
+            return
+        self._aborted_abandoned_uploads = True
+
+        cutoff = time.time() - self.ABANDONED_UPLOAD_TIMEOUT
+        paginator = self.boto.get_paginator('list_multipart_uploads')
+        page_iterator = paginator.paginate(
+            Bucket=self.bucket,
+            Prefix=self.prefix,
+        )
+        for page in page_iterator:
+            for upload in page.get('Uploads', []):
+                if utils.to_timestamp(upload['Initiated']) >= cutoff:
+                    continue
+                logger.info('Aborting abandoned upload of %s', upload['Key'])
+                self.abort_upload(upload['Key'], upload['UploadId'])
+
+    def abort_upload(self, path, upload_id):
+        try:
+            self.boto.abort_multipart_upload(Bucket=self.bucket, Key=path, UploadId=upload_id)
+        except ClientError as e:
+            logger.debug('Unable to abort upload of %s: %s', path, e)
+
+        uri = 's3://{}/{}'.format(self.bucket, path)
+        state = self.uploads.get(uri)
+        if state is not None and state['upload_id'] == upload_id:
+            self.uploads.remove(uri)
+
+    def get_uploaded_parts(self, path, upload_id):
+        """
+        Returns the ETags of the parts S3 has received for an upload or None if the upload
+        no longer exists.
+        """
+        results = {}
+        paginator = self.boto.get_paginator('list_parts')
+        page_iterator = paginator.paginate(
+            Bucket=self.bucket,
+            Key=path,
+            UploadId=upload_id,
+        )
+        try:
+            for page in page_iterator:
+                for part in page.get('Parts', []):
+                    results[part['PartNumber']] = part['ETag']
+        except ClientError:
+            return None
+        return results
+
+    def put_resumable(self, key, sync_object, callback=None):
+        """
+        Multipart upload which records its UploadId and the ETag of every finished part in
+        the upload state file. If an upload of the same source (size and timestamp) was
+        interrupted, the parts S3 still has are reused instead of being sent again.
+        """
+        self.abort_abandoned_uploads()
+
+        fp = sync_object.fp
+        path = os.path.join(self.prefix, key)
+        uri = self.get_uri(key)
+        source = [sync_object.total_size, sync_object.timestamp]
+
+        state = self.uploads.get(uri)
+        server_parts = {}
+        if state is not None and state['source'] != source:
+            logger.debug('Source of %s changed, restarting its upload', key)
+            self.abort_upload(path, state['upload_id'])
+            state = None
+        elif state is not None:
+            server_parts = self.get_uploaded_parts(path, state['upload_id'])
+            if server_parts is None:
+                self.uploads.remove(uri)
+                server_parts = {}
+                state = None
+
+        options = self.get_transfer_options(sync_object.total_size)
+        if state is None:
+            extra_args = {}
+            if sync_object.hash is not None:
+                extra_args['Metadata'] = {self.HASH_METADATA_KEY: sync_object.hash}
+            upload = self.boto.create_multipart_upload(Bucket=self.bucket, Key=path, **extra_args)
+            if self.tuner is not None or 'multipart_chunksize' in self.transfer_options:
+                part_size = options['multipart_chunksize']
+            else:
+                part_size = self.RESUMABLE_PART_SIZE
+            state = {
+                'upload_id': upload['UploadId'],
+                'source': source,
+                'part_size': max(part_size, -(-sync_object.total_size // self.MAX_PARTS)),
+                'started_at': time.time(),
+                'parts': {},
+            }
+            self.uploads.set(uri, state)
+        else:
+            logger.info('Resuming upload of %s (%s parts done)', key, len(server_parts))
+
+        upload_id = state['upload_id']
+        part_size = state['part_size']
+        concurrency = options['max_concurrency']
+        seekable = _is_seekable(fp)
+        parts = {}
+        pending = {}
+
+        def finish(part_number, size, etag):
+            parts[part_number] = etag
+            state['parts'][str(part_number)] = etag
+            self.uploads.set(uri, state)
+            if callback is not None:
+                callback(size)
+
+        def wait(return_when):
+            done, _ = futures.wait(pending, return_when=return_when)
+            for future in done:
+                part_number, size = pending.pop(future)
+                finish(part_number, size, future.result()['ETag'])
+
+        timer = transfer_module.TransferTimer(self.tuner, 0, concurrency)
+        with timer, utils.ThreadPoolExecutor(concurrency) as executor:
+            try:
+                offsets = range(0, sync_object.total_size, part_size)
+                for part_number, offset in enumerate(offsets, start=1):
+                    size = min(part_size, sync_object.total_size - offset)
+                    recorded = state['parts'].get(str(part_number))
+                    server = server_parts.get(part_number)
+
+                    if recorded is not None and recorded == server and seekable:
+                        fp.seek(size, os.SEEK_CUR)
+                        parts[part_number] = recorded
+                        if callback is not None:
+                            callback(size)
+                        continue
+
+                    data = fp.read(size)
+                    if server is not None and server.strip('"') == hashlib.md5(data).hexdigest():
+                        finish(part_number, size, server)
+                        continue
+
+                    # bound the number of parts held in memory
+                    if len(pending) >= concurrency:
+                        wait(futures.FIRST_COMPLETED)
+                    transfer_module.bandwidth.upload(size)
+                    future = executor.submit(
+                        self.boto.upload_part,
+                        Bucket=self.bucket,
+                        Key=path,
+                        UploadId=upload_id,
+                        PartNumber=part_number,
+                        Body=data,
+                    )
+                    pending[future] = (part_number, size)
+                    timer.size += size
+                wait(futures.ALL_COMPLETED)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+        self.boto.complete_multipart_upload(
+            Bucket=self.bucket,
+            Key=path,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': [
+                {'ETag': etag, 'PartNumber': part_number}
+                for part_number, etag in sorted(parts.items())
+            ]},
+        )
+        self.uploads.remove(uri)
+
+    def put(self, key, sync_object, callback=None):
+        if self.chunker is not None and sync_object.total_size >= self.chunk_threshold:
+            self.put_chunked(key, sync_object, callback)
+        else:
+            self.put_object(key, sync_object, callback)
+        self._sizes.pop(key, None)
+        self.set_remote_timestamp(key, sync_object.timestamp)
+
+    def get_upload_hash(self, sync_object):
+        """
+        Returns the md5 of the contents of sync_object, asking its source for it or reading
+        them first (and seeking back) if it is unknown.
+        """
+        fp = sync_object.fp
+        if sync_object.hash is None and sync_object.hasher is not None:
+            sync_object.hash = sync_object.hasher()
+        elif sync_object.hash is None and _is_seekable(fp):
+            start = fp.tell()
+            sync_object.hash = cache.hash_fp(fp, self.APPEND_PART_SIZE)
+            fp.seek(start)
+        return sync_object.hash
+
+    def put_object(self, key, sync_object, callback=None):
+        stat_key = _get_stat_key(sync_object.fp)
+        self.put_contents(key, sync_object, callback)
+        if (
+            sync_object.hash is not None and stat_key is not None and
+            _get_stat_key(sync_object.fp) != stat_key
+        ):
+            # the contents which were hashed are not necessarily the ones uploaded
+            logger.warning('%s changed while it was uploaded, not storing its hash', key)
+            self.remove_hash(key)
+
+    def remove_hash(self, key):
+        path = os.path.join(self.prefix, key)
+        self.boto.copy(
+            CopySource={'Bucket': self.bucket, 'Key': path},
+            Bucket=self.bucket,
+            Key=path,
+            ExtraArgs={'MetadataDirective': 'REPLACE'},
+        )
+
+    def put_contents(self, key, sync_object, callback=None):
+        appended = self.get_appended_object(key, sync_object)
+        if appended is not None:
+            self.put_appended(key, sync_object, appended, callback)
+            return
+
+        if self.put_object_threshold and sync_object.total_size < self.put_object_threshold:
+            self.put_small_object(key, sync_object, callback)
+            return
+
+        if self.store_hashes:
+            self.get_upload_hash(sync_object)
+
+        if sync_object.total_size >= self.RESUMABLE_THRESHOLD:
+            self.put_resumable(key, sync_object, callback)
+            return
+
+        extra_args = {}
+        if sync_object.hash is not None:
+            # ETags of multipart uploads are not md5 hashes so store it separately
+            extra_args['Metadata'] = {self.HASH_METADATA_KEY: sync_object.hash}
+
+        options = self.get_transfer_options(sync_object.total_size)
+        concurrency = 1
+        if sync_object.total_size >= options['multipart_threshold']:
+            concurrency = options['max_concurrency']
+
+        def progress(size):
+            # s3transfer reports negative sizes when it retries a part
+            if size > 0:
+                transfer_module.bandwidth.upload(size)
+            if callback is not None:
+                callback(size)
+
+        with transfer_module.TransferTimer(self.tuner, sync_object.total_size, concurrency):
+            self.boto.upload_fileobj(
                 Bucket=self.bucket,
                 Key=os.path.join(self.prefix, key),
+                Fileobj=sync_object.fp,
+                Callback=progress,
+                ExtraArgs=extra_args,
+                Config=TransferConfig(**options),
             )
+
+    def put_small_object(self, key, sync_object, callback=None):
+        # read until the end like upload_fileobj would, the file may have grown
+        blocks = []
+        while True:
+            block = sync_object.fp.read(self.put_object_threshold)
+            if not block:
+                break
+            blocks.append(block)
+        data = b''.join(blocks)
+        digest = hashlib.md5(data)
+
+        transfer_module.bandwidth.upload(len(data))
+        with transfer_module.TransferTimer(self.tuner, len(data)):
+            self.boto.put_object(
+                Bucket=self.bucket,
+                Key=os.path.join(self.prefix, key),
+                Body=data,
+                ContentMD5=base64.b64encode(digest.digest()).decode('ascii'),
+                # also kept when the object is later extended by put_appended
+                Metadata={self.HASH_METADATA_KEY: sync_object.hash or digest.hexdigest()},
+            )
+        if callback is not None:
+            callback(len(data))
+
+    def get_object(self, key, **kwargs):
+        return self.boto.get_object(
+            Bucket=self.bucket,
+            Key=os.path.join(self.prefix, key),
+            **kwargs
+        )
+
+    def get(self, key):
+        try:
+            if self.download_part_size:
+                # only request the first part, the rest can be fetched concurrently
+                try:
+                    resp = self.get_object(
+                        key, Range='bytes=0-{}'.format(self.download_part_size - 1),
+                    )
+                except ClientError as e:
+                    # ranges of empty objects can not be satisfied
+                    if e.response['Error']['Code'] != 'InvalidRange':
+                        raise
+                    resp = self.get_object(key)
+            else:
+                resp = self.get_object(key)
+
+            total_size = get_total_size(resp)
+            if self.CHUNKED_METADATA_KEY in resp.get('Metadata', {}):
+                if total_size > resp['ContentLength']:
+                    # the whole manifest is requested again, release the connection first
+                    resp['Body'].close()
+                    resp = self.get_object(key)
+                try:
+                    manifest = chunking_module.load_manifest(resp['Body'].read())
+                finally:
+                    resp['Body'].close()
+                fp = chunking_module.ChunkedReader(manifest['chunks'], self.get_chunk)
+                total_size = manifest['size']
+            elif total_size > resp['ContentLength']:
+                def get_range(start, end):
+                    return self.get_object(
+                        key,
+                        Range='bytes={}-{}'.format(start, end),
+                        # fail if the object is replaced while it is being downloaded
+                        IfMatch=resp['ETag'],
+                    )['Body']
+
+                fp = RangedReader(
+                    resp['Body'], total_size, self.download_part_size,
+                    self.download_concurrency, get_range,
+                )
+            else:
+                fp = transfer_module.LimitedReader(
+                    resp['Body'], transfer_module.bandwidth.download,
+                )
             return SyncObject(
-                resp['Body'],
-                resp['ContentLength'],
+                fp,
+                total_size,
                 utils.to_timestamp(resp['LastModified']),
+                hash=get_response_hash(resp),
             )
         except ClientError:
             return None
 
+    def head(self, key):
+        try:
+            return self.boto.head_object(
+                Bucket=self.bucket,
+                Key=os.path.join(self.prefix, key),
+            )
+        except ClientError:
+            return None
+
+    def get_size(self, key):
+        # listings only show the size of chunk manifests, not of their contents
+        if key in self._sizes and self.chunker is None:
+            return self._sizes[key]
+        response = self.head(key)
+        if response is None:
+            return None
+        chunked_size = response.get('Metadata', {}).get(self.CHUNKED_METADATA_KEY)
+        if chunked_size is not None:
+            return int(chunked_size)
+        return response['ContentLength']
+
+    def copy(self, source_key, key):
+        """
+        Server side copy of source_key to key. Large objects are copied in parts.
+        """
+        self.boto.copy(
+            CopySource={'Bucket': self.bucket, 'Key': os.path.join(self.prefix, source_key)},
+            Bucket=self.bucket,
+            Key=os.path.join(self.prefix, key),
+        )
+        self._sizes.pop(key, None)
+
+    def copy_from(self, client, key):
+        """
+        Server side copy of key from another S3 target, which may be in a different bucket
+        or region. Objects above the 5GB limit of copy_object are copied in parts, up to
+        `copy_concurrency` at a time.
+        """
+        if not isinstance(client, S3SyncClient):
+            return False
+
+        response = client.head(key)
+        if response is None:
+            return False
+        if self.CHUNKED_METADATA_KEY in response.get('Metadata', {}):
+            # the manifest refers to chunks which only exist below the other prefix
+            return False
+
+        size = response['ContentLength']
+        if self.chunker is not None and size >= self.chunk_threshold:
+            return False
+
+        copy_source = {'Bucket': client.bucket, 'Key': os.path.join(client.prefix, key)}
+        path = os.path.join(self.prefix, key)
+        try:
+            if size <= self.MAX_COPY_PART_SIZE:
+                self.boto.copy_object(
+                    CopySource=copy_source,
+                    CopySourceIfMatch=response['ETag'],
+                    Bucket=self.bucket,
+                    Key=path,
+                    MetadataDirective='COPY',
+                )
+            else:
+                self.copy_parts(copy_source, response, path)
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('AccessDenied', 'AuthorizationHeaderMalformed'):
+                raise
+            # e.g. the credentials of this target can not read the other bucket
+            logger.debug('Unable to copy %s from %s: %s', key, client, e)
+            return False
+
+        logger.debug('Copied %s from %s on the server side', key, client)
+        self._sizes.pop(key, None)
+        return True
+
+    def copy_parts(self, copy_source, response, path):
+        size = response['ContentLength']
+        part_size = max(self.COPY_PART_SIZE, -(-size // self.MAX_PARTS))
+        extra_args = {}
+        if 'ContentType' in response:
+            extra_args['ContentType'] = response['ContentType']
+
+        upload = self.boto.create_multipart_upload(
+            Bucket=self.bucket, Key=path, Metadata=response.get('Metadata', {}), **extra_args
+        )
+        upload_id = upload['UploadId']
+
+        def copy_part(part):
+            part_number, offset = part
+            result = self.boto.upload_part_copy(
+                Bucket=self.bucket,
+                Key=path,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                CopySource=copy_source,
+                CopySourceRange='bytes={}-{}'.format(offset, min(offset + part_size, size) - 1),
+                CopySourceIfMatch=response['ETag'],
+            )
+            return {'ETag': result['CopyPartResult']['ETag'], 'PartNumber': part_number}
+
+        try:
+            with utils.ThreadPoolExecutor(self.copy_concurrency) as executor:
+                parts = list(executor.map(
+                    copy_part, enumerate(range(0, size, part_size), start=1),
+                ))
+            self.boto.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=path,
+                UploadId=upload_id,
+                MultipartUpload={'Parts': parts},
+            )
+        except BaseException:
+            self.boto.abort_multipart_upload(Bucket=self.bucket, Key=path, UploadId=upload_id)
+            raise
+
+    def rename(self, source_key, key):
+        self.copy(source_key, key)
+        self.delete(source_key)
+
+    def get_hash(self, key):
+        response = self.head(key)
+        return get_response_hash(response) if response is not None else None
+
     def delete(self, key):
+        self._sizes.pop(key, None)
         resp = self.boto.delete_objects(
             Bucket=self.bucket,
             Delete={
@@ -122,6 +1069,7 @@ class S3SyncClient(SyncClient):
                 Key=self.index_path(),
             )
             body = resp['Body'].read()
+            self._index_etag = resp.get('ETag')
             content_type = magic.from_buffer(body, mime=True)
             if content_type == 'text/plain':
                 logger.debug('Detected plain text encoding for index')
@@ -135,6 +1083,7 @@ class S3SyncClient(SyncClient):
             else:
                 raise ValueError('Unknown content type for index', content_type)
         except (ClientError):
+            self._index_etag = None
             return {}
 
     def reload_index(self):
@@ -148,11 +1097,12 @@ class S3SyncClient(SyncClient):
         else:
             logger.debug('Using plain text encoding for writing index')
 
-        self.boto.put_object(
+        response = self.boto.put_object(
             Bucket=self.bucket,
             Key=self.index_path(),
             Body=data,
         )
+        self._index_etag = response.get('ETag')
 
     def get_local_keys(self):
         results = []
@@ -166,6 +1116,8 @@ class S3SyncClient(SyncClient):
                 return results
 
             for obj in page['Contents']:
+                if self.is_chunk_path(obj['Key']):
+                    continue
                 key = os.path.relpath(obj['Key'], self.prefix)
                 if not is_ignored_key(key, self.ignore_files):
                     results.append(key)
@@ -187,6 +1139,21 @@ class S3SyncClient(SyncClient):
     def get_index_keys(self):
         return self.index.keys()
 
+    def get_fingerprint(self):
+        # Every sync through s4 rewrites the index, so its ETag changes with it
+        try:
+            response = self.boto.head_object(
+                Bucket=self.bucket,
+                Key=self.index_path(),
+            )
+            return response['ETag']
+        except ClientError:
+            return None
+
+    def get_synced_fingerprint(self):
+        # another machine rewriting the index during the sync changes its ETag again
+        return self._index_etag
+
     def get_index_local_timestamp(self, key):
         return self.index.get(key, {}).get('local_timestamp')
 
@@ -203,8 +1170,41 @@ class S3SyncClient(SyncClient):
             self.index[key] = {}
         self.index[key]['remote_timestamp'] = timestamp
 
+    def list_objects(self):
+        objects = []
+        paginator = self.boto.get_paginator('list_objects_v2')
+        page_iterator = paginator.paginate(
+            Bucket=self.bucket,
+            Prefix=self.prefix,
+        )
+        for page in page_iterator:
+            objects.extend(page.get('Contents', []))
+        return objects
+
     def get_all_real_local_timestamps(self):
+        # neither the index nor the .syncignore file are needed to start listing, so
+        # the three are requested at the same time
+        with utils.ThreadPoolExecutor(max_workers=3) as executor:
+            objects = executor.submit(self.list_objects)
+            index = executor.submit(getattr, self, 'index')
+            ignore_files = executor.submit(getattr, self, 'ignore_files')
+            index.result()
+            ignore_files = ignore_files.result()
+            objects = objects.result()
+
         result = {}
+        for obj in objects:
+            if self.is_chunk_path(obj['Key']):
+                continue
+            key = os.path.relpath(obj['Key'], self.prefix)
+            if not is_ignored_key(key, ignore_files):
+                result[key] = utils.to_timestamp(obj['LastModified'])
+                self._sizes[key] = obj['Size']
+
+        return result
+
+    def iter_real_local_timestamps(self):
+        ignore_files = self.ignore_files
         paginator = self.boto.get_paginator('list_objects_v2')
         page_iterator = paginator.paginate(
             Bucket=self.bucket,
@@ -212,11 +1212,12 @@ class S3SyncClient(SyncClient):
         )
         for page in page_iterator:
             for obj in page.get('Contents', []):
+                if self.is_chunk_path(obj['Key']):
+                    continue
                 key = os.path.relpath(obj['Key'], self.prefix)
-                if not is_ignored_key(key, self.ignore_files):
-                    result[key] = utils.to_timestamp(obj['LastModified'])
-
-        return result
+                if not is_ignored_key(key, ignore_files):
+                    self._sizes[key] = obj['Size']
+                    yield key, utils.to_timestamp(obj['LastModified'])
 
     def get_all_remote_timestamps(self):
         return {key: value.get('remote_timestamp') for key, value in self.index.items()}
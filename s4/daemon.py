@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import time
+from collections import defaultdict, namedtuple
+
+from inotify_simple import Event, flags
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+
+from s4 import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+# File systems on which inotify does not see changes made by other machines
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', '9p', 'ceph', 'glusterfs')
+
+
+EntryStat = namedtuple('EntryStat', ['is_dir', 'mtime_ns', 'size', 'inode'])
+
+
+class ReconciliationPolicy(object):
+    """
+    Decides when the daemon should run a full reconciliation (a complete scan and
+    listing of both clients) for a target instead of the cheap incremental syncs
+    it runs for each batch of file system events.
+
+    A full reconciliation is only due once `interval` seconds have passed since the
+    last one, and is skipped entirely if nothing could have been missed in the
+    meantime (e.g. no inotify queue overflow and no failed syncs).
+
+    Events only cover the local side, so the fingerprint of the remote side is also
+    compared with the one our last sync left behind, every `remote_interval` seconds
+    and whenever a reconciliation is due. Targets which changed remotely are
+    reconciled straight away. Failed reconciliations are retried after
+    `retry_interval` seconds, doubling with every further failure.
+    """
+    OVERFLOW = 'overflow'
+    ERROR = 'error'
+    # no events are received for the target, e.g. when both sides are on S3
+    UNWATCHED = 'unwatched'
+    # something else (e.g. another machine) changed the remote side
+    REMOTE = 'remote'
+
+    def __init__(self, interval, clock=None, remote_interval=None, retry_interval=60):
+        self.interval = interval
+        self.remote_interval = remote_interval
+        self.retry_interval = retry_interval
+        self.clock = clock or time.monotonic
+        self._last_run = {}
+        self._checked_at = {}
+        self._fingerprints = {}
+        self._failures = defaultdict(int)
+        self._reasons = defaultdict(set)
+
+    def __repr__(self):
+        return 'ReconciliationPolicy<interval={}>'.format(self.interval)
+
+    def add_target(self, target):
+        now = self.clock()
+        self._last_run[target] = now
+        self._checked_at[target] = now
+
+    def mark_dirty(self, target, reason):
+        logger.debug('Marking %s for full reconciliation (%s)', target, reason)
+        self._reasons[target].add(reason)
+
+    def mark_all_dirty(self, reason):
+        for target in self._last_run:
+            self.mark_dirty(target, reason)
+
+    def get_reasons(self, target):
+        return set(self._reasons.get(target, set()))
+
+    def is_dirty(self, target):
+        return len(self._reasons.get(target, ())) > 0
+
+    def reconciled(self, target):
+        now = self.clock()
+        self._last_run[target] = now
+        # a full reconciliation has just listed the remote side as well
+        self._checked_at[target] = now
+        self._reasons.pop(target, None)
+        self._failures.pop(target, None)
+
+    def failed(self, target):
+        """
+        Delays the next reconciliation of a target whose full sync failed, e.g. while
+        offline, instead of retrying it straight away.
+        """
+        self._failures[target] += 1
+        delay = min(self.interval, self.retry_interval * 2 ** (self._failures[target] - 1))
+        logger.debug('Retrying full reconciliation of %s in %s seconds', target, delay)
+        # as if the last reconciliation ran just long enough ago to be due after delay
+        self._last_run[target] = self.clock() - self.interval + delay
+
+    def synced(self, target, fingerprint):
+        """
+        Records the fingerprint of the remote side of target as our last sync left it.
+        """
+        if fingerprint is not None:
+            self._fingerprints[target] = fingerprint
+
+    def has_remote_changes(self, target, get_fingerprint):
+        self._checked_at[target] = self.clock()
+        fingerprint = get_fingerprint(target)
+        # an unknown fingerprint (e.g. while offline) is no reason to reconcile
+        return fingerprint is not None and fingerprint != self._fingerprints.get(target)
+
+    def get_due_targets(self, get_fingerprint=None):
+        """
+        Returns the targets whose reconciliation interval has elapsed, or whose remote
+        side changed according to `get_fingerprint(target)`. Targets which are due but
+        could not have missed anything are skipped and their timer reset.
+        """
+        if not self.interval:
+            return []
+
+        now = self.clock()
+        results = []
+        for target, last_run in sorted(self._last_run.items()):
+            due = now - last_run >= self.interval
+            if self.is_dirty(target):
+                if due:
+                    results.append(target)
+                continue
+
+            check_remote = get_fingerprint is not None and (
+                due or (
+                    self.remote_interval and
+                    now - self._checked_at[target] >= self.remote_interval
+                )
+            )
+            if check_remote and self.has_remote_changes(target, get_fingerprint):
+                self.mark_dirty(target, self.REMOTE)
+                results.append(target)
+            elif due:
+                logger.debug('Skipping full reconciliation of %s: nothing was missed', target)
+                self._last_run[target] = now
+        return results
+
+    def get_timeout(self):
+        """
+        Returns the number of milliseconds until the next reconciliation or remote check
+        is due, or None if the daemon can wait indefinitely for events.
+        """
+        if not self.interval or not self._last_run:
+            return None
+
+        deadline = min(self._last_run.values()) + self.interval
+        # dirty targets wait for their reconciliation and are not checked remotely
+        checked_at = [
+            checked_at for target, checked_at in self._checked_at.items()
+            if not self.is_dirty(target)
+        ]
+        if self.remote_interval and checked_at:
+            deadline = min(deadline, min(checked_at) + self.remote_interval)
+        return max(0, int((deadline - self.clock()) * 1000))
+
+
+def get_filesystem_type(path, mounts_path='/proc/self/mounts'):
+    """
+    Returns the type of the file system the given path resides on or None if it
+    cannot be determined.
+    """
+    path = os.path.realpath(path)
+    try:
+        with open(mounts_path, 'r') as fp:
+            lines = fp.read().splitlines()
+    except (IOError, OSError):
+        return None
+
+    result = None
+    best_match = ''
+    for line in lines:
+        tokens = line.split()
+        if len(tokens) < 3:
+            continue
+        mount_point = tokens[1].replace('\\040', ' ')
+        prefix = mount_point.rstrip('/') + '/'
+        if (path == mount_point or path.startswith(prefix)) and len(mount_point) >= len(best_match):
+            best_match = mount_point
+            result = tokens[2]
+    return result
+
+
+def supports_inotify(path):
+    fs_type = get_filesystem_type(path)
+    if fs_type is None:
+        return True
+    return fs_type not in NETWORK_FILESYSTEMS and not fs_type.startswith('fuse')
+
+
+class DirectorySnapshot(object):
+    def __init__(self, wd, mtime_ns, entries, scanned_at):
+        self.wd = wd
+        self.mtime_ns = mtime_ns
+        self.entries = entries
+        self.scanned_at = scanned_at
+
+    def is_racy(self):
+        return self.mtime_ns >= self.scanned_at - utils.RACY_WINDOW_NS
+
+
+def scan_directory(path):
+    entries = {}
+    for item in scandir(path):
+        try:
+            stat = item.stat(follow_symlinks=False)
+        except OSError:
+            # removed while we were scanning
+            continue
+        entries[item.name] = EntryStat(
+            item.is_dir(follow_symlinks=False), stat.st_mtime_ns, stat.st_size, stat.st_ino,
+        )
+    return entries
+
+
+class PollingNotifier(object):
+    """
+    Polling change detector for file systems where inotify does not deliver events
+    (NFS, SMB and some FUSE mounts). Produces the same events as INotifyRecursive.
+
+    An in-memory stat snapshot of every watched directory is kept. Each poll only
+    stats the watched directories and rescans the listing of those whose mtime changed.
+    Files modified in place do not change their directory's mtime, so a rotating
+    sweep also re-stats up to `stat_batch` files from unchanged directories per poll.
+    """
+    def __init__(self, interval=5.0, stat_batch=1000, clock=None, sleep=None):
+        self.interval = interval
+        self.stat_batch = stat_batch
+        self.clock = clock or time.monotonic
+        self.sleep = sleep or time.sleep
+        self._next_wd = 1
+        self._snapshots = {}
+        self._paths = {}
+        self._sweep = []
+
+    def __repr__(self):
+        return 'PollingNotifier<interval={}, {} directories>'.format(
+            self.interval, len(self._snapshots)
+        )
+
+    def add_watch(self, path, mask=None):
+        path = os.fsdecode(path)
+        if path in self._snapshots:
+            return self._snapshots[path].wd
+
+        wd = self._next_wd
+        self._next_wd += 1
+        self._snapshots[path] = self._snapshot(wd, path)
+        self._paths[wd] = path
+        return wd
+
+    def add_watches(self, path, mask=None):
+        path = os.fsdecode(path)
+        results = {self.add_watch(path, mask): path}
+
+        for name, entry in self._snapshots[path].entries.items():
+            if entry.is_dir:
+                results.update(self.add_watches(os.path.join(path, name), mask))
+
+        return results
+
+    def rm_watch(self, wd):
+        path = self._paths.pop(wd, None)
+        self._snapshots.pop(path, None)
+
+    def _snapshot(self, wd, path):
+        now = int(time.time() * 10**9)
+        mtime_ns = os.stat(path).st_mtime_ns
+        return DirectorySnapshot(wd, mtime_ns, scan_directory(path), now)
+
+    def _remove_subtree(self, path):
+        prefix = os.path.join(path, '')
+        for other in list(self._snapshots):
+            if other == path or other.startswith(prefix):
+                self.rm_watch(self._snapshots[other].wd)
+
+    def _diff_directory(self, path, snapshot):
+        events = []
+        try:
+            new_snapshot = self._snapshot(snapshot.wd, path)
+        except OSError:
+            # The directory itself was removed, its parent will report this
+            return events
+
+        old_entries, new_entries = snapshot.entries, new_snapshot.entries
+        for name in sorted(set(old_entries) | set(new_entries)):
+            old, new = old_entries.get(name), new_entries.get(name)
+            if old is None:
+                mask = flags.CREATE | (flags.ISDIR if new.is_dir else 0)
+            elif new is None:
+                mask = flags.DELETE | (flags.ISDIR if old.is_dir else 0)
+                if old.is_dir:
+                    self._remove_subtree(os.path.join(path, name))
+            elif old.is_dir != new.is_dir:
+                mask = flags.CREATE | (flags.ISDIR if new.is_dir else 0)
+            elif not new.is_dir and old != new:
+                mask = flags.MODIFY
+            else:
+                continue
+            events.append(Event(wd=snapshot.wd, mask=mask, cookie=0, name=name))
+
+        self._snapshots[path] = new_snapshot
+        return events
+
+    def _sweep_files(self, skip):
+        """
+        Re-stat a batch of files from directories which were not rescanned.
+        """
+        events = []
+        checked = 0
+        while checked < self.stat_batch:
+            if not self._sweep:
+                # never check the same file twice in a single poll
+                if checked > 0:
+                    break
+                self._sweep = [
+                    (path, name)
+                    for path, snapshot in self._snapshots.items()
+                    for name, entry in snapshot.entries.items()
+                    if not entry.is_dir
+                ]
+                if not self._sweep:
+                    break
+
+            path, name = self._sweep.pop()
+            checked += 1
+            snapshot = self._snapshots.get(path)
+            if path in skip or snapshot is None or name not in snapshot.entries:
+                continue
+
+            try:
+                stat = os.stat(os.path.join(path, name), follow_symlinks=False)
+            except OSError:
+                # deleted files are picked up when the directory mtime changes
+                continue
+
+            old = snapshot.entries[name]
+            new = EntryStat(old.is_dir, stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            if new != old:
+                snapshot.entries[name] = new
+                events.append(Event(wd=snapshot.wd, mask=flags.MODIFY, cookie=0, name=name))
+        return events
+
+    def poll(self):
+        """
+        Runs a single polling cycle and returns the events found.
+        """
+        events = []
+        changed = set()
+        for path in sorted(self._snapshots):
+            snapshot = self._snapshots.get(path)
+            if snapshot is None:
+                continue
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+
+            if mtime_ns != snapshot.mtime_ns or snapshot.is_racy():
+                changed.add(path)
+                events.extend(self._diff_directory(path, snapshot))
+
+        events.extend(self._sweep_files(changed))
+        logger.debug(
+            'Polled %s directories (%s changed): %s events',
+            len(self._snapshots), len(changed), len(events),
+        )
+        return events
+
+    def read(self, timeout=None, read_delay=None):
+        """
+        Blocks until events are available or `timeout` milliseconds have passed. If
+        `read_delay` is given, waits that many milliseconds after the first event to
+        gather any further events. Same semantics as INotify.read.
+        """
+        deadline = None if timeout is None else self.clock() + timeout / 1000
+        while True:
+            events = self.poll()
+            if events:
+                if read_delay:
+                    self.sleep(read_delay / 1000)
+                    events.extend(self.poll())
+                return events
+
+            if deadline is None:
+                self.sleep(self.interval)
+            else:
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    return []
+                self.sleep(min(self.interval, remaining))
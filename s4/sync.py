@@ -1,16 +1,32 @@
 # -*- coding: utf-8 -*-
 
+import hashlib
 import logging
 import os
+import queue
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
+from collections import defaultdict
 
 from clint.textui import colored
 
 import tqdm
 
-from s4.clients import SyncState
+from s4 import transfer
+from s4 import utils
+from s4.clients import SyncState, cache
+
+
+# states in which a client holds a copy of the contents of a key
+CONTENT_STATES = (SyncState.CREATED, SyncState.UPDATED, SyncState.NOCHANGES, SyncState.CONFLICT)
+
+# methods of SyncWorker which deferred calls stored in a journal may refer to
+JOURNALED_CALLS = (
+    'create_client', 'update_client', 'delete_client', 'rename_client', 'touch_client',
+)
 
 
 class DeferredFunction(object):
@@ -83,19 +99,115 @@ def show_diff(client_1, client_2, key):
 
 
 class SyncWorker(object):
-    def __init__(self, client_1, client_2):
+    FINGERPRINTS_FILE_NAME = 'fingerprints'
+    JOBS_FILE_NAME = 'jobs'
+    JOURNALS_FOLDER_NAME = 'journals'
+    # the index is checkpointed after this many completed deferred calls at the latest
+    CHECKPOINT_KEYS = 1000
+    # transfers of at least this many bytes only get large_jobs of the jobs
+    DEFAULT_LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+    def __init__(
+        self, client_1, client_2, fast_path=False, verify_hashes=False, detect_renames=False,
+        hash_workers=4, jobs=1, max_jobs=None, max_attempts=5, scheduling='alphabetical',
+        large_file_size=DEFAULT_LARGE_FILE_SIZE, large_jobs=1, pipeline=False,
+        checkpoint_interval=60, show_progress=True,
+    ):
         self.client_1 = client_1
         self.client_2 = client_2
+        self.fast_path = fast_path
+        self.verify_hashes = verify_hashes
+        self.detect_renames = detect_renames
+        self.hash_workers = hash_workers
+        # number of deferred calls run at the same time, tuned up to max_jobs if set
+        self.jobs = jobs
+        self.max_jobs = max_jobs
+        self.max_attempts = max_attempts
+        # order in which deferred calls are run, see transfer.SCHEDULING_POLICIES
+        transfer.get_scheduling_policy(scheduling)
+        self.scheduling = scheduling
+        self.large_file_size = large_file_size
+        self.large_jobs = large_jobs
+        # start transfers while the rest of the sync is still being planned
+        self.pipeline = pipeline
+        # seconds between checkpoints of the indexes while deferred calls run
+        self.checkpoint_interval = checkpoint_interval
+        # progress bars of concurrent syncs would overwrite each other
+        self.show_progress = show_progress
+        # journal of the running sync session, if any
+        self.journal = None
+        self._checkpoint_keys = []
+        self._checkpointed_at = time.monotonic()
         self.logger = logging.getLogger(str(self))
 
     def __repr__(self):
         return 'SyncWorker<{}, {}>'.format(self.client_1.get_uri(), self.client_2.get_uri())
 
+    def get_fingerprints(self):
+        return [self.client_1.get_fingerprint(), self.client_2.get_fingerprint()]
+
+    def get_synced_fingerprints(self):
+        return [self.client_1.get_synced_fingerprint(), self.client_2.get_synced_fingerprint()]
+
+    def load_fingerprints(self):
+        path = utils.get_state_path(self.FINGERPRINTS_FILE_NAME)
+        return cache.read_json(path, default={}).get(repr(self))
+
+    def save_fingerprints(self, fingerprints):
+        path = utils.get_state_path(self.FINGERPRINTS_FILE_NAME)
+        with cache.get_state_lock(path):
+            data = cache.read_json(path, default={})
+            if fingerprints is None:
+                data.pop(repr(self), None)
+            else:
+                data[repr(self)] = fingerprints
+            cache.write_json(path, data)
+
+    def is_unchanged(self):
+        """
+        Cheap check whether anything could have changed on either client since the
+        last complete sync, based on the fingerprints stored after that sync.
+        """
+        previous = self.load_fingerprints()
+        if previous is None:
+            self.logger.debug('Fast path: no fingerprints stored from a previous sync')
+            return False
+
+        current = self.get_fingerprints()
+        for client, before, now in zip((self.client_1, self.client_2), previous, current):
+            if now is None:
+                self.logger.debug('Fast path: %s does not support fingerprints', client)
+                return False
+            elif before != now:
+                self.logger.debug('Fast path: %s changed (%s => %s)', client, before, now)
+                return False
+
+        self.logger.debug('Fast path: fingerprints unchanged since last sync %s', current)
+        return True
+
     def sync(self, conflict_choice=None, keys=None):
+        use_fast_path = self.fast_path and keys is None
+        journal = self.get_journal()
+        if use_fast_path and not journal.exists() and self.is_unchanged():
+            self.logger.info('Nothing to update')
+            return
+
         self.client_1.lock()
         self.client_2.lock()
+        completed = False
+        self.journal = journal
         try:
-            deferred_calls, unhandled_events = self.get_sync_states(keys)
+            if self.resume() and keys is None:
+                # the interrupted session already planned a full sync
+                return
+
+            self.journal.start([{'started': time.time(), 'full': keys is None}])
+            self._checkpointed_at = time.monotonic()
+            if self.pipeline:
+                deferred_calls, unhandled_events, early, early_success = self.run_pipelined(keys)
+            else:
+                deferred_calls, unhandled_events = self.get_sync_states(keys)
+                early, early_success = {}, []
 
             self.logger.debug(
                 'There are %s unhandled events for the user to solve', len(unhandled_events)
@@ -144,15 +256,106 @@ class SyncWorker(object):
                         self.logger.info('Ignoring sync conflict for %s', key)
                         continue
 
-            self.run_deferred_calls(deferred_calls)
+            remaining = {
+                key: deferred_function
+                for key, deferred_function in deferred_calls.items() if key not in early
+            }
+            for key in sorted(remaining):
+                self.journal.append({'plan': key, 'call': self.dump_call(remaining[key])})
+            self.journal.append({'planned': True})
+            self.journal.sync()
+
+            success = early_success + self.run_deferred_calls(
+                remaining, flush=len(deferred_calls) > 0,
+            )
+            completed = (
+                len(success) == len(deferred_calls) and
+                set(unhandled_events) <= set(deferred_calls)
+            )
 
         except KeyboardInterrupt:
             self.logger.warning('Session interrupted by Keyboard Interrupt. Aborting....')
         finally:
+            self.journal.close()
+            self.journal = None
+            self._checkpoint_keys = []
             self.client_1.unlock()
             self.client_2.unlock()
 
-    def get_sync_states(self, keys=None):
+        if use_fast_path:
+            # Anything left unsynced must be looked at again on the next run
+            # fingerprints taken now would hide changes made while the sync ran
+            self.save_fingerprints(self.get_synced_fingerprints() if completed else None)
+
+    def run_pipelined(self, keys=None):
+        """
+        Plans the sync in a background thread while the deferred calls which nothing
+        planned later can change are already being run. Returns the results of
+        get_sync_states, the deferred calls which were run and the keys which succeeded.
+        """
+        feed = queue.Queue()
+        early = {}
+        large_keys = set()
+        concurrent = self.jobs > 1 or self.max_jobs is not None
+        result = {}
+
+        def emit(key, deferred_function):
+            early[key] = deferred_function
+            if self.journal is not None:
+                self.journal.append({'plan': key, 'call': self.dump_call(deferred_function)})
+            if concurrent:
+                item = self.get_transfer_item(key, deferred_function)
+                if (item.size or 0) >= self.large_file_size:
+                    large_keys.add(key)
+            feed.put(key)
+
+        log_context = utils.get_log_context()
+
+        def plan():
+            try:
+                with utils.log_context(log_context):
+                    result['states'] = self.get_sync_states(keys, emit=emit)
+            except BaseException as e:
+                result['error'] = e
+            finally:
+                feed.put(None)
+
+        planner = threading.Thread(target=plan, name='{} planner'.format(self), daemon=True)
+        planner.start()
+        success = []
+        try:
+            self.execute_deferred_calls(early, [], large_keys, success, feed=feed)
+        except KeyboardInterrupt:
+            # keep the index entries of everything transferred so far
+            self.flush_indexes()
+            raise
+        planner.join()
+
+        if 'error' in result:
+            raise result['error']
+        deferred_calls, unhandled_events = result['states']
+        self.logger.debug('Ran %s deferred calls while planning', len(early))
+        return deferred_calls, unhandled_events, early, success
+
+    def is_final(self, key, deferred_function, comparable):
+        """
+        Returns whether the deferred call planned for key can not be replaced by the
+        passes which run once every key has been looked at.
+        """
+        if self.verify_hashes and key in comparable:
+            return False
+        if self.detect_renames and deferred_function.func in (
+            self.create_client, self.delete_client,
+        ):
+            return False
+        return True
+
+    def get_sync_states(self, keys=None, emit=None):
+        """
+        Returns the deferred calls and the unhandled events of each key. Deferred calls
+        which are final are also passed to `emit(key, deferred_function)` as soon as
+        they are planned.
+        """
         # we store a list of deferred calls to make sure we can handle everything before
         # running any updates on the file system and indexes
         deferred_calls = {}
@@ -161,9 +364,18 @@ class SyncWorker(object):
         # the automated solution has not yet been implemented)
         unhandled_events = {}
 
+        # states of keys where both clients have a copy whose contents may be identical
+        comparable = {}
+
+        # with emit the keys are planned while the clients are still being listed
+        states = self.get_states(keys) if emit is None else self.iter_states(keys)
+
         self.logger.debug('Generating deferred calls based on client states')
-        for key, state_1, state_2 in self.get_states(keys):
+        for key, state_1, state_2 in states:
             self.logger.debug('%s: %s %s', key, state_1, state_2)
+            if state_1.state in CONTENT_STATES and state_2.state in CONTENT_STATES:
+                comparable[key] = (state_1, state_2)
+
             if state_1.state == SyncState.NOCHANGES and state_2.state == SyncState.NOCHANGES:
                 if state_1.remote_timestamp == state_2.remote_timestamp:
                     continue
@@ -272,38 +484,400 @@ class SyncWorker(object):
                 unhandled_events[key] = (state_1, state_2)
 
             self.logger.debug('Action=%s', deferred_calls.get(key))
+            if (
+                emit is not None and key in deferred_calls and
+                self.is_final(key, deferred_calls[key], comparable)
+            ):
+                emit(key, deferred_calls[key])
+
+        if self.verify_hashes:
+            self.skip_unchanged_contents(comparable, deferred_calls, unhandled_events)
+
+        if self.detect_renames:
+            self.pair_renames(deferred_calls)
 
         return deferred_calls, unhandled_events
 
-    def run_deferred_calls(self, deferred_calls):
+    def pair_renames(self, deferred_calls):
+        """
+        Pairs up the deletion of a key with the creation of another key with the same
+        contents on the same client, and replaces both with a single rename. Sizes are
+        compared first and only keys with matching sizes are hashed.
+        """
+        deleted = defaultdict(lambda: defaultdict(list))
+        created = []
+        for key, deferred_function in sorted(deferred_calls.items()):
+            if deferred_function.func == self.delete_client:
+                client = deferred_function.args[0]
+                size = client.get_size(key)
+                if size:
+                    deleted[client][size].append(key)
+            elif deferred_function.func == self.create_client:
+                created.append(key)
+
+        candidates = []
+        for key in created:
+            to_client, from_client, _, _ = deferred_calls[key].args
+            size = from_client.get_size(key) if to_client in deleted else None
+            if size and size in deleted[to_client]:
+                candidates.append((key, to_client, from_client, deleted[to_client][size]))
+
+        if not candidates:
+            return
+
+        def get_hashes(candidate):
+            key, to_client, from_client, old_keys = candidate
+            return (
+                from_client.get_hash(key),
+                [to_client.get_hash(old_key) for old_key in old_keys],
+            )
+
+        self.logger.debug('Comparing contents of %s possibly renamed keys', len(candidates))
+        with utils.ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+            results = list(executor.map(get_hashes, candidates))
+
+        for (key, to_client, from_client, old_keys), (new_hash, old_hashes) in zip(
+            candidates, results
+        ):
+            if new_hash is None:
+                continue
+            for old_key, old_hash in zip(old_keys, old_hashes):
+                if old_hash == new_hash and old_key in deferred_calls:
+                    _, _, _, timestamp = deferred_calls[key].args
+                    _, _, old_remote_timestamp = deferred_calls.pop(old_key).args
+                    deferred_calls[key] = DeferredFunction(
+                        self.rename_client, to_client, from_client,
+                        old_key, key, timestamp, old_remote_timestamp,
+                    )
+                    self.logger.debug('Detected rename of %s to %s', old_key, key)
+                    break
+
+    def has_same_contents(self, key):
+        size_1 = self.client_1.get_size(key)
+        size_2 = self.client_2.get_size(key)
+        if size_1 is None or size_1 != size_2:
+            return False
+
+        hash_1 = self.client_1.get_hash(key)
+        if hash_1 is None:
+            return False
+        return hash_1 == self.client_2.get_hash(key)
+
+    def skip_unchanged_contents(self, comparable, deferred_calls, unhandled_events):
+        """
+        Replaces transfers (and conflicts) of keys whose contents are identical on both
+        clients with a metadata only update of the index. Sizes are compared first
+        and contents are only hashed if they match.
+        """
+        candidates = sorted(
+            key for key in comparable
+            if key in unhandled_events or (
+                key in deferred_calls and
+                deferred_calls[key].func in (self.update_client, self.create_client)
+            )
+        )
+        if not candidates:
+            return
+
+        self.logger.debug('Comparing the contents of %s keys', len(candidates))
+        with utils.ThreadPoolExecutor(max_workers=self.hash_workers) as executor:
+            results = executor.map(self.has_same_contents, candidates)
+
+            for key, same_contents in zip(candidates, results):
+                if not same_contents:
+                    continue
+
+                state_1, state_2 = comparable[key]
+                if key in deferred_calls:
+                    to_client, from_client, _, timestamp = deferred_calls[key].args
+                elif state_1.local_timestamp >= state_2.local_timestamp:
+                    to_client, from_client = self.client_2, self.client_1
+                    timestamp = state_1.local_timestamp
+                else:
+                    to_client, from_client = self.client_1, self.client_2
+                    timestamp = state_2.local_timestamp
+
+                unhandled_events.pop(key, None)
+                deferred_calls[key] = DeferredFunction(
+                    self.touch_client, to_client, from_client, key, timestamp
+                )
+
+    def get_journal(self):
+        name = hashlib.md5(repr(self).encode('utf-8')).hexdigest()
+        return cache.Journal(
+            utils.get_state_path(os.path.join(self.JOURNALS_FOLDER_NAME, name))
+        )
+
+    def dump_call(self, deferred_function):
+        """
+        Returns a json serialisable description of a deferred call of this worker.
+        """
+        args = []
+        for arg in deferred_function.args:
+            if arg is self.client_1:
+                arg = {'client': 1}
+            elif arg is self.client_2:
+                arg = {'client': 2}
+            args.append(arg)
+        return {'func': deferred_function.func.__name__, 'args': args}
+
+    def load_call(self, data):
+        if data['func'] not in JOURNALED_CALLS:
+            raise ValueError('Unknown deferred call', data['func'])
+        clients = {1: self.client_1, 2: self.client_2}
+        args = [
+            clients[arg['client']] if isinstance(arg, dict) else arg for arg in data['args']
+        ]
+        return DeferredFunction(getattr(self, data['func']), *args)
+
+    def resume(self):
+        """
+        Runs the deferred calls which an interrupted session journaled but did not
+        complete, without planning anything again. Returns whether that session had
+        finished planning a full sync, in which case nothing is left to do.
+        """
+        planned = {}
+        done = set()
+        full = complete = False
+        for record in self.journal.read():
+            if 'started' in record:
+                full = record['full']
+            elif 'plan' in record:
+                planned[record['plan']] = record['call']
+            elif 'done' in record:
+                done.add(record['done'])
+            elif record.get('planned'):
+                complete = True
+
+        if not planned:
+            return False
+
+        deferred_calls = {}
+        for key, data in sorted(planned.items()):
+            if key in done:
+                continue
+            try:
+                deferred_function = self.load_call(data)
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                self.logger.warning('Ignoring unreadable journal entry for %s: %s', key, e)
+                continue
+
+            if not self.is_resumable(key, deferred_function):
+                # planning again is the only safe way to find out what should happen
+                self.logger.warning('%s changed since the interrupted sync, skipping it', key)
+                complete = False
+                continue
+            deferred_calls[key] = deferred_function
+
+        self.logger.info(
+            'Resuming interrupted sync, %s of %s deferred calls left',
+            len(deferred_calls), len(planned),
+        )
+        records = [{'started': time.time(), 'full': full}]
+        records.extend(
+            {'plan': key, 'call': self.dump_call(deferred_function)}
+            for key, deferred_function in sorted(deferred_calls.items())
+        )
+        if complete:
+            records.append({'planned': True})
+        self.journal.start(records)
+        self._checkpointed_at = time.monotonic()
+
+        success = []
+        try:
+            keys, large_keys = self.get_transfer_order(deferred_calls)
+            self.execute_deferred_calls(deferred_calls, keys, large_keys, success)
+        finally:
+            self.flush_indexes()
+        self.journal.remove()
+        return full and complete
+
+    def is_resumable(self, key, deferred_function):
+        """
+        Returns whether every client touched by a journaled deferred call is still in
+        the state the call was planned against, i.e. nothing changed on either side
+        since the interrupted sync listed them.
+        """
+        func = deferred_function.func
+        if func in (self.create_client, self.update_client):
+            to_client, from_client, _, timestamp = deferred_function.args
+            real_timestamp = from_client.get_real_local_timestamp(key)
+            # planned timestamps are whole seconds, see get_sync_state
+            if real_timestamp is None or int(real_timestamp) != timestamp:
+                return False
+            if func == self.create_client:
+                return to_client.get_real_local_timestamp(key) is None
+            return is_unchanged(to_client, key)
+        elif func == self.delete_client:
+            client, _, _ = deferred_function.args
+            return is_unchanged(client, key)
+        elif func == self.rename_client:
+            to_client, from_client, old_key, _, timestamp, _ = deferred_function.args
+            real_timestamp = from_client.get_real_local_timestamp(key)
+            return (
+                real_timestamp is not None and int(real_timestamp) == timestamp and
+                from_client.get_real_local_timestamp(old_key) is None and
+                to_client.get_real_local_timestamp(key) is None and
+                is_unchanged(to_client, old_key)
+            )
+        elif func == self.touch_client:
+            # the index of both sides is only updated because their contents are the same
+            return self.has_same_contents(key)
+        return False
+
+    def checkpoint(self, key):
+        """
+        Records that the deferred call of key completed. Every checkpoint_interval
+        seconds (or CHECKPOINT_KEYS keys) the indexes are flushed and only then are the
+        keys marked as done in the journal, so a crash never loses more than that and a
+        key which is done always has its index entries stored.
+        """
+        self._checkpoint_keys.append(key)
+        elapsed = time.monotonic() - self._checkpointed_at
+        if (
+            len(self._checkpoint_keys) >= self.CHECKPOINT_KEYS or
+            elapsed >= self.checkpoint_interval
+        ):
+            self.logger.debug(
+                'Checkpointing indexes after %s deferred calls', len(self._checkpoint_keys)
+            )
+            self.client_1.flush_index()
+            self.client_2.flush_index()
+            self.commit_journal()
+
+    def commit_journal(self):
+        if self.journal is not None and self._checkpoint_keys:
+            for key in self._checkpoint_keys:
+                self.journal.append({'done': key})
+            self.journal.sync()
+        self._checkpoint_keys = []
+        self._checkpointed_at = time.monotonic()
+
+    def load_jobs(self):
+        path = utils.get_state_path(self.JOBS_FILE_NAME)
+        return cache.read_json(path, default={}).get(repr(self))
+
+    def save_jobs(self, jobs):
+        path = utils.get_state_path(self.JOBS_FILE_NAME)
+        with cache.get_state_lock(path):
+            data = cache.read_json(path, default={})
+            data[repr(self)] = jobs
+            cache.write_json(path, data)
+
+    def get_executor(self):
+        tuner = None
+        if self.max_jobs is not None:
+            # start from the number of jobs the previous sync of this target settled on
+            tuner = transfer.ConcurrencyTuner(self.jobs, self.max_jobs, jobs=self.load_jobs())
+        return transfer.TransferExecutor(
+            jobs=self.jobs, max_attempts=self.max_attempts, tuner=tuner,
+            large_jobs=self.large_jobs,
+        )
+
+    def get_transfer_item(self, key, deferred_function):
+        func = deferred_function.func
+        if func in (self.create_client, self.update_client):
+            _, from_client, _, timestamp = deferred_function.args
+            return transfer.TransferItem(key, from_client.get_size(key), timestamp)
+        elif func in (self.delete_client, self.touch_client):
+            return transfer.TransferItem(key, 0, deferred_function.args[-1])
+        elif func == self.rename_client:
+            return transfer.TransferItem(key, 0, deferred_function.args[4])
+        return transfer.TransferItem(key, 0, None)
+
+    def get_transfer_order(self, deferred_calls):
+        """
+        Returns the keys of deferred_calls in the order they should be run and the keys
+        of the large transfers which should not hold up the others.
+        """
+        concurrent = self.jobs > 1 or self.max_jobs is not None
+        if self.scheduling == 'alphabetical' and not concurrent:
+            # nothing to look up
+            return sorted(deferred_calls), set()
+
+        items = [
+            self.get_transfer_item(key, deferred_function)
+            for key, deferred_function in deferred_calls.items()
+        ]
+        items.sort(key=transfer.get_scheduling_policy(self.scheduling))
+
+        large_keys = set()
+        if concurrent:
+            large_keys = {
+                item.key for item in items if (item.size or 0) >= self.large_file_size
+            }
+        return [item.key for item in items], large_keys
+
+    def execute_deferred_calls(self, deferred_calls, keys, large_keys, success, feed=None):
+        """
+        Runs deferred calls for keys (and those fed later), appending the keys which
+        succeeded to success as they do.
+        """
+        def run(key):
+            return deferred_calls[key]()
+
+        def on_success(key):
+            self.client_1.update_index_entry(key)
+            self.client_2.update_index_entry(key)
+            success.append(key)
+            if self.journal is not None:
+                self.checkpoint(key)
+
+        def on_error(key, e):
+            self.logger.error('An error occurred while trying to update %s: %s', key, e)
+
+        executor = self.get_executor()
+        try:
+            executor.run(
+                keys, run, on_success=on_success, on_error=on_error, large_keys=large_keys,
+                feed=feed,
+            )
+        finally:
+            if executor.tuner is not None and (deferred_calls or keys):
+                self.save_jobs(executor.tuner.jobs)
+
+    def flush_indexes(self):
+        self.logger.info('Flushing Index to Storage')
+        self.client_1.flush_index()
+        self.client_2.flush_index()
+        self.commit_journal()
+
+    def run_deferred_calls(self, deferred_calls, flush=None):
         # call everything once we know we can handle all of it
         self.logger.debug('There are %s total deferred calls', len(deferred_calls))
         success = []
+        interrupted = False
         try:
-            for key in sorted(deferred_calls.keys()):
-                deferred_function = deferred_calls[key]
-                try:
-                    deferred_function()
-                    self.client_1.update_index_entry(key)
-                    self.client_2.update_index_entry(key)
-                    success.append(key)
-                except Exception as e:
-                    self.logger.error('An error occurred while trying to update %s: %s', key, e)
+            keys, large_keys = self.get_transfer_order(deferred_calls)
+            self.execute_deferred_calls(deferred_calls, keys, large_keys, success)
         except KeyboardInterrupt:
             self.logger.warning('Session interrupted by Keyboard Interrupt. Cleaning up....')
+            interrupted = True
 
-        if len(deferred_calls) > 0:
-            self.logger.info('Flushing Index to Storage')
-            self.client_1.flush_index()
-            self.client_2.flush_index()
+        if flush is None:
+            flush = len(deferred_calls) > 0
+        if flush:
+            self.flush_indexes()
         else:
             self.logger.info('Nothing to update')
 
+        if self.journal is not None and not interrupted:
+            # failed calls are planned again by the next sync
+            self.journal.remove()
         return success
 
     def get_states(self, keys=None):
-        client_1_actions = self.client_1.get_all_actions()
-        client_2_actions = self.client_2.get_all_actions()
+        # scan both clients at the same time, e.g. walk the local folder while S3 lists
+        with utils.ThreadPoolExecutor(max_workers=2) as executor:
+            if keys is None:
+                future_1 = executor.submit(self.client_1.get_all_actions)
+                future_2 = executor.submit(self.client_2.get_all_actions)
+            else:
+                # only look up the requested keys instead of scanning both clients
+                future_1 = executor.submit(self.client_1.get_actions, keys)
+                future_2 = executor.submit(self.client_2.get_actions, keys)
+            client_1_actions = future_1.result()
+            client_2_actions = future_2.result()
 
         all_keys = set(client_1_actions) | set(client_2_actions)
         self.logger.debug(
@@ -312,10 +886,7 @@ class SyncWorker(object):
             len(client_1_actions), self.client_1.get_uri(),
             len(client_2_actions), self.client_2.get_uri()
         )
-        if keys is None:
-            target_keys = sorted(all_keys)
-        else:
-            target_keys = keys
+        target_keys = sorted(all_keys)
 
         DOES_NOT_EXIST = SyncState(SyncState.DOESNOTEXIST, None, None)
         for key in target_keys:
@@ -323,6 +894,64 @@ class SyncWorker(object):
             action_2 = client_2_actions.get(key, DOES_NOT_EXIST)
             yield key, action_1, action_2
 
+    def iter_states(self, keys=None):
+        """
+        Yields the same states as get_states while both clients are still being listed,
+        each key as soon as both clients have either listed it or finished listing. Keys
+        are not yielded in any particular order.
+        """
+        if keys is not None:
+            for item in self.get_states(keys):
+                yield item
+            return
+
+        events = queue.Queue()
+
+        def scan(side, client):
+            # the end of each listing is marked with None, or the error it failed with
+            try:
+                for key, action in client.iter_actions():
+                    events.put((side, key, action))
+            except BaseException as e:
+                events.put((side, None, e))
+            else:
+                events.put((side, None, None))
+
+        DOES_NOT_EXIST = SyncState(SyncState.DOESNOTEXIST, None, None)
+        actions = ({}, {})
+        done = [False, False]
+        yielded = set()
+        with utils.ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(scan, 0, self.client_1)
+            executor.submit(scan, 1, self.client_2)
+
+            while not all(done):
+                side, key, action = events.get()
+                other = 1 - side
+                if key is None:
+                    if action is not None:
+                        raise action
+                    done[side] = True
+                    ready = [key for key in actions[other] if key not in yielded]
+                else:
+                    actions[side][key] = action
+                    ready = [key] if key in actions[other] or done[other] else []
+
+                for key in ready:
+                    yielded.add(key)
+                    yield (
+                        key,
+                        actions[0].get(key, DOES_NOT_EXIST),
+                        actions[1].get(key, DOES_NOT_EXIST),
+                    )
+
+        self.logger.debug(
+            '%s keys in total (%s for %s and %s for %s)',
+            len(yielded),
+            len(actions[0]), self.client_1.get_uri(),
+            len(actions[1]), self.client_2.get_uri()
+        )
+
     def get_deferred_function(self, key, action, to_client, from_client):
         if action.state in (SyncState.UPDATED, SyncState.NOCHANGES):
             return DeferredFunction(
@@ -342,23 +971,59 @@ class SyncWorker(object):
             colored.green('Creating %s (%s => %s)'),
             key, from_client.get_uri(), to_client.get_uri()
         )
-        self.move(to_client, from_client, key, timestamp)
+        return self.move(to_client, from_client, key, timestamp)
 
     def update_client(self, to_client, from_client, key, timestamp):
         self.logger.info(
             colored.yellow('Updating %s (%s => %s)'),
             key, from_client.get_uri(), to_client.get_uri()
         )
-        self.move(to_client, from_client, key, timestamp)
+        return self.move(to_client, from_client, key, timestamp)
 
-    def move(self, to_client, from_client, key, timestamp):
-        sync_object = from_client.get(key)
+    def rename_client(
+        self, to_client, from_client, old_key, key, timestamp, old_remote_timestamp
+    ):
+        self.logger.info(
+            colored.green('Renaming %s to %s on %s'),
+            old_key, key, to_client.get_uri()
+        )
+        to_client.rename(old_key, key)
+        to_client.set_remote_timestamp(key, timestamp)
+        from_client.set_remote_timestamp(key, timestamp)
 
-        with get_progress_bar(sync_object.total_size) as progress_bar:
-            to_client.put(key, sync_object, callback=progress_bar.update)
+        # the old key has now been deleted on both clients
+        to_client.set_remote_timestamp(old_key, old_remote_timestamp)
+        to_client.update_index_entry(old_key)
+        from_client.update_index_entry(old_key)
+
+    def touch_client(self, to_client, from_client, key, timestamp):
+        self.logger.info(
+            'Contents of %s unchanged, updating index only (%s => %s)',
+            key, from_client.get_uri(), to_client.get_uri()
+        )
+        to_client.set_remote_timestamp(key, timestamp)
+        from_client.set_remote_timestamp(key, timestamp)
+
+    def move(self, to_client, from_client, key, timestamp):
+        """
+        Returns the number of bytes which passed through this host.
+        """
+        size = 0
+        # e.g. between two S3 targets the contents never have to pass through this host
+        if not to_client.copy_from(from_client, key):
+            sync_object = from_client.get(key)
+            try:
+                with get_progress_bar(
+                    sync_object.total_size, disable=not self.show_progress,
+                ) as progress_bar:
+                    to_client.put(key, sync_object, callback=progress_bar.update)
+            finally:
+                sync_object.close()
+            size = sync_object.total_size
 
         to_client.set_remote_timestamp(key, timestamp)
         from_client.set_remote_timestamp(key, timestamp)
+        return size
 
     def delete_client(self, client, key, remote_timestamp):
         self.logger.info(
@@ -369,9 +1034,21 @@ class SyncWorker(object):
         client.set_remote_timestamp(key, remote_timestamp)
 
 
-def get_progress_bar(max_value):
+def is_unchanged(client, key):
+    """
+    Returns whether key still exists on client with the timestamp stored in its index.
+    """
+    real_timestamp = client.get_real_local_timestamp(key)
+    index_timestamp = client.get_index_local_timestamp(key)
+    if real_timestamp is None or index_timestamp is None:
+        return False
+    return int(real_timestamp) == int(index_timestamp)
+
+
+def get_progress_bar(max_value, disable=False):
     return tqdm.tqdm(
         total=max_value,
+        disable=disable,
         leave=False,
         ncols=80,
         unit='B',
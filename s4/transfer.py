@@ -0,0 +1,821 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import datetime
+import heapq
+import logging
+import math
+import queue as queue_module
+import random
+import threading
+import time
+from concurrent import futures
+
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+
+from s4 import utils
+
+
+logger = logging.getLogger(__name__)
+
+
+MB = 1024 * 1024
+
+# Defaults of boto3.s3.transfer.TransferConfig
+DEFAULT_MULTIPART_THRESHOLD = 8 * MB
+DEFAULT_MULTIPART_CHUNKSIZE = 8 * MB
+DEFAULT_MAX_CONCURRENCY = 10
+
+TRANSFER_OPTIONS = ('multipart_threshold', 'multipart_chunksize', 'max_concurrency')
+
+# error codes S3 uses to ask clients to slow down
+THROTTLING_ERROR_CODES = (
+    'SlowDown', 'ServiceUnavailable', 'Throttling', 'ThrottlingException',
+    'RequestLimitExceeded', 'TooManyRequests', '503',
+)
+TRANSIENT_ERROR_CODES = ('InternalError', 'RequestTimeout', '500')
+
+Sample = collections.namedtuple('Sample', ['size', 'seconds', 'concurrency'])
+TransferItem = collections.namedtuple('TransferItem', ['key', 'size', 'timestamp'])
+
+
+class TransferTuner(object):
+    """
+    Picks the multipart chunk size and concurrency of each transfer from its size and
+    the throughput of recent transfers.
+
+    Each part should take about `part_seconds` to send over a single connection: long
+    enough to amortise the cost of a request, short enough that a failed part is cheap
+    to retry. Files are split into at least as many parts as there are connections, so
+    that mid sized files still use all of them.
+    """
+    MIN_CHUNKSIZE = 5 * MB
+    MAX_CHUNKSIZE = 512 * MB
+    MAX_PARTS = 10000
+
+    def __init__(
+        self, max_concurrency=DEFAULT_MAX_CONCURRENCY, part_seconds=5, history=20,
+        min_sample_size=MB, clock=None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.part_seconds = part_seconds
+        self.min_sample_size = min_sample_size
+        self.clock = clock or time.monotonic
+        self._samples = collections.deque(maxlen=history)
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'TransferTuner<max_concurrency={}>'.format(self.max_concurrency)
+
+    def record(self, size, seconds, concurrency=1):
+        # tiny transfers are dominated by latency and say nothing about bandwidth
+        if size < self.min_sample_size or seconds <= 0:
+            return
+        with self._lock:
+            self._samples.append(Sample(size, seconds, max(1, concurrency)))
+
+    def get_stream_throughput(self):
+        """
+        Returns the recently observed bytes per second of a single connection or None
+        if nothing has been transferred yet.
+        """
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return None
+        total_size = sum(sample.size / sample.concurrency for sample in samples)
+        total_seconds = sum(sample.seconds for sample in samples)
+        return total_size / total_seconds
+
+    def get_options(self, size):
+        """
+        Returns the TransferConfig options to use for a transfer of `size` bytes.
+        """
+        throughput = self.get_stream_throughput()
+        if throughput is None:
+            chunksize = DEFAULT_MULTIPART_CHUNKSIZE
+        else:
+            chunksize = int(throughput * self.part_seconds)
+
+        # use every connection, but never more parts than S3 allows
+        chunksize = min(chunksize, -(-size // self.max_concurrency))
+        chunksize = max(chunksize, -(-size // self.MAX_PARTS), self.MIN_CHUNKSIZE)
+        chunksize = min(chunksize, self.MAX_CHUNKSIZE)
+
+        parts = -(-size // chunksize)
+        return {
+            'multipart_threshold': chunksize,
+            'multipart_chunksize': chunksize,
+            'max_concurrency': max(1, min(self.max_concurrency, parts)),
+        }
+
+
+class TransferTimer(object):
+    """
+    Context manager which records the duration of a transfer with a TransferTuner.
+    """
+    def __init__(self, tuner, size, concurrency=1):
+        self.tuner = tuner
+        self.size = size
+        self.concurrency = concurrency
+        self.start = None
+
+    def __enter__(self):
+        if self.tuner is not None:
+            self.start = self.tuner.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.tuner is not None and exc_type is None:
+            self.tuner.record(self.size, self.tuner.clock() - self.start, self.concurrency)
+
+
+_tuners = {}
+_tuners_lock = threading.Lock()
+
+
+def get_tuner(name, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+    """
+    Returns the TransferTuner of a target, so its history outlives the clients created
+    for each sync.
+    """
+    with _tuners_lock:
+        tuner = _tuners.get(name)
+        if tuner is None or tuner.max_concurrency != max_concurrency:
+            tuner = _tuners[name] = TransferTuner(max_concurrency=max_concurrency)
+        return tuner
+
+
+def get_error_code(error):
+    if not isinstance(error, ClientError):
+        return None
+    return error.response.get('Error', {}).get('Code')
+
+
+def is_throttling_error(error):
+    if not isinstance(error, ClientError):
+        return False
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return get_error_code(error) in THROTTLING_ERROR_CODES or status in (429, 503)
+
+
+def is_retryable_error(error):
+    return (
+        is_throttling_error(error) or
+        get_error_code(error) in TRANSIENT_ERROR_CODES or
+        isinstance(error, (ConnectionError, HTTPClientError))
+    )
+
+
+class RateController(object):
+    """
+    Additive increase, multiplicative decrease (AIMD) of the number of transfers in
+    flight and of the rate at which new ones are started.
+
+    Every successful transfer raises the concurrency by `increase` per window of
+    `concurrency` transfers and the rate by `increase` calls per second every second.
+    A throttled transfer multiplies both by `decrease`. Transfers which were started
+    before the last decrease can not lower them again, so a burst of errors caused by
+    the same overload only counts once. The rate is unlimited until the first throttle.
+
+    Only the thread scheduling the transfers may use a controller.
+    """
+    def __init__(
+        self, max_concurrency=1, min_concurrency=1, increase=1, decrease=0.5,
+        min_rate=1, clock=None, sleep=None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.increase = increase
+        self.decrease = decrease
+        self.min_rate = min_rate
+        self.clock = clock or time.monotonic
+        self.sleep = sleep or time.sleep
+
+        self.concurrency = float(max_concurrency)
+        self.rate = None
+        self.last_decrease = None
+        self._next_start = None
+        self._starts = collections.deque(maxlen=50)
+
+    def __repr__(self):
+        return 'RateController<concurrency={:.1f}, rate={}>'.format(self.concurrency, self.rate)
+
+    @property
+    def limit(self):
+        return max(self.min_concurrency, int(self.concurrency))
+
+    def get_start_rate(self):
+        if len(self._starts) < 2:
+            return None
+        seconds = self._starts[-1] - self._starts[0]
+        if seconds <= 0:
+            return None
+        return (len(self._starts) - 1) / seconds
+
+    def acquire(self):
+        """
+        Waits until the current rate allows another transfer to start and returns the
+        time at which it started, to be passed back to `release`.
+        """
+        now = self.clock()
+        if self.rate is not None and self._next_start is not None and now < self._next_start:
+            self.sleep(self._next_start - now)
+            now = self.clock()
+        if self.rate is not None:
+            self._next_start = now + 1 / self.rate
+        self._starts.append(now)
+        return now
+
+    def release(self, started_at, throttled=False):
+        if throttled:
+            self.on_throttle(started_at)
+        else:
+            self.on_success()
+
+    def on_success(self):
+        self.concurrency = min(
+            self.max_concurrency, self.concurrency + self.increase / self.concurrency,
+        )
+        if self.rate is not None:
+            self.rate += self.increase / self.rate
+
+    def on_throttle(self, started_at):
+        if self.last_decrease is not None and started_at < self.last_decrease:
+            return
+
+        self.last_decrease = self.clock()
+        self.concurrency = max(self.min_concurrency, self.concurrency * self.decrease)
+        rate = self.rate if self.rate is not None else self.get_start_rate()
+        self.rate = max(self.min_rate, (rate or self.min_rate) * self.decrease)
+        logger.debug('Throttled, slowing down to %s', self)
+
+
+class ConcurrencyTuner(object):
+    """
+    Hill climbs the number of transfers in flight between `min_jobs` and `max_jobs`.
+
+    The throughput (bytes per second, or transfers per second when nothing but
+    metadata was transferred) and the mean latency of the transfers completed in
+    each `interval` are compared with the previous interval. The number of jobs keeps
+    moving by `step` in the same direction while the throughput improves by more than
+    `tolerance` and turns around when it gets worse. When the throughput is flat but
+    transfers take longer than before, extra jobs only queue up, so it steps down.
+    """
+    def __init__(
+        self, min_jobs, max_jobs, jobs=None, interval=5, step=1, tolerance=0.05,
+        clock=None,
+    ):
+        if not 1 <= min_jobs <= max_jobs:
+            raise ValueError('Invalid job bounds', min_jobs, max_jobs)
+        self.min_jobs = min_jobs
+        self.max_jobs = max_jobs
+        self.interval = interval
+        self.step = step
+        self.tolerance = tolerance
+        self.clock = clock or time.monotonic
+
+        self.jobs = min_jobs if jobs is None else max(min_jobs, min(max_jobs, jobs))
+        self.direction = 1
+        self.previous = None
+        self._reset(self.clock())
+
+    def __repr__(self):
+        return 'ConcurrencyTuner<jobs={}, min={}, max={}>'.format(
+            self.jobs, self.min_jobs, self.max_jobs,
+        )
+
+    def _reset(self, now):
+        self._started_at = now
+        self._size = 0
+        self._count = 0
+        self._latency = 0
+
+    def record(self, size, seconds):
+        self._size += size
+        self._count += 1
+        self._latency += seconds
+        self.update()
+
+    def update(self):
+        now = self.clock()
+        elapsed = now - self._started_at
+        if elapsed < self.interval or self._count == 0:
+            return self.jobs
+
+        throughput = (self._size or self._count) / elapsed
+        latency = self._latency / self._count
+        current = (throughput, latency, self._size > 0)
+        self._reset(now)
+
+        previous, self.previous = self.previous, current
+        if previous is None or previous[2] != current[2]:
+            return self._move()
+
+        if throughput > previous[0] * (1 + self.tolerance):
+            pass
+        elif throughput < previous[0] * (1 - self.tolerance):
+            self.direction = -self.direction
+        elif latency > previous[1] * (1 + self.tolerance):
+            self.direction = -1
+        return self._move()
+
+    def _move(self):
+        jobs = self.jobs + self.direction * self.step
+        if not self.min_jobs <= jobs <= self.max_jobs:
+            self.direction = -self.direction
+            jobs = self.jobs + self.direction * self.step
+        jobs = max(self.min_jobs, min(self.max_jobs, jobs))
+        if jobs != self.jobs:
+            logger.debug('Changing jobs from %s to %s', self.jobs, jobs)
+        self.jobs = jobs
+        return jobs
+
+
+def get_weighted_policy(size=1, age=1):
+    """
+    Returns a scheduling policy mixing smallest first and most recently modified first.
+    Both the size and the age of a key count on a logarithmic scale, so that a file ten
+    times larger weighs the same as one modified ten times longer ago (with the
+    default weights).
+    """
+    def priority(item):
+        item_age = max(0, time.time() - (item.timestamp or 0))
+        return (
+            size * math.log10((item.size or 0) + 1) + age * math.log10(item_age + 1),
+            item.key,
+        )
+    return priority
+
+
+# sort keys for TransferItems, the lowest ones are transferred first
+SCHEDULING_POLICIES = {
+    'alphabetical': lambda item: item.key,
+    'smallest': lambda item: (item.size or 0, item.key),
+    'recent': lambda item: (-(item.timestamp or 0), item.key),
+    'weighted': get_weighted_policy(),
+}
+
+
+def get_scheduling_policy(policy):
+    """
+    Returns the sort key function for `policy`: the name of one of the
+    SCHEDULING_POLICIES, an object with the `size` and `age` weights of a weighted
+    policy, or a function taking a TransferItem.
+    """
+    if callable(policy):
+        return policy
+    elif isinstance(policy, dict):
+        return get_weighted_policy(**policy)
+    elif policy in SCHEDULING_POLICIES:
+        return SCHEDULING_POLICIES[policy]
+    else:
+        raise ValueError('Unknown scheduling policy', policy)
+
+
+class InlineExecutor(object):
+    """
+    Runs every submitted function straight away in the calling thread, so that a
+    single job keeps the order and the KeyboardInterrupt behaviour of a plain loop.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def submit(self, func, *args):
+        future = futures.Future()
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class JobBudget(object):
+    """
+    Limits how many transfers run at the same time across every TransferExecutor, e.g.
+    of targets synced in parallel, on top of the jobs of each one. A limit of None
+    means unlimited.
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'JobBudget<{}/{}>'.format(self.in_flight, self.limit)
+
+    def configure(self, limit=None):
+        if limit is not None and limit < 1:
+            raise ValueError('At least one job is needed', limit)
+        with self._lock:
+            self.limit = limit
+
+    def acquire(self):
+        """
+        Takes a job from the budget without waiting, returns False if none is left.
+        """
+        with self._lock:
+            if self.limit is not None and self.in_flight >= self.limit:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+# shared by all targets so that the limit applies to s4 as a whole
+job_budget = JobBudget()
+
+
+class TransferExecutor(object):
+    """
+    Runs transfers for a list of keys with up to `jobs` of them in flight.
+
+    Transfers failing with a throttling or transient error are put back in a retry
+    queue with full jitter exponential backoff and are run again (at most
+    `max_attempts` times) before `run` returns, while a RateController backs off the
+    concurrency and rate of new transfers.
+
+    With a ConcurrencyTuner, `jobs` is only the upper bound and the tuner picks how
+    many transfers run at a time from the sizes (the values returned by `func`) and
+    durations of the completed ones.
+
+    Keys passed to `run` as `large_keys` only get `large_jobs` lanes, so that while
+    they are in flight the remaining jobs keep working through the smaller ones.
+
+    Every transfer also takes a job from `budget`, which is shared with the executors
+    of other targets.
+    """
+    def __init__(
+        self, jobs=1, controller=None, max_attempts=5, backoff_base=0.5, backoff_cap=30,
+        tuner=None, large_jobs=1, clock=None, sleep=None, budget=None,
+    ):
+        if large_jobs < 1:
+            raise ValueError('At least one job is needed for large transfers', large_jobs)
+        self.large_jobs = large_jobs
+        self.tuner = tuner
+        if tuner is not None:
+            jobs = tuner.max_jobs
+        self.jobs = jobs
+        self.clock = clock or time.monotonic
+        self.sleep = sleep or time.sleep
+        if controller is None:
+            controller = RateController(jobs, clock=self.clock, sleep=self.sleep)
+        self.controller = controller
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.budget = budget or job_budget
+
+    # seconds between checks for keys fed, or jobs left in the budget, while waiting
+    FEED_INTERVAL = 0.1
+
+    def __repr__(self):
+        return 'TransferExecutor<jobs={}, {}>'.format(self.jobs, self.controller)
+
+    def get_backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+
+    @property
+    def limit(self):
+        if self.tuner is None:
+            return self.controller.limit
+        return min(self.controller.limit, self.tuner.jobs)
+
+    def get_executor(self):
+        if self.jobs <= 1:
+            return InlineExecutor()
+        return utils.ThreadPoolExecutor(self.jobs)
+
+    def get_next_index(self, queue, large_keys, large_in_flight):
+        for index, key in enumerate(queue):
+            if key not in large_keys or large_in_flight < self.large_jobs:
+                return index
+        return None
+
+    def run(self, keys, func, on_success=None, on_error=None, large_keys=(), feed=None):
+        """
+        Calls `func(key)` for every key, in the given order as far as the lanes allow,
+        and returns the keys which succeeded. `on_success(key)` and `on_error(key, error)`
+        are always called from the calling thread.
+
+        Further keys can be passed through `feed`, a queue.Queue ended with None, while
+        the transfers are already running. `run` only returns once the feed has ended.
+        """
+        queue = collections.deque(keys)
+        retries = []
+        attempts = collections.Counter()
+        pending = {}
+        success = []
+        feeding = feed is not None
+        budget_exhausted = False
+
+        def call(key):
+            try:
+                return func(key)
+            finally:
+                # released as soon as it is done, other targets may be waiting for it
+                self.budget.release()
+
+        def handle(future):
+            key, started_at = pending.pop(future)
+            error = future.exception()
+            if error is not None and not isinstance(error, Exception):
+                # e.g. a KeyboardInterrupt in a worker thread ends the whole run
+                raise error
+            self.controller.release(started_at, throttled=is_throttling_error(error))
+            if error is None:
+                if self.tuner is not None:
+                    size = future.result()
+                    self.tuner.record(
+                        size if isinstance(size, int) else 0,
+                        self.controller.clock() - started_at,
+                    )
+                success.append(key)
+                if on_success is not None:
+                    on_success(key)
+                return
+
+            attempts[key] += 1
+            if is_retryable_error(error) and attempts[key] < self.max_attempts:
+                delay = self.get_backoff(attempts[key])
+                logger.warning('Retrying %s in %.1f seconds: %s', key, delay, error)
+                heapq.heappush(retries, (self.clock() + delay, key))
+            elif on_error is not None:
+                on_error(key, error)
+
+        def read_feed(timeout=None):
+            # returns False once the feed has ended
+            try:
+                key = feed.get(timeout=timeout) if timeout else feed.get_nowait()
+                while key is not None:
+                    queue.append(key)
+                    key = feed.get_nowait()
+                return False
+            except queue_module.Empty:
+                return True
+
+        def get_timeout():
+            timeouts = []
+            if retries:
+                timeouts.append(max(0, retries[0][0] - self.clock()))
+            if feeding or budget_exhausted:
+                timeouts.append(self.FEED_INTERVAL)
+            return min(timeouts) if timeouts else None
+
+        with self.get_executor() as executor:
+            try:
+                while queue or retries or pending or feeding:
+                    if feeding:
+                        feeding = read_feed()
+
+                    if retries and retries[0][0] <= self.clock():
+                        queue.appendleft(heapq.heappop(retries)[1])
+
+                    index = None
+                    if queue and len(pending) < self.limit:
+                        large_in_flight = sum(
+                            1 for key, _ in pending.values() if key in large_keys
+                        )
+                        index = self.get_next_index(queue, large_keys, large_in_flight)
+
+                    budget_exhausted = index is not None and not self.budget.acquire()
+                    if budget_exhausted:
+                        index = None
+
+                    if index is not None:
+                        key = queue[index]
+                        del queue[index]
+                        started_at = self.controller.acquire()
+                        future = executor.submit(call, key)
+                        pending[future] = (key, started_at)
+                        if future.done():
+                            handle(future)
+                    elif pending:
+                        done, _ = futures.wait(
+                            pending, timeout=get_timeout(), return_when=futures.FIRST_COMPLETED,
+                        )
+                        for future in done:
+                            handle(future)
+                    elif feeding and not retries:
+                        feeding = read_feed(timeout=self.FEED_INTERVAL)
+                    elif retries or budget_exhausted:
+                        self.sleep(get_timeout())
+            except BaseException:
+                for future in pending:
+                    if future.cancel():
+                        # it never got to call, which would have released its job
+                        self.budget.release()
+                raise
+
+        return success
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket limiting the rate of bytes to `rate` per second (None is
+    unlimited), with bursts of up to `burst` seconds worth of bytes.
+
+    Consumers take their tokens up front and sleep off any debt, so concurrent
+    transfers share the rate between them instead of each getting all of it. A rate of 0
+    pauses them until it changes.
+    """
+    def __init__(self, rate=None, burst=1, clock=None, sleep=None):
+        self.burst = burst
+        self.clock = clock or time.monotonic
+        self.sleep = sleep or time.sleep
+        self._lock = threading.Lock()
+        self.rate = None
+        self.set_rate(rate)
+
+    def __repr__(self):
+        return 'TokenBucket<rate={}>'.format(self.rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            if rate != self.rate:
+                self.rate = rate
+                self._tokens = 0 if rate is None else rate * self.burst
+                self._updated_at = self.clock()
+
+    def consume(self, size, wait=None):
+        """
+        Takes size tokens, sleeping off any debt. While paused `wait()` is called (or one
+        second slept) before the rate is checked again.
+        """
+        if self.rate is None:
+            return
+
+        while True:
+            with self._lock:
+                if self.rate is None:
+                    return
+                if self.rate != 0:
+                    now = self.clock()
+                    capacity = self.rate * self.burst
+                    self._tokens = min(
+                        capacity, self._tokens + (now - self._updated_at) * self.rate
+                    )
+                    self._updated_at = now
+                    self._tokens -= size
+                    delay = -self._tokens / self.rate if self._tokens < 0 else 0
+                    break
+
+            if wait is not None:
+                wait()
+            else:
+                self.sleep(1)
+
+        if delay > 0:
+            self.sleep(delay)
+
+
+def parse_time(value):
+    hours, minutes = value.split(':')
+    return datetime.time(int(hours), int(minutes))
+
+
+class BandwidthWindow(object):
+    """
+    Time of day (and optionally days of the week, 0 being Monday) during which other
+    bandwidth limits apply. Windows ending before they start span midnight.
+    """
+    def __init__(self, start, end, upload=None, download=None, days=None):
+        self.start = parse_time(start)
+        self.end = parse_time(end)
+        self.upload = upload
+        self.download = download
+        self.days = days
+
+    def __repr__(self):
+        return 'BandwidthWindow<{}-{}, upload={}, download={}>'.format(
+            self.start, self.end, self.upload, self.download,
+        )
+
+    def contains(self, now):
+        current = now.time()
+        if self.start <= self.end:
+            inside = self.start <= current < self.end
+            day = now.weekday()
+        else:
+            inside = current >= self.start or current < self.end
+            # the early hours belong to the window which started the day before
+            day = now.weekday() if current >= self.start else (now.weekday() - 1) % 7
+        return inside and (self.days is None or day in self.days)
+
+
+class BandwidthLimiter(object):
+    """
+    Limits the bytes per second uploaded to and downloaded from S3 by every target
+    together. The limits of the first window of the schedule containing the current
+    time replace the default ones, and are checked again every `check_interval`
+    seconds so long transfers follow the schedule too. A window with a limit of 0
+    pauses those transfers until it ends.
+    """
+    def __init__(self, clock=None, sleep=None, now=None, check_interval=60):
+        self.clock = clock or time.monotonic
+        self.sleep = sleep or time.sleep
+        self.now = now or datetime.datetime.now
+        self.check_interval = check_interval
+        self.uploads = TokenBucket(clock=self.clock, sleep=sleep)
+        self.downloads = TokenBucket(clock=self.clock, sleep=sleep)
+        self.upload_limit = None
+        self.download_limit = None
+        self.windows = []
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'BandwidthLimiter<upload={}, download={}>'.format(
+            self.uploads.rate, self.downloads.rate,
+        )
+
+    def configure(self, upload=None, download=None, schedule=()):
+        windows = [BandwidthWindow(**window) for window in schedule]
+        for limit in (upload, download):
+            if limit is not None and limit <= 0:
+                # nothing would ever end the pause
+                raise ValueError('Bandwidth limits must be positive', limit)
+        for window in windows:
+            for limit in (window.upload, window.download):
+                if limit is not None and limit < 0:
+                    raise ValueError('Bandwidth limits can not be negative', limit)
+
+        self.upload_limit = upload
+        self.download_limit = download
+        self.windows = windows
+        self.update(force=True)
+
+    def get_limits(self):
+        now = self.now()
+        for window in self.windows:
+            if window.contains(now):
+                return window.upload, window.download
+        return self.upload_limit, self.download_limit
+
+    def update(self, force=False):
+        if not self.windows and not force:
+            return
+        # called by every transfer thread, only one of them switches the rates
+        with self._lock:
+            now = self.clock()
+            if (
+                force or self._checked_at is None or
+                now - self._checked_at >= self.check_interval
+            ):
+                self._checked_at = now
+                upload, download = self.get_limits()
+                if (upload, download) != (self.uploads.rate, self.downloads.rate):
+                    logger.debug(
+                        'Limiting uploads to %s and downloads to %s bytes/s', upload, download
+                    )
+                self.uploads.set_rate(upload)
+                self.downloads.set_rate(download)
+
+    def wait(self):
+        # paused by the schedule, wait for the window to end
+        self.sleep(self.check_interval)
+        self.update()
+
+    def consume(self, bucket, size):
+        self.update()
+        bucket.consume(size, wait=self.wait)
+
+    def upload(self, size):
+        self.consume(self.uploads, size)
+
+    def download(self, size):
+        self.consume(self.downloads, size)
+
+
+# shared by all targets so that the limits apply to s4 as a whole
+bandwidth = BandwidthLimiter()
+
+
+class LimitedReader(object):
+    """
+    Wraps a file like object so that reading from it consumes `consume(size)` first.
+    """
+    def __init__(self, fp, consume):
+        self.fp = fp
+        self.consume = consume
+
+    def __repr__(self):
+        return 'LimitedReader<{}>'.format(self.fp)
+
+    @property
+    def closed(self):
+        return getattr(self.fp, 'closed', False)
+
+    def read(self, size=-1):
+        data = self.fp.read(size) if size is not None and size >= 0 else self.fp.read()
+        self.consume(len(data))
+        return data
+
+    def close(self):
+        self.fp.close()
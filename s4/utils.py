@@ -1,7 +1,41 @@
 # -*- coding: utf-8 -*-
 
+import contextlib
+import ctypes
+import ctypes.util
 import datetime
 import getpass
+import logging
+import os
+import platform
+import threading
+from concurrent import futures
+
+
+logger = logging.getLogger(__name__)
+
+
+STATE_FOLDER_PATH = os.path.join(
+    os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 's4'
+)
+
+# Linux ioprio_set / ioprio_get syscall numbers for the architectures we know about
+IOPRIO_SYSCALLS = {
+    'x86_64': (251, 252),
+    'i386': (289, 290),
+    'i686': (289, 290),
+    'aarch64': (30, 31),
+    'armv7l': (314, 315),
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_IDLE = 3
+
+# Directories modified this close to the time they were scanned may change again
+# without their mtime changing on file systems with coarse timestamps
+RACY_WINDOW_NS = 2 * 10**9
+
+_log_context = threading.local()
 
 
 def to_timestamp(dt):
@@ -14,3 +48,91 @@ def get_input(*args, secret=False, **kwargs):
         return getpass.getpass(*args, **kwargs)
     else:
         return input(*args, **kwargs)
+
+
+def get_state_path(name):
+    """
+    Returns the path of a file used to keep local state between runs of s4.
+    """
+    return os.path.join(STATE_FOLDER_PATH, name)
+
+
+def _ioprio_syscall(index, *args):
+    syscalls = IOPRIO_SYSCALLS.get(platform.machine())
+    if platform.system() != 'Linux' or syscalls is None:
+        return -1
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return libc.syscall(syscalls[index], IOPRIO_WHO_PROCESS, 0, *args)
+
+
+def get_io_priority():
+    """
+    Returns the I/O priority of the current thread or None if this is not supported
+    on the running platform.
+    """
+    result = _ioprio_syscall(1)
+    return result if result >= 0 else None
+
+
+def set_io_priority(value):
+    """
+    Sets the I/O priority of the current thread. Returns True if successful.
+    """
+    return _ioprio_syscall(0, value) == 0
+
+
+@contextlib.contextmanager
+def lower_io_priority():
+    """
+    Runs the enclosed block in the idle I/O scheduling class so that it only uses
+    the disk when nothing else needs it. Does nothing on unsupported platforms.
+    """
+    previous = get_io_priority()
+    if previous is not None and set_io_priority(IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT):
+        logger.debug('Lowered I/O priority (previously %s)', previous)
+    else:
+        previous = None
+        logger.debug('Unable to lower I/O priority on this platform')
+
+    try:
+        yield
+    finally:
+        if previous is not None:
+            set_io_priority(previous)
+
+
+def get_log_context():
+    """
+    Returns the name the log records of the current thread are grouped under, if any.
+    """
+    return getattr(_log_context, 'name', None)
+
+
+@contextlib.contextmanager
+def log_context(name):
+    """
+    Groups the log records of the enclosed block under name, including those of the
+    work it hands to a ThreadPoolExecutor of this module.
+    """
+    previous = get_log_context()
+    _log_context.name = name
+    try:
+        yield
+    finally:
+        _log_context.name = previous
+
+
+class ThreadPoolExecutor(futures.ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor which runs each function in the log context of the thread that
+    submitted it.
+    """
+    def submit(self, fn, *args, **kwargs):
+        name = get_log_context()
+
+        def run():
+            with log_context(name):
+                return fn(*args, **kwargs)
+
+        return super().submit(run)
@@ -33,7 +33,11 @@ setup(
         's4/__init__.py',
         's4/sync.py',
         's4/utils.py',
+        's4/daemon.py',
+        's4/transfer.py',
         's4/clients/__init__.py',
+        's4/clients/cache.py',
+        's4/clients/chunking.py',
         's4/clients/local.py',
         's4/clients/s3.py',
     ],
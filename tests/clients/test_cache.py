@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import os
+
+import mock
+
+import pytest
+
+from s4.clients import cache
+from tests import utils
+
+
+def age(path, seconds=10):
+    # move directory mtimes into the past so that they are not considered racy
+    for directory, dirs, files in os.walk(path):
+        stat = os.stat(directory)
+        os.utime(directory, ns=(stat.st_atime_ns, stat.st_mtime_ns - seconds * 10**9))
+
+
+class TestJson(object):
+    def test_round_trip(self, tmpdir):
+        path = str(tmpdir.join('foo', 'data'))
+        cache.write_json(path, {'hello': [1, 2]})
+        assert cache.read_json(path) == {'hello': [1, 2]}
+        assert os.listdir(str(tmpdir.join('foo'))) == ['data']
+
+    def test_missing(self, tmpdir):
+        assert cache.read_json(str(tmpdir.join('nope')), default={}) == {}
+
+    def test_corrupt(self, tmpdir):
+        tmpdir.join('data').write('garbage')
+        assert cache.read_json(str(tmpdir.join('data'))) is None
+
+    def test_state_lock(self, tmpdir):
+        path = str(tmpdir.join('data'))
+        assert cache.get_state_lock(path) is cache.get_state_lock(path)
+        assert cache.get_state_lock(path) is not cache.get_state_lock(path + '2')
+
+
+class TestStatCache(object):
+    def test_unknown_mode(self, tmpdir):
+        with pytest.raises(ValueError):
+            cache.StatCache(str(tmpdir.join('.s4cache')), 'whatever')
+
+    def test_repr(self):
+        stat_cache = cache.StatCache('/i/dont/exist', cache.StatCache.TRUST)
+        assert repr(stat_cache) == 'StatCache</i/dont/exist, trust>'
+
+    def test_scan(self, tmpdir):
+        root = str(tmpdir.join('root'))
+        utils.set_local_contents(mock.Mock(path=root), 'foo/bar.txt', timestamp=1000)
+        utils.set_local_contents(mock.Mock(path=root), 'baz.txt', timestamp=2000)
+        utils.set_local_contents(mock.Mock(path=root), 'baz.pyc', timestamp=2000)
+
+        stat_cache = cache.StatCache(str(tmpdir.join('.s4cache')))
+        expected = {'foo/bar.txt': 1000, 'baz.txt': 2000}
+        assert stat_cache.scan(root, ['*.pyc']) == expected
+        stat_cache.save()
+
+        other = cache.StatCache(str(tmpdir.join('.s4cache')))
+        assert other.directories == stat_cache.directories
+        assert other.scan(root, ['*.pyc']) == expected
+
+    def test_trust_reuses_unchanged_directories(self, tmpdir):
+        root = str(tmpdir.join('root'))
+        utils.set_local_contents(mock.Mock(path=root), 'foo/bar.txt', timestamp=1000)
+        utils.set_local_contents(mock.Mock(path=root), 'baz.txt', timestamp=2000)
+        age(root)
+
+        stat_cache = cache.StatCache(str(tmpdir.join('.s4cache')), cache.StatCache.TRUST)
+        stat_cache.scan(root, [])
+        stat_cache.save()
+
+        with mock.patch('s4.clients.cache.scandir') as scandir:
+            with mock.patch('os.stat', wraps=os.stat) as stat:
+                result = stat_cache.scan(root, [])
+
+        assert result == {'foo/bar.txt': 1000, 'baz.txt': 2000}
+        assert scandir.call_count == 0
+        # only directories are stat'ed
+        assert stat.call_count == 2
+        assert not stat_cache.dirty
+
+    def test_verify_restats_files(self, tmpdir):
+        root = str(tmpdir.join('root'))
+        client = mock.Mock(path=root)
+        utils.set_local_contents(client, 'foo/bar.txt', timestamp=1000)
+        age(root)
+
+        stat_cache = cache.StatCache(str(tmpdir.join('.s4cache')), cache.StatCache.VERIFY)
+        stat_cache.scan(root, [])
+
+        # modify the file in place without changing the mtime of the directory
+        directory_mtime = os.stat(os.path.join(root, 'foo')).st_mtime_ns
+        utils.set_local_contents(client, 'foo/bar.txt', timestamp=3000, data='hello')
+        os.utime(os.path.join(root, 'foo'), ns=(directory_mtime, directory_mtime))
+
+        with mock.patch('s4.clients.cache.scandir') as scandir:
+            assert stat_cache.scan(root, []) == {'foo/bar.txt': 3000}
+        assert scandir.call_count == 0
+
+    def test_changed_directory(self, tmpdir):
+        root = str(tmpdir.join('root'))
+        client = mock.Mock(path=root)
+        utils.set_local_contents(client, 'foo/bar.txt', timestamp=1000)
+        age(root)
+
+        stat_cache = cache.StatCache(str(tmpdir.join('.s4cache')), cache.StatCache.TRUST)
+        stat_cache.scan(root, [])
+
+        utils.set_local_contents(client, 'foo/new.txt', timestamp=4000)
+        utils.delete_local(client, 'foo/bar.txt')
+        assert stat_cache.scan(root, []) == {'foo/new.txt': 4000}
+
+    def test_ignore_files_changed(self, tmpdir):
+        root = str(tmpdir.join('root'))
+        utils.set_local_contents(mock.Mock(path=root), 'foo.txt', timestamp=1000)
+        age(root)
+
+        stat_cache = cache.StatCache(str(tmpdir.join('.s4cache')), cache.StatCache.TRUST)
+        assert stat_cache.scan(root, []) == {'foo.txt': 1000}
+        assert stat_cache.scan(root, ['*.txt']) == {}
+
+
+class TestHashCache(object):
+    def test_unknown_storage(self):
+        with pytest.raises(ValueError):
+            cache.HashCache('whatever')
+
+    def test_repr(self):
+        assert repr(cache.HashCache('xattr')) == 'HashCache<xattr>'
+
+    @pytest.mark.parametrize(['storage'], [('sqlite', ), ('xattr', )])
+    def test_hashed_once(self, tmpdir, storage):
+        path = str(tmpdir.join('foo'))
+        utils.write_local(path, 'hello')
+
+        hash_cache = cache.HashCache(storage, path=str(tmpdir.join('hashes.sqlite')))
+        with mock.patch('s4.clients.cache.hash_file', wraps=cache.hash_file) as hash_file:
+            assert hash_cache.get_hash(path) == '5d41402abc4b2a76b9719d911017c592'
+            assert hash_cache.get_hash(path) == '5d41402abc4b2a76b9719d911017c592'
+
+            other = cache.HashCache(storage, path=str(tmpdir.join('hashes.sqlite')))
+            assert other.get_hash(path) == '5d41402abc4b2a76b9719d911017c592'
+        assert hash_file.call_count == 1
+
+    @pytest.mark.parametrize(['storage'], [('sqlite', ), ('xattr', )])
+    def test_invalidated_by_modification(self, tmpdir, storage):
+        path = str(tmpdir.join('foo'))
+        utils.write_local(path, 'hello')
+
+        hash_cache = cache.HashCache(storage, path=str(tmpdir.join('hashes.sqlite')))
+        hash_cache.set(path, 'notarealhash')
+        assert hash_cache.get(path) == 'notarealhash'
+
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert hash_cache.get(path) is None
+        assert hash_cache.get_hash(path) == '5d41402abc4b2a76b9719d911017c592'
+
+    def test_missing_file(self, tmpdir):
+        hash_cache = cache.HashCache(path=str(tmpdir.join('hashes.sqlite')))
+        assert hash_cache.get(str(tmpdir.join('nope'))) is None
+        assert hash_cache.get_hash(str(tmpdir.join('nope'))) is None
+
+    def test_xattr_not_supported(self, tmpdir):
+        path = str(tmpdir.join('foo'))
+        utils.write_local(path, 'hello')
+
+        hash_cache = cache.HashCache('xattr', path=str(tmpdir.join('hashes.sqlite')))
+        error = OSError(errno.ENOTSUP, 'Operation not supported')
+        with mock.patch('os.setxattr', side_effect=error):
+            hash_cache.set(path, 'somehash')
+        assert hash_cache._get_database(os.stat(path)) == 'somehash'
+        assert hash_cache.get(path) == 'somehash'
+
+    def test_xattr_read_only(self, tmpdir):
+        path = str(tmpdir.join('foo'))
+        utils.write_local(path, 'hello')
+
+        hash_cache = cache.HashCache('xattr', path=str(tmpdir.join('hashes.sqlite')))
+        error = OSError(errno.EROFS, 'Read-only file system')
+        with mock.patch('os.setxattr', side_effect=error):
+            assert hash_cache.get_hash(path) == '5d41402abc4b2a76b9719d911017c592'
+        assert hash_cache._get_database(os.stat(path)) == '5d41402abc4b2a76b9719d911017c592'
+
+
+class TestUploadState(object):
+    def test_set_get_remove(self, tmpdir):
+        state = cache.UploadState(str(tmpdir.join('uploads')))
+        assert state.get('s3://foo/bar') is None
+
+        state.set('s3://foo/bar', {'upload_id': 'abc'})
+        state.set('s3://foo/baz', {'upload_id': 'def'})
+        assert state.get('s3://foo/bar') == {'upload_id': 'abc'}
+
+        state.remove('s3://foo/bar')
+        state.remove('s3://foo/idontexist')
+        assert state.get('s3://foo/bar') is None
+        assert state.get('s3://foo/baz') == {'upload_id': 'def'}
+
+    def test_default_path(self, state_folder):
+        assert cache.UploadState().path == os.path.join(state_folder, 'uploads')
+
+    def test_shared_lock(self, tmpdir):
+        # e.g. the states of S3 targets synced in parallel
+        path = str(tmpdir.join('uploads'))
+        state_1 = cache.UploadState(path)
+        state_2 = cache.UploadState(path)
+
+        def write_json(path, data):
+            assert cache.get_state_lock(path).locked()
+            write(path, data)
+
+        write = cache.write_json
+        with mock.patch.object(cache, 'write_json', side_effect=write_json):
+            state_1.set('s3://foo/bar', {'upload_id': 'abc'})
+            state_2.set('s3://foo/baz', {'upload_id': 'def'})
+        assert state_1._lock is state_2._lock
+        assert state_1.get('s3://foo/bar') == {'upload_id': 'abc'}
+
+
+class TestJournal(object):
+    def test_start_append_read(self, tmpdir):
+        journal = cache.Journal(str(tmpdir.join('journals', 'abc')))
+        assert not journal.exists()
+        assert journal.read() == []
+
+        journal.start([{'started': 1000}])
+        journal.append({'plan': 'foo'})
+        journal.sync()
+        assert journal.read() == [{'started': 1000}, {'plan': 'foo'}]
+
+        # starting again replaces what was recorded
+        journal.start([{'started': 2000}])
+        journal.close()
+        assert journal.read() == [{'started': 2000}]
+
+        journal.remove()
+        assert not journal.exists()
+
+    def test_truncated_line(self, tmpdir):
+        path = tmpdir.join('journal')
+        path.write('{"plan": "foo"}\n{"done": "fo')
+        assert cache.Journal(str(path)).read() == [{'plan': 'foo'}]
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import io
+import random
+
+import mock
+import pytest
+
+from s4.clients import chunking
+
+
+def get_data(size, seed=0):
+    return bytes(random.Random(seed).getrandbits(8) for _ in range(size))
+
+
+class TestChunker(object):
+    def test_invalid_sizes(self):
+        with pytest.raises(ValueError):
+            chunking.Chunker(min_size=100, avg_size=50, max_size=200)
+
+    def test_repr(self):
+        chunker = chunking.Chunker(1, 2, 3)
+        assert repr(chunker) == 'Chunker<min=1, avg=2, max=3>'
+
+    def test_empty(self):
+        chunker = chunking.Chunker(64, 256, 1024)
+        assert list(chunker.iter_chunks(io.BytesIO(b''))) == []
+
+    def test_sizes(self):
+        data = get_data(20000)
+        chunker = chunking.Chunker(64, 256, 1024)
+        chunks = list(chunker.iter_chunks(io.BytesIO(data)))
+
+        assert b''.join(chunks) == data
+        assert len(chunks) > 1
+        assert all(64 <= len(chunk) <= 1024 for chunk in chunks[:-1])
+
+    def test_insertion_only_changes_nearby_chunks(self):
+        data = get_data(20000)
+        modified = data[:5000] + b'inserted' + data[5000:]
+        chunker = chunking.Chunker(64, 256, 1024)
+
+        chunks = list(chunker.iter_chunks(io.BytesIO(data)))
+        modified_chunks = list(chunker.iter_chunks(io.BytesIO(modified)))
+
+        changed = set(modified_chunks) - set(chunks)
+        assert 0 < sum(len(chunk) for chunk in changed) <= 2 * 1024 + len(b'inserted')
+
+    @pytest.mark.skipif(chunking.numpy is None, reason='numpy is not installed')
+    @pytest.mark.parametrize(['block_size'], [(1, ), (63, ), (100, ), (1024 * 1024, )])
+    def test_vectorised_search(self, block_size):
+        data = get_data(20000)
+        chunker = chunking.Chunker(64, 256, 1024)
+        with mock.patch.object(chunking, 'numpy', None):
+            expected = list(chunker.iter_chunks(io.BytesIO(data)))
+
+        with mock.patch.object(chunking, 'SEARCH_BLOCK_SIZE', block_size):
+            assert list(chunker.iter_chunks(io.BytesIO(data))) == expected
+
+
+class TestManifest(object):
+    def test_round_trip(self):
+        data = chunking.dump_manifest(10, 'abc', [['def', 10]])
+        assert chunking.load_manifest(data) == {
+            'version': chunking.MANIFEST_VERSION,
+            'size': 10,
+            'md5': 'abc',
+            'chunks': [['def', 10]],
+        }
+
+    def test_unknown_version(self):
+        with pytest.raises(ValueError):
+            chunking.load_manifest(b'{"version": 1000}')
+
+
+class TestChunkedReader(object):
+    def test_read(self):
+        chunks = {'a': b'hello ', 'b': b'world'}
+        reader = chunking.ChunkedReader([['a', 6], ['b', 5], ['a', 6]], chunks.get)
+
+        assert reader.read(3) == b'hel'
+        assert reader.read(5) == b'lo wo'
+        assert reader.read() == b'rldhello '
+        assert reader.read(10) == b''
+
+        reader.close()
+        assert reader.closed
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import io
 
 import pytest
 
@@ -74,6 +75,21 @@ class TestSyncClient(object):
         with pytest.raises(NotImplementedError):
             client.delete("something")
 
+    def test_rename(self):
+        client = SyncClient()
+        with pytest.raises(NotImplementedError):
+            client.rename("something", "else")
+
+    def test_get_size(self):
+        client = SyncClient()
+        with pytest.raises(NotImplementedError):
+            client.get_size("something")
+
+    def test_get_hash(self):
+        client = SyncClient()
+        with pytest.raises(NotImplementedError):
+            client.get_hash("something")
+
     def test_get_local_keys(self):
         client = SyncClient()
         with pytest.raises(NotImplementedError):
@@ -140,6 +156,14 @@ class TestSyncObject(object):
         expected_repr = 'SyncObject<{}, 4096, 312313>'.format(dev_null)
         assert repr(sync_object) == expected_repr
 
+    def test_close(self):
+        fp = io.BytesIO(b'hello')
+        SyncObject(fp, 5, 312313).close()
+        assert fp.closed
+
+        # objects without a close method are left alone
+        SyncObject(object(), 5, 312313).close()
+
 
 class TestGetSyncState(object):
     def test_does_not_exist(self):
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import errno
 import gzip
 import io
 import json
@@ -55,6 +56,56 @@ class TestTraverse(object):
 
 
 class TestLocalSyncClient(object):
+    def test_stat_cache(self, local_client):
+        client = local.LocalSyncClient(local_client.path, stat_cache='trust')
+        utils.set_local_contents(client, 'foo/bar', timestamp=1000)
+        utils.set_local_contents(client, 'baz', timestamp=2000)
+
+        expected = {'foo/bar': 1000, 'baz': 2000}
+        assert client.get_all_real_local_timestamps() == expected
+        assert os.path.exists(os.path.join(client.path, '.s4cache'))
+        # the cache itself is never synced
+        assert client.get_all_real_local_timestamps() == expected
+        assert sorted(client.get_local_keys()) == ['baz', 'foo/bar']
+
+    def test_get_size_and_hash(self, local_client):
+        utils.set_local_contents(local_client, 'foo', data='hello')
+        assert local_client.get_size('foo') == 5
+        assert local_client.get_hash('foo') == '5d41402abc4b2a76b9719d911017c592'
+
+        assert local_client.get_size('idontexist') is None
+        assert local_client.get_hash('idontexist') is None
+
+    def test_hash_cache(self, local_client):
+        client = local.LocalSyncClient(local_client.path, hash_cache='sqlite')
+        utils.set_local_contents(client, 'foo', data='hello')
+        assert client.get('foo').hash is None
+        assert client.get_hash('foo') == '5d41402abc4b2a76b9719d911017c592'
+        assert client.get('foo').hash == '5d41402abc4b2a76b9719d911017c592'
+
+        # hashes of downloaded contents are stored without reading them again
+        client.put('bar', SyncObject(io.BytesIO(b'hi'), 2, 2000, hash='abc'))
+        assert client.get_hash('bar') == 'abc'
+
+    def test_hasher_stores_hash(self, local_client):
+        client = local.LocalSyncClient(local_client.path, hash_cache='sqlite')
+        utils.set_local_contents(client, 'foo', data='hello')
+        sync_object = client.get('foo')
+        sync_object.fp.read(2)
+
+        assert sync_object.hasher() == '5d41402abc4b2a76b9719d911017c592'
+        assert sync_object.fp.read() == b'llo'
+        sync_object.close()
+        # uploads hashing the file fill the cache for the next one
+        assert client.get('foo').hash == '5d41402abc4b2a76b9719d911017c592'
+
+    def test_rename(self, local_client):
+        utils.set_local_contents(local_client, 'foo', timestamp=1000, data='hello')
+        local_client.rename('foo', 'bar/baz')
+        assert local_client.get('foo') is None
+        assert utils.get_local_contents(local_client, 'bar/baz') == b'hello'
+        assert local_client.get_real_local_timestamp('bar/baz') == 1000
+
     def test_get_client_name(self, local_client):
         assert local_client.get_client_name() == 'local'
 
@@ -82,6 +133,15 @@ class TestLocalSyncClient(object):
         assert local_client.index['foo/hello_world.txt']['remote_timestamp'] == 20000
         assert utils.get_local_contents(local_client, 'foo/hello_world.txt') == data
 
+    def test_put_write_to(self, local_client):
+        fp = mock.MagicMock()
+        fp.write_to.side_effect = lambda fd, callback: os.write(fd, b'written in place')
+
+        local_client.put('foo', SyncObject(fp, 16, 20000))
+
+        assert not fp.read.called
+        assert utils.get_local_contents(local_client, 'foo') == b'written in place'
+
     def test_get_uri(self):
         client = local.LocalSyncClient('/home/michael')
         assert client.get_uri() == '/home/michael/'
@@ -253,14 +313,48 @@ class TestLocalSyncClient(object):
     def test_get_all_real_local_timestamps(self, local_client):
         utils.set_local_contents(local_client, 'red', 2323230)
         utils.set_local_contents(local_client, 'blue', 80808008)
+        utils.set_local_contents(local_client, '.chunks/green', 1000)
 
         expected_output = {
             'red': 2323230,
             'blue': 80808008,
+            '.chunks/green': 1000,
         }
         actual_output = local_client.get_all_real_local_timestamps()
         assert actual_output == expected_output
 
+    @pytest.mark.parametrize(['stat_cache'], [(None, ), ('verify', )])
+    def test_iter_actions(self, local_client, stat_cache):
+        client = local.LocalSyncClient(local_client.path, stat_cache=stat_cache)
+        utils.set_local_contents(client, 'red', 1000)
+        utils.set_local_contents(client, 'colors/blue', 2000)
+        for key, timestamp in [('red', 900), ('green', 800)]:
+            client.set_index_local_timestamp(key, timestamp)
+            client.set_remote_timestamp(key, timestamp)
+
+        actions = list(client.iter_actions())
+        assert [key for key, _ in actions][-1] == 'green'
+        assert dict(actions) == client.get_all_actions()
+        assert client.get_synced_fingerprint() == client.get_fingerprint()
+
+    def test_get_synced_fingerprint(self, local_client):
+        assert local_client.get_synced_fingerprint() is None
+
+        utils.set_local_contents(local_client, 'red', 1000)
+        utils.set_local_contents(local_client, 'blue', 2000)
+        local_client.get_all_real_local_timestamps()
+        assert local_client.get_synced_fingerprint() == local_client.get_fingerprint()
+
+        # changes made through the client are part of it, others are not
+        local_client.put('green', SyncObject(io.BytesIO(b'green'), 5, 3000))
+        local_client.delete('red')
+        synced = local_client.get_synced_fingerprint()
+        assert synced == local_client.get_fingerprint()
+
+        utils.set_local_contents(local_client, 'blue', 4000)
+        assert local_client.get_synced_fingerprint() == synced
+        assert local_client.get_fingerprint() != synced
+
     def test_get_index_timestamps(self, local_client):
         utils.set_local_index(local_client, {
             'foo': {
@@ -337,6 +431,52 @@ class TestLocalSyncClient(object):
 
         result = local_client.get('keychain')
         assert result.fp.read() == b'iamsomedatathatexists'
+        # no temporary files are left behind
+        assert os.listdir(local_client.path) == ['keychain']
+
+    def test_put_temp_file_next_to_destination(self, local_client):
+        mkstemp = tempfile.mkstemp
+        with mock.patch('tempfile.mkstemp', side_effect=mkstemp) as mock_mkstemp:
+            local_client.put('foo/bar', SyncObject(io.BytesIO(b'hello'), 5, 20000))
+
+        assert mock_mkstemp.call_args[1] == {
+            'dir': os.path.join(local_client.path, 'foo'),
+            'prefix': '.s4tmp-',
+        }
+        assert os.listdir(os.path.join(local_client.path, 'foo')) == ['bar']
+
+    def test_put_large(self, local_client):
+        data = os.urandom(3 * local_client.BUFFER_SIZE + 100)
+        callback = mock.MagicMock()
+        local_client.put('foo', SyncObject(io.BytesIO(data), len(data), 20000), callback)
+
+        assert utils.get_local_contents(local_client, 'foo') == data
+        assert sum(c[0][0] for c in callback.call_args_list) == len(data)
+
+    def test_put_without_readinto(self, local_client):
+        fp = mock.MagicMock(spec=['read'])
+        fp.read.side_effect = [b'hello ', b'world', b'']
+        local_client.put('foo', SyncObject(fp, 11, 20000))
+        assert utils.get_local_contents(local_client, 'foo') == b'hello world'
+
+    def test_put_shorter_than_expected(self, local_client):
+        local_client.put('foo', SyncObject(io.BytesIO(b'hello'), 1000, 20000))
+        assert utils.get_local_contents(local_client, 'foo') == b'hello'
+
+    @pytest.mark.parametrize(['policy', 'calls'], [
+        ('never', 0),
+        ('file', 1),
+        ('full', 2),
+    ])
+    def test_put_fsync(self, local_client, policy, calls):
+        client = local.LocalSyncClient(local_client.path, fsync=policy)
+        with mock.patch('os.fsync') as fsync:
+            client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 20000))
+        assert fsync.call_count == calls
+
+    def test_invalid_fsync(self, local_client):
+        with pytest.raises(ValueError):
+            local.LocalSyncClient(local_client.path, fsync='sometimes')
 
     @pytest.mark.parametrize(['compressed', 'method'], [
         (True, gzip.open),
@@ -412,3 +552,60 @@ class TestLocalSyncClient(object):
             }
         }
         assert local_client.index == expected_index
+
+
+class TestCopyFile(object):
+    def copy(self, local_client, data, offset=0):
+        source = os.path.join(local_client.path, 'source')
+        utils.write_local(source)
+        with open(source, 'wb') as fp:
+            fp.write(data)
+
+        callback = mock.MagicMock()
+        with open(source, 'rb') as fp:
+            fp.read(offset)
+            local_client.put('dest', SyncObject(fp, len(data), 20000), callback)
+
+        assert utils.get_local_contents(local_client, 'dest') == data[offset:]
+        assert sum(c[0][0] for c in callback.call_args_list) == len(data) - offset
+
+    def test_clone(self, local_client):
+        with mock.patch('fcntl.ioctl') as ioctl:
+            ioctl.side_effect = lambda dest_fd, request, source_fd: os.write(
+                dest_fd, os.pread(source_fd, 100, 0),
+            )
+            self.copy(local_client, b'hello world')
+        assert ioctl.call_args[0][1] == local.FICLONE
+
+    def test_copy_file_range(self, local_client):
+        with mock.patch('fcntl.ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'Nope')):
+            self.copy(local_client, os.urandom(10000))
+
+    def test_sendfile(self, local_client):
+        with mock.patch('fcntl.ioctl', side_effect=OSError(errno.EXDEV, 'Nope')):
+            with mock.patch('os.copy_file_range', side_effect=OSError(errno.ENOSYS, 'Nope')):
+                with mock.patch('os.sendfile', wraps=os.sendfile) as sendfile:
+                    self.copy(local_client, os.urandom(10000))
+        assert sendfile.called
+
+    def test_buffered_fallback(self, local_client):
+        with mock.patch('fcntl.ioctl', side_effect=OSError(errno.EXDEV, 'Nope')):
+            with mock.patch('os.copy_file_range', side_effect=OSError(errno.ENOSYS, 'Nope')):
+                with mock.patch('os.sendfile', side_effect=OSError(errno.EINVAL, 'Nope')):
+                    self.copy(local_client, os.urandom(10000))
+
+    def test_offset(self, local_client):
+        with mock.patch('fcntl.ioctl') as ioctl:
+            self.copy(local_client, b'hello world', offset=6)
+        assert not ioctl.called
+
+    def test_unexpected_error(self, local_client):
+        with mock.patch('fcntl.ioctl', side_effect=OSError(errno.EIO, 'Broken disk')):
+            with pytest.raises(OSError):
+                self.copy(local_client, b'hello world')
+        assert not os.path.exists(os.path.join(local_client.path, 'dest'))
+
+    def test_not_a_file(self):
+        assert local.get_file_descriptor(io.BytesIO(b'hello')) is None
+        with open(os.devnull, 'rb') as fp:
+            assert local.get_file_descriptor(fp) is None
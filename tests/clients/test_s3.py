@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 import datetime
+import hashlib
 import io
 import os
+import random
+import threading
 
 import boto3
 
@@ -9,10 +12,13 @@ from botocore.exceptions import ClientError
 
 import freezegun
 
+import mock
+
 from moto import mock_s3
 
 import pytest
 
+from s4 import transfer
 from s4.clients import SyncObject, s3
 from s4.utils import to_timestamp
 from tests import utils
@@ -102,6 +108,85 @@ class TestS3SyncClient(object):
         assert resp['Body'].read() == data
         assert s3_client.get_remote_timestamp('something/boardgame.rst') == 4000
 
+    def test_get_size_and_hash(self, s3_client):
+        utils.set_s3_contents(s3_client, 'foo', data='hello')
+        assert s3_client.get_size('foo') == 5
+        assert s3_client.get_hash('foo') == '5d41402abc4b2a76b9719d911017c592'
+
+        assert s3_client.get_size('idontexist') is None
+        assert s3_client.get_hash('idontexist') is None
+
+    def test_put_stores_hash(self, s3_client):
+        input_object = SyncObject(io.BytesIO(b'hello'), 5, 4000, hash='fakehash')
+        s3_client.put('foo', input_object)
+        assert s3_client.get_hash('foo') == 'fakehash'
+        assert s3_client.get('foo').hash == 'fakehash'
+
+    def test_managed_put_stores_hash(self, s3_client):
+        s3_client.put_object_threshold = None
+        s3_client.store_hashes = True
+        s3_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000))
+
+        metadata = s3_client.head('foo')['Metadata']
+        assert metadata[s3_client.HASH_METADATA_KEY] == '5d41402abc4b2a76b9719d911017c592'
+        assert s3_client.get_hash('foo') == '5d41402abc4b2a76b9719d911017c592'
+
+    def test_multipart_put_stores_hash(self, s3_client):
+        data = os.urandom(9 * 1024 * 1024)
+        s3_client.store_hashes = True
+        s3_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        assert s3.get_response_hash({'ETag': s3_client.head('foo')['ETag']}) is None
+        assert s3_client.get_hash('foo') == hashlib.md5(data).hexdigest()
+
+    def test_managed_put_without_store_hashes(self, s3_client):
+        s3_client.put_object_threshold = None
+        hasher = mock.Mock(return_value='somehash')
+        s3_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000, hasher=hasher))
+
+        # the contents are only read once, to upload them
+        assert not hasher.called
+        assert s3_client.HASH_METADATA_KEY not in s3_client.head('foo')['Metadata']
+
+    def test_put_uses_hasher(self, s3_client):
+        s3_client.put_object_threshold = None
+        s3_client.store_hashes = True
+        hasher = mock.Mock(return_value='somehash')
+        s3_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000, hasher=hasher))
+
+        assert hasher.call_count == 1
+        assert s3_client.get_hash('foo') == 'somehash'
+
+    def test_put_changed_while_uploading(self, s3_client, tmpdir):
+        path = str(tmpdir.join('foo'))
+        utils.write_local(path, 'hello')
+        s3_client.put_object_threshold = None
+        s3_client.store_hashes = True
+        upload_fileobj = s3_client.boto.upload_fileobj
+
+        def modifying_upload(**kwargs):
+            os.utime(path, (5000, 5000))
+            return upload_fileobj(**kwargs)
+
+        with open(path, 'rb') as fp:
+            with mock.patch.object(
+                s3_client.boto, 'upload_fileobj', side_effect=modifying_upload,
+            ):
+                s3_client.put('foo', SyncObject(fp, 5, 4000, hash='stalehash'))
+
+        assert s3_client.HASH_METADATA_KEY not in s3_client.head('foo')['Metadata']
+        assert s3_client.get_hash('foo') == '5d41402abc4b2a76b9719d911017c592'
+
+    def test_response_hash_multipart(self):
+        assert s3.get_response_hash({'ETag': '"abcdef-3"'}) is None
+        assert s3.get_response_hash({'ETag': '"abcdef"'}) == 'abcdef'
+
+    def test_rename(self, s3_client):
+        utils.set_s3_contents(s3_client, 'foo', data='hello')
+        s3_client.rename('foo', 'bar/baz')
+        assert s3_client.get('foo') is None
+        assert s3_client.get('bar/baz').fp.read() == b'hello'
+
     def test_get(self, s3_client):
         # given
         data = b'#000000'
@@ -296,6 +381,66 @@ class TestS3SyncClient(object):
         actual_output = s3_client.get_all_real_local_timestamps()
         assert actual_output == expected_output
 
+    def test_chunk_store_not_listed(self, s3_client):
+        utils.set_s3_contents(s3_client, 'carrot_cake', timestamp=2000)
+        utils.set_s3_contents(s3_client, '.chunks/' + 'a' * 64, timestamp=2100)
+        utils.set_s3_contents(s3_client, 'recipes/.chunks/notes', timestamp=2200)
+
+        expected_output = {'carrot_cake': 2000, 'recipes/.chunks/notes': 2200}
+        assert s3_client.get_all_real_local_timestamps() == expected_output
+        assert dict(s3_client.iter_real_local_timestamps()) == expected_output
+        assert sorted(s3_client.get_local_keys()) == sorted(expected_output)
+
+    def test_iter_actions(self, s3_client):
+        utils.set_s3_contents(s3_client, 'carrot_cake', timestamp=2000)
+        utils.set_s3_contents(s3_client, 'notes.txt', timestamp=2400)
+        utils.set_s3_contents(s3_client, '.syncignore', timestamp=1000, data='*.txt')
+
+        assert dict(s3_client.iter_real_local_timestamps()) == {
+            'carrot_cake': 2000, '.syncignore': 1000,
+        }
+        assert dict(s3_client.iter_actions()) == s3_client.get_all_actions()
+
+    def test_get_all_real_local_timestamps_fetches_concurrently(self, s3_client):
+        utils.set_s3_contents(s3_client, 'carrot_cake', timestamp=2000)
+        utils.set_s3_contents(s3_client, 'notes.txt', timestamp=2400)
+        utils.set_s3_contents(s3_client, '.syncignore', timestamp=1000, data='*.txt')
+
+        # the listing, index and .syncignore only all return if they run at the same time
+        barrier = threading.Barrier(3, timeout=5)
+
+        def wait(func):
+            def wrapper(*args, **kwargs):
+                barrier.wait()
+                return func(*args, **kwargs)
+            return wrapper
+
+        s3_client.list_objects = wait(s3_client.list_objects)
+        s3_client.load_index = wait(s3_client.load_index)
+        s3_client.reload_ignore_files = wait(s3_client.reload_ignore_files)
+
+        actual_output = s3_client.get_all_real_local_timestamps()
+        assert actual_output == {'carrot_cake': 2000, '.syncignore': 1000}
+        assert s3_client.index == {}
+
+    def test_get_synced_fingerprint(self, s3_client):
+        assert s3_client.get_synced_fingerprint() is None
+
+        s3_client.set_remote_timestamp('red', 4000)
+        s3_client.flush_index()
+        fingerprint = s3_client.get_synced_fingerprint()
+        assert fingerprint == s3_client.get_fingerprint()
+
+        # another machine syncing afterwards does not change what this client synced
+        other_client = s3.S3SyncClient(s3_client.boto, s3_client.bucket, s3_client.prefix)
+        other_client.set_remote_timestamp('blue', 5000)
+        other_client.flush_index()
+        assert s3_client.get_synced_fingerprint() == fingerprint
+        assert s3_client.get_fingerprint() != fingerprint
+
+        s3_client.reload_index()
+        assert s3_client.get_synced_fingerprint() == s3_client.get_fingerprint()
+
     def test_set_index_timestamps(self, s3_client):
         # given
         utils.set_s3_index(s3_client, {
@@ -373,3 +518,580 @@ class TestS3SyncClient(object):
             }
         }
         assert s3_client.index == expected_index
+
+
+class TestChunkedStorage(object):
+    @pytest.fixture
+    def chunked_client(self, s3_client):
+        return s3.S3SyncClient(s3_client.boto, s3_client.bucket, s3_client.prefix, chunking={
+            'threshold': 100, 'min_size': 64, 'avg_size': 256, 'max_size': 1024,
+        })
+
+    def get_chunk_keys(self, client):
+        response = client.boto.list_objects_v2(
+            Bucket=client.bucket, Prefix=client.chunk_path(''),
+        )
+        return [obj['Key'] for obj in response.get('Contents', [])]
+
+    def test_small_files_not_chunked(self, chunked_client):
+        chunked_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000))
+        assert self.get_chunk_keys(chunked_client) == []
+        assert chunked_client.get('foo').fp.read() == b'hello'
+
+    def test_put_get(self, chunked_client):
+        data = os.urandom(10000)
+        chunked_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        assert len(self.get_chunk_keys(chunked_client)) > 1
+        assert chunked_client.get_remote_timestamp('foo') == 4000
+        assert chunked_client.get_size('foo') == len(data)
+        assert chunked_client.get_hash('foo') == hashlib.md5(data).hexdigest()
+
+        result = chunked_client.get('foo')
+        assert result.total_size == len(data)
+        assert result.hash == hashlib.md5(data).hexdigest()
+        assert result.fp.read() == data
+
+    def test_get_large_manifest(self, chunked_client):
+        data = os.urandom(10000)
+        chunked_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+        chunked_client.download_part_size = 100
+        get_object = chunked_client.get_object
+        bodies = []
+
+        def recording_get_object(key, **kwargs):
+            response = get_object(key, **kwargs)
+            response['Body'] = mock.Mock(wraps=response['Body'])
+            bodies.append(response['Body'])
+            return response
+
+        with mock.patch.object(chunked_client, 'get_object', side_effect=recording_get_object):
+            result = chunked_client.get('foo')
+
+        # the first part does not hold the whole manifest, its connection is released
+        assert len(bodies) == 2
+        assert all(body.close.called for body in bodies)
+        assert result.fp.read() == data
+
+    def test_chunks_deduplicated(self, chunked_client):
+        data = bytes(random.Random(0).getrandbits(8) for _ in range(10000))
+        chunked_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+        chunk_keys = self.get_chunk_keys(chunked_client)
+
+        # a fresh client has to find out which chunks exist by itself
+        client = s3.S3SyncClient(
+            chunked_client.boto, chunked_client.bucket, chunked_client.prefix,
+            chunking={'threshold': 100, 'min_size': 64, 'avg_size': 256, 'max_size': 1024},
+        )
+        modified = data[:5000] + b'some more data' + data[5000:]
+        with mock.patch.object(client.boto, 'put_object', wraps=client.boto.put_object) as put:
+            client.put('bar', SyncObject(io.BytesIO(modified), len(modified), 5000))
+
+        # only a couple of chunks plus the manifest are uploaded
+        assert put.call_count <= 4
+        assert len(self.get_chunk_keys(client)) <= len(chunk_keys) + 3
+        assert client.get('bar').fp.read() == modified
+        assert client.get('foo').fp.read() == data
+
+    def test_chunks_ignored(self, chunked_client):
+        data = os.urandom(1000)
+        chunked_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+        assert list(chunked_client.get_all_real_local_timestamps()) == ['foo']
+
+    def test_rename(self, chunked_client):
+        data = os.urandom(1000)
+        chunked_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+        chunked_client.rename('foo', 'bar')
+        assert chunked_client.get('bar').fp.read() == data
+
+    def test_corrupt_chunk(self, chunked_client):
+        data = os.urandom(1000)
+        chunked_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+        chunked_client.boto.put_object(
+            Bucket=chunked_client.bucket,
+            Key=self.get_chunk_keys(chunked_client)[0],
+            Body=b'garbage',
+        )
+        with pytest.raises(ValueError):
+            chunked_client.get('foo').fp.read()
+
+    def test_delete_unreferenced_chunks(self, chunked_client):
+        data = os.urandom(10000)
+        chunked_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+        chunked_client.put('bar', SyncObject(io.BytesIO(os.urandom(5000)), 5000, 4000))
+        chunked_client.put('small', SyncObject(io.BytesIO(b'hello'), 5, 4000))
+        chunked_client.delete('bar')
+        chunk_keys = self.get_chunk_keys(chunked_client)
+
+        # chunks of files which may still be uploading are kept
+        assert chunked_client.delete_unreferenced_chunks() == []
+        assert self.get_chunk_keys(chunked_client) == chunk_keys
+
+        chunked_client.UNREFERENCED_CHUNK_TIMEOUT = -60
+        deleted = chunked_client.delete_unreferenced_chunks()
+
+        assert len(deleted) > 0
+        assert len(self.get_chunk_keys(chunked_client)) == len(chunk_keys) - len(deleted)
+        assert chunked_client.get('foo').fp.read() == data
+        assert chunked_client.get('small').fp.read() == b'hello'
+        assert chunked_client.delete_unreferenced_chunks() == []
+
+
+class TestAppendedPut(object):
+    def put(self, client, key, data, timestamp=4000):
+        client.put(key, SyncObject(io.BytesIO(data), len(data), timestamp))
+
+    def test_append(self, s3_client):
+        data = os.urandom(6 * 1024 * 1024)
+        self.put(s3_client, 'foo', data)
+
+        appended = data + b'some new lines'
+        with mock.patch.object(s3_client.boto, 'upload_fileobj') as upload_fileobj:
+            with mock.patch.object(
+                s3_client.boto, 'upload_part', wraps=s3_client.boto.upload_part,
+            ) as upload_part:
+                self.put(s3_client, 'foo', appended, timestamp=5000)
+
+        assert not upload_fileobj.called
+        assert upload_part.call_count == 1
+        assert upload_part.call_args[1]['Body'] == b'some new lines'
+        assert s3_client.get('foo').fp.read() == appended
+        assert s3_client.get_remote_timestamp('foo') == 5000
+
+    def test_two_appends(self, s3_client):
+        data = os.urandom(6 * 1024 * 1024)
+        self.put(s3_client, 'foo', data)
+        self.put(s3_client, 'foo', data + b'first', timestamp=5000)
+
+        with mock.patch.object(
+            s3_client.boto, 'upload_part', wraps=s3_client.boto.upload_part,
+        ) as upload_part:
+            self.put(s3_client, 'foo', data + b'first' + b'second', timestamp=6000)
+
+        assert upload_part.call_count == 1
+        assert upload_part.call_args[1]['Body'] == b'second'
+        assert s3_client.get('foo').fp.read() == data + b'firstsecond'
+        assert s3_client.get_hash('foo') == hashlib.md5(data + b'firstsecond').hexdigest()
+
+    def test_multipart_object(self, s3_client):
+        data = os.urandom(9 * 1024 * 1024)
+        s3_client.store_hashes = True
+        self.put(s3_client, 'foo', data)
+
+        with mock.patch.object(s3_client.boto, 'upload_fileobj') as upload_fileobj:
+            with mock.patch.object(
+                s3_client.boto, 'upload_part', wraps=s3_client.boto.upload_part,
+            ) as upload_part:
+                self.put(s3_client, 'foo', data + b'some new lines', timestamp=5000)
+
+        assert not upload_fileobj.called
+        assert upload_part.call_count == 1
+        assert upload_part.call_args[1]['Body'] == b'some new lines'
+        assert s3_client.get('foo').fp.read() == data + b'some new lines'
+
+    def test_modified_head(self, s3_client):
+        data = os.urandom(6 * 1024 * 1024)
+        self.put(s3_client, 'foo', data)
+
+        modified = b'x' + data[1:] + b'some new lines'
+        with mock.patch.object(s3_client.boto, 'upload_part_copy') as upload_part_copy:
+            self.put(s3_client, 'foo', modified)
+
+        assert not upload_part_copy.called
+        assert s3_client.get('foo').fp.read() == modified
+
+    def test_small_files(self, s3_client):
+        self.put(s3_client, 'foo', b'hello')
+        with mock.patch.object(s3_client.boto, 'head_object') as head_object:
+            self.put(s3_client, 'foo', b'hello world')
+
+        assert not head_object.called
+        assert s3_client.get('foo').fp.read() == b'hello world'
+
+    def test_not_seekable(self, s3_client):
+        data = os.urandom(6 * 1024 * 1024)
+        self.put(s3_client, 'foo', data)
+
+        sync_object = SyncObject(utils.InterruptedBytesIO(interrupt_at=1000), len(data) + 1, 4000)
+        assert s3_client.get_appended_object('foo', sync_object) is None
+
+    def test_aborted(self, s3_client):
+        data = os.urandom(6 * 1024 * 1024)
+        self.put(s3_client, 'foo', data)
+
+        with mock.patch.object(s3_client.boto, 'upload_part', side_effect=ValueError('Oops')):
+            with pytest.raises(ValueError):
+                self.put(s3_client, 'foo', data + b'more')
+
+        uploads = s3_client.boto.list_multipart_uploads(Bucket=s3_client.bucket)
+        assert uploads.get('Uploads', []) == []
+        assert s3_client.get('foo').fp.read() == data
+
+
+class TestResumablePut(object):
+    @pytest.fixture
+    def client(self, s3_client):
+        s3_client.RESUMABLE_THRESHOLD = 1
+        s3_client.RESUMABLE_PART_SIZE = 5 * 1024 * 1024
+        # upload one part at a time so interruptions happen at a known part
+        s3_client.transfer_options['max_concurrency'] = 1
+        return s3_client
+
+    def interrupt_upload(self, client, key, sync_object, after=1):
+        upload_part = client.boto.upload_part
+        calls = []
+
+        def side_effect(**kwargs):
+            if len(calls) == after:
+                raise KeyboardInterrupt()
+            calls.append(kwargs['PartNumber'])
+            return upload_part(**kwargs)
+
+        with mock.patch.object(client.boto, 'upload_part', side_effect=side_effect):
+            with pytest.raises(KeyboardInterrupt):
+                client.put(key, sync_object)
+
+    def test_put(self, client):
+        data = os.urandom(11 * 1024 * 1024)
+        client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000, hash='somehash'))
+
+        assert client.get('foo').fp.read() == data
+        assert client.get_hash('foo') == 'somehash'
+        assert client.uploads.get(client.get_uri('foo')) is None
+
+    def test_concurrent_parts(self, client):
+        client.transfer_options['max_concurrency'] = 3
+        data = os.urandom(11 * 1024 * 1024)
+        with mock.patch.object(
+            client.boto, 'upload_part', wraps=client.boto.upload_part,
+        ) as upload_part:
+            client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        assert sorted(c[1]['PartNumber'] for c in upload_part.call_args_list) == [1, 2, 3]
+        assert client.get('foo').fp.read() == data
+        assert client.uploads.get(client.get_uri('foo')) is None
+
+    def test_configured_part_size(self, client):
+        client.transfer_options['multipart_chunksize'] = 6 * 1024 * 1024
+        data = os.urandom(11 * 1024 * 1024)
+        with mock.patch.object(
+            client.boto, 'upload_part', wraps=client.boto.upload_part,
+        ) as upload_part:
+            client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        assert upload_part.call_count == 2
+        assert client.get('foo').fp.read() == data
+
+    def test_resume(self, client):
+        data = os.urandom(11 * 1024 * 1024)
+        self.interrupt_upload(client, 'foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        state = client.uploads.get(client.get_uri('foo'))
+        assert list(state['parts']) == ['1']
+
+        with mock.patch.object(
+            client.boto, 'upload_part', wraps=client.boto.upload_part,
+        ) as upload_part:
+            client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        assert [c[1]['PartNumber'] for c in upload_part.call_args_list] == [2, 3]
+        assert client.get('foo').fp.read() == data
+        assert client.uploads.get(client.get_uri('foo')) is None
+
+    def test_source_changed(self, client):
+        data = os.urandom(11 * 1024 * 1024)
+        self.interrupt_upload(client, 'foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        modified = os.urandom(11 * 1024 * 1024)
+        client.put('foo', SyncObject(io.BytesIO(modified), len(modified), 5000))
+
+        assert client.get('foo').fp.read() == modified
+        uploads = client.boto.list_multipart_uploads(Bucket=client.bucket)
+        assert uploads.get('Uploads', []) == []
+
+    def test_upload_no_longer_exists(self, client):
+        data = os.urandom(11 * 1024 * 1024)
+        self.interrupt_upload(client, 'foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        state = client.uploads.get(client.get_uri('foo'))
+        client.boto.abort_multipart_upload(
+            Bucket=client.bucket,
+            Key=os.path.join(client.prefix, 'foo'),
+            UploadId=state['upload_id'],
+        )
+
+        client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+        assert client.get('foo').fp.read() == data
+
+    def test_abort_abandoned_uploads(self, client):
+        data = os.urandom(11 * 1024 * 1024)
+        self.interrupt_upload(client, 'foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        client.boto.create_multipart_upload(Bucket=client.bucket, Key='outside/prefix')
+
+        # uploads are only checked once per client
+        client = s3.S3SyncClient(client.boto, client.bucket, client.prefix)
+        client.ABANDONED_UPLOAD_TIMEOUT = -60
+        client.abort_abandoned_uploads()
+
+        uploads = client.boto.list_multipart_uploads(Bucket=client.bucket)
+        assert [upload['Key'] for upload in uploads['Uploads']] == ['outside/prefix']
+        assert client.uploads.get(client.get_uri('foo')) is None
+
+
+class TestGetBotoClient(object):
+    @pytest.yield_fixture(autouse=True)
+    def boto_clients(self):
+        with mock.patch.dict(s3._boto_clients, clear=True):
+            yield s3._boto_clients
+
+    def test_shared(self):
+        client = s3.get_boto_client('key', 'secret', 'eu-west-2')
+        assert s3.get_boto_client('key', 'secret', 'eu-west-2') is client
+        assert s3.get_boto_client('key', 'secret', 'us-east-1') is not client
+        assert s3.get_boto_client('other', 'secret', 'eu-west-2') is not client
+
+    def test_pool_size(self, boto_clients):
+        client = s3.get_boto_client('key', 'secret', 'eu-west-2', max_pool_connections=2)
+        assert client.meta.config.max_pool_connections == 10
+
+        larger = s3.get_boto_client('key', 'secret', 'eu-west-2', max_pool_connections=32)
+        assert larger is not client
+        assert larger.meta.config.max_pool_connections == 32
+        assert boto_clients[('key', 'secret', 'eu-west-2')].session is not None
+
+        # smaller pools are satisfied by the larger client
+        assert s3.get_boto_client('key', 'secret', 'eu-west-2', max_pool_connections=16) is larger
+
+    def test_get_pool_size(self):
+        assert s3.get_pool_size({}) == 10
+        assert s3.get_pool_size({'download_concurrency': 16}) == 16
+        assert s3.get_pool_size({'copy_concurrency': 12, 'transfer': None}) == 12
+        assert s3.get_pool_size({'transfer': {'max_concurrency': 20}}) == 20
+
+
+class TestSmallPut(object):
+    def test_single_request(self, s3_client):
+        with mock.patch.object(
+            s3_client.boto, 'put_object', wraps=s3_client.boto.put_object,
+        ) as put_object, mock.patch.object(s3_client.boto, 'upload_fileobj') as upload_fileobj:
+            s3_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000, hash='somehash'))
+
+        assert upload_fileobj.call_count == 0
+        assert put_object.call_args[1]['ContentMD5'] == 'XUFAKrxLKna5cZ2REBfFkg=='
+        assert s3_client.get('foo').fp.read() == b'hello'
+        assert s3_client.get_hash('foo') == 'somehash'
+
+    def test_callback(self, s3_client):
+        callback = mock.MagicMock()
+        s3_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000), callback=callback)
+        callback.assert_called_once_with(5)
+
+    def test_large_file(self, s3_client):
+        s3_client.put_object_threshold = 10
+        with mock.patch.object(
+            s3_client.boto, 'upload_fileobj', wraps=s3_client.boto.upload_fileobj,
+        ) as upload_fileobj:
+            s3_client.put('foo', SyncObject(io.BytesIO(b'hello world'), 11, 4000))
+
+        assert upload_fileobj.call_count == 1
+        assert s3_client.get('foo').fp.read() == b'hello world'
+
+
+class TestBandwidth(object):
+    @pytest.yield_fixture
+    def bandwidth(self):
+        with mock.patch.object(transfer.bandwidth, 'upload') as upload:
+            with mock.patch.object(transfer.bandwidth, 'download') as download:
+                yield upload, download
+
+    def test_small_put(self, s3_client, bandwidth):
+        upload, download = bandwidth
+        s3_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000))
+        upload.assert_called_once_with(5)
+
+        assert s3_client.get('foo').fp.read() == b'hello'
+        download.assert_called_once_with(5)
+
+    def test_managed_put(self, s3_client, bandwidth):
+        upload, _ = bandwidth
+        s3_client.put_object_threshold = None
+        s3_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000))
+        assert sum(c[0][0] for c in upload.call_args_list) == 5
+
+    def test_ranged_get(self, s3_client, bandwidth):
+        _, download = bandwidth
+        s3_client.download_part_size = 1000
+        data = os.urandom(2500)
+        s3_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        assert s3_client.get('foo').fp.read() == data
+        assert sum(c[0][0] for c in download.call_args_list) == 2500
+
+
+class TestTransferOptions(object):
+    def test_unknown_option(self, s3_client):
+        with pytest.raises(ValueError):
+            s3.S3SyncClient(s3_client.boto, s3_client.bucket, s3_client.prefix, transfer={
+                'multipart_chunk_size': 10,
+            })
+
+    def test_static(self, s3_client):
+        client = s3.S3SyncClient(s3_client.boto, s3_client.bucket, s3_client.prefix, transfer={
+            'max_concurrency': 2,
+        })
+        assert client.tuner is None
+        assert client.get_transfer_options(1000) == {
+            'multipart_threshold': 8 * 1024 * 1024,
+            'multipart_chunksize': 8 * 1024 * 1024,
+            'max_concurrency': 2,
+        }
+
+    def test_put_uses_config(self, s3_client):
+        s3_client.put_object_threshold = None
+        s3_client.transfer_options['multipart_chunksize'] = 6 * 1024 * 1024
+        with mock.patch.object(
+            s3_client.boto, 'upload_fileobj', wraps=s3_client.boto.upload_fileobj,
+        ) as upload_fileobj:
+            s3_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000))
+
+        config = upload_fileobj.call_args[1]['Config']
+        assert config.multipart_chunksize == 6 * 1024 * 1024
+        assert s3_client.get('foo').fp.read() == b'hello'
+
+    def test_adaptive(self, s3_client):
+        client = s3.S3SyncClient(s3_client.boto, s3_client.bucket, s3_client.prefix, transfer={
+            'adaptive': True, 'max_concurrency': 3,
+        })
+        assert client.tuner.max_concurrency == 3
+
+        data = os.urandom(2 * 1024 * 1024)
+        client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+        assert client.tuner.get_stream_throughput() > 0
+        assert client.get_transfer_options(100 * 1024 * 1024)['max_concurrency'] == 3
+
+
+class TestRangedGet(object):
+    @pytest.fixture
+    def client(self, s3_client):
+        s3_client.download_part_size = 1000
+        s3_client.download_concurrency = 3
+        return s3_client
+
+    def test_small_object(self, client):
+        utils.set_s3_contents(client, 'foo', data='hello')
+        result = client.get('foo')
+        assert not isinstance(result.fp, s3.RangedReader)
+        assert result.total_size == 5
+        assert result.fp.read() == b'hello'
+
+    def test_empty_object(self, client):
+        utils.set_s3_contents(client, 'foo', data='')
+        result = client.get('foo')
+        assert result.total_size == 0
+        assert result.fp.read() == b''
+
+    def test_disabled(self, client):
+        client.download_part_size = None
+        data = os.urandom(5000)
+        client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        with mock.patch.object(client.boto, 'get_object', wraps=client.boto.get_object) as get:
+            result = client.get('foo')
+        assert 'Range' not in get.call_args[1]
+        assert result.fp.read() == data
+
+    def test_sequential_read(self, client):
+        data = os.urandom(5500)
+        client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        result = client.get('foo')
+        assert isinstance(result.fp, s3.RangedReader)
+        assert result.total_size == 5500
+        assert result.fp.read(10) == data[:10]
+        assert result.fp.read(2000) == data[10:2010]
+        assert result.fp.read() == data[2010:]
+        assert result.fp.read() == b''
+
+    def test_write_to(self, client, tmpdir):
+        data = os.urandom(5500)
+        client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+        result = client.get('foo')
+
+        callback = mock.MagicMock()
+        path = str(tmpdir.join('foo'))
+        with open(path, 'wb') as fp:
+            with mock.patch.object(client.boto, 'get_object', wraps=client.boto.get_object) as get:
+                result.fp.write_to(fp.fileno(), callback)
+
+        with open(path, 'rb') as fp:
+            assert fp.read() == data
+        assert sum(c[0][0] for c in callback.call_args_list) == 5500
+        assert sorted(c[1]['Range'] for c in get.call_args_list) == [
+            'bytes=1000-1999',
+            'bytes=2000-2999',
+            'bytes=3000-3999',
+            'bytes=4000-4999',
+            'bytes=5000-5499',
+        ]
+
+    def test_replaced_while_downloading(self, client):
+        data = os.urandom(5500)
+        client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+        result = client.get('foo')
+
+        utils.set_s3_contents(client, 'foo', data='something else' * 1000)
+        with pytest.raises(ClientError):
+            result.fp.read()
+
+
+class TestCopyFrom(object):
+    @pytest.fixture
+    def other_client(self, s3_client):
+        s3_client.boto.create_bucket(Bucket='otherbucket')
+        return s3.S3SyncClient(s3_client.boto, 'otherbucket', 'some/prefix')
+
+    def test_copy(self, s3_client, other_client):
+        other_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000, hash='somehash'))
+
+        assert s3_client.copy_from(other_client, 'foo') is True
+        result = s3_client.get('foo')
+        assert result.fp.read() == b'hello'
+        assert result.hash == 'somehash'
+
+    def test_multipart_copy(self, s3_client, other_client):
+        s3_client.MAX_COPY_PART_SIZE = 5 * 1024 * 1024
+        s3_client.COPY_PART_SIZE = 5 * 1024 * 1024
+        data = os.urandom(11 * 1024 * 1024)
+        other_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000, hash='somehash'))
+
+        with mock.patch.object(
+            s3_client.boto, 'upload_part_copy', wraps=s3_client.boto.upload_part_copy,
+        ) as upload_part_copy:
+            assert s3_client.copy_from(other_client, 'foo') is True
+
+        assert upload_part_copy.call_count == 3
+        result = s3_client.get('foo')
+        assert result.fp.read() == data
+        assert result.hash == 'somehash'
+
+    def test_other_clients(self, s3_client, local_client):
+        utils.set_local_contents(local_client, 'foo', data='hello')
+        assert s3_client.copy_from(local_client, 'foo') is False
+
+    def test_non_existant(self, s3_client, other_client):
+        assert s3_client.copy_from(other_client, 'foo') is False
+
+    def test_chunked(self, s3_client, other_client):
+        other_client.chunker = s3.chunking_module.Chunker(64, 256, 1024)
+        other_client.chunk_threshold = 100
+        data = os.urandom(1000)
+        other_client.put('foo', SyncObject(io.BytesIO(data), len(data), 4000))
+
+        assert s3_client.copy_from(other_client, 'foo') is False
+
+    def test_access_denied(self, s3_client, other_client):
+        other_client.put('foo', SyncObject(io.BytesIO(b'hello'), 5, 4000))
+        error = ClientError({'Error': {'Code': 'AccessDenied'}}, 'CopyObject')
+        with mock.patch.object(s3_client.boto, 'copy_object', side_effect=error):
+            assert s3_client.copy_from(other_client, 'foo') is False
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 import shutil
 import tempfile
 
@@ -7,6 +8,8 @@ import boto3
 
 from faker import Faker
 
+import mock
+
 import moto
 
 import pytest
@@ -16,6 +19,20 @@ from s4.clients.s3 import S3SyncClient
 
 fake = Faker()
 
+# moto does not decode the aws-chunked bodies newer botocore versions send for upload_part
+os.environ.setdefault('AWS_REQUEST_CHECKSUM_CALCULATION', 'when_required')
+
+
+@pytest.yield_fixture(autouse=True)
+def state_folder():
+    # never write state into the home folder of whoever is running the tests
+    folder = tempfile.mkdtemp()
+    mocker = mock.patch('s4.utils.STATE_FOLDER_PATH', folder)
+    mocker.start()
+    yield folder
+    mocker.stop()
+    shutil.rmtree(folder)
+
 
 @pytest.yield_fixture
 def local_client():
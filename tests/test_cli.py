@@ -2,10 +2,12 @@
 
 import argparse
 import io
+import itertools
 import json
 import logging
 import os
 import tempfile
+import threading
 from datetime import datetime
 
 from inotify_simple import flags, Event
@@ -14,6 +16,10 @@ import pytest
 import pytz
 
 from s4 import cli
+from s4 import daemon
+from s4 import transfer
+from s4 import utils as utils_module
+from s4.clients import local, s3
 from s4.utils import to_timestamp
 from tests import utils
 
@@ -91,6 +97,71 @@ class TestINotifyRecursive(object):
         assert result_2[events[2].wd] == str(baz)
 
 
+class TestGetNotifier(object):
+    def test_inotify(self):
+        args = argparse.Namespace(watcher='inotify', poll_interval=5)
+        assert isinstance(cli.get_notifier(args, ['/']), cli.INotifyRecursive)
+
+    def test_poll(self):
+        args = argparse.Namespace(watcher='poll', poll_interval=3)
+        notifier = cli.get_notifier(args, ['/'])
+        assert isinstance(notifier, daemon.PollingNotifier)
+        assert notifier.interval == 3
+
+    @mock.patch('s4.daemon.get_filesystem_type')
+    def test_auto(self, get_filesystem_type):
+        args = argparse.Namespace(watcher='auto', poll_interval=5)
+
+        get_filesystem_type.side_effect = ['ext4', 'nfs4']
+        assert isinstance(cli.get_notifier(args, ['/a', '/b']), daemon.PollingNotifier)
+
+        get_filesystem_type.side_effect = ['ext4', 'btrfs']
+        assert isinstance(cli.get_notifier(args, ['/a', '/b']), cli.INotifyRecursive)
+
+
+@mock.patch('s4.transfer.bandwidth')
+class TestSetBandwidthLimits(object):
+    def test_unlimited(self, bandwidth):
+        cli.set_bandwidth_limits({'targets': {}})
+        bandwidth.configure.assert_called_once_with(upload=None, download=None, schedule=())
+
+    def test_schedule(self, bandwidth):
+        schedule = [{'start': '09:00', 'end': '17:00', 'upload': 1000}]
+        cli.set_bandwidth_limits({'bandwidth': {'download': 5000, 'schedule': schedule}})
+        bandwidth.configure.assert_called_once_with(
+            upload=None, download=5000, schedule=schedule,
+        )
+
+
+class TestGetS3Options(object):
+    def test_empty(self):
+        assert cli.get_s3_options({}) == {}
+
+    def test_chunking(self):
+        assert cli.get_s3_options({'chunking': True}) == {'chunking': {}}
+        assert cli.get_s3_options({'chunking': False}) == {}
+        assert cli.get_s3_options({'chunking': {'threshold': 10}}) == {
+            'chunking': {'threshold': 10},
+        }
+
+    def test_downloads(self):
+        entry = {'download_part_size': 1000, 'download_concurrency': 2}
+        assert cli.get_s3_options(entry) == entry
+
+    def test_transfer(self):
+        entry = {'transfer': {'adaptive': True, 'max_concurrency': 4}}
+        assert cli.get_s3_options(entry) == entry
+
+    def test_put_object_threshold(self):
+        entry = {'put_object_threshold': None}
+        assert cli.get_s3_options(entry) == entry
+
+    def test_store_hashes(self):
+        assert cli.get_s3_options({'verify_hashes': True}) == {'store_hashes': True}
+        assert cli.get_s3_options({'detect_renames': True}) == {'store_hashes': True}
+        assert cli.get_s3_options({'verify_hashes': False}) == {}
+
+
 # TODO: Should catch KeyboardExceptions and raise them again
 class TestMain(object):
 
@@ -151,6 +222,11 @@ class TestMain(object):
         cli.main(['add'])
         assert add_command.call_count == 1
 
+    @mock.patch('s4.cli.gc_command')
+    def test_gc_command(self, gc_command):
+        cli.main(['gc', 'foo'])
+        assert gc_command.call_count == 1
+
 
 class TestGetConfigFile(object):
     @mock.patch('s4.cli.CONFIG_FILE_PATH', '/i/dont/exist')
@@ -185,7 +261,10 @@ class TestDaemonCommand(object):
 
     @pytest.mark.timeout(5)
     def test_no_targets(self, INotifyRecursive, SyncWorker, logger):
-        args = argparse.Namespace(targets=None, conflicts='ignore', read_delay=0)
+        args = argparse.Namespace(
+            targets=None, conflicts='ignore', read_delay=0, reconcile_interval=3600,
+            watcher='inotify', poll_interval=5, remote_interval=60,
+        )
         cli.daemon_command(args, {'targets': {}}, logger, terminator=self.single_term)
 
         assert get_stream_value(logger) == (
@@ -197,7 +276,10 @@ class TestDaemonCommand(object):
 
     @pytest.mark.timeout(5)
     def test_wrong_target(self, INotifyRecursive, SyncWorker, logger):
-        args = argparse.Namespace(targets=['foo'], conflicts='ignore', read_delay=0)
+        args = argparse.Namespace(
+            targets=['foo'], conflicts='ignore', read_delay=0, reconcile_interval=3600,
+            watcher='inotify', poll_interval=5, remote_interval=60,
+        )
         cli.daemon_command(args, {'targets': {'bar': {}}}, logger, terminator=self.single_term)
 
         assert get_stream_value(logger) == (
@@ -219,7 +301,10 @@ class TestDaemonCommand(object):
             }
         )
 
-        args = argparse.Namespace(targets=['foo'], conflicts='ignore', read_delay=0)
+        args = argparse.Namespace(
+            targets=['foo'], conflicts='ignore', read_delay=0, reconcile_interval=3600,
+            watcher='inotify', poll_interval=5, remote_interval=60,
+        )
         config = {
             'targets': {
                 'foo': {
@@ -236,18 +321,188 @@ class TestDaemonCommand(object):
 
         assert SyncWorker.call_count == 2
         assert INotifyRecursive.call_count == 1
+        assert SyncWorker.return_value.sync.call_args_list[-1] == mock.call(
+            conflict_choice='ignore', keys={'hello.txt', 'hoot/bar.txt'},
+        )
+
+    @pytest.mark.timeout(5)
+    def test_directory_event(self, INotifyRecursive, SyncWorker, logger):
+        INotifyRecursive.return_value = FakeINotify(
+            events=[
+                Event(wd=1, mask=flags.CREATE, cookie=None, name="hello.txt"),
+                Event(wd=1, mask=flags.CREATE | flags.ISDIR, cookie=None, name="new"),
+            ],
+            wd_map={1: '/home/jon/code/'},
+        )
+
+        args = argparse.Namespace(
+            targets=['foo'], conflicts='ignore', read_delay=0, reconcile_interval=3600,
+            watcher='inotify', poll_interval=5, remote_interval=60,
+        )
+        config = {
+            'targets': {
+                'foo': {
+                    'local_folder': '/home/jon/code',
+                    's3_uri': 's3://bucket/code',
+                    'aws_secret_access_key': '23232323',
+                    'aws_access_key_id': '########',
+                    'region_name': 'eu-west-2',
+                },
+            }
+        }
+        cli.daemon_command(args, config, logger, terminator=self.single_term)
+
+        # New directories result in a full sync rather than an incremental one
+        assert SyncWorker.call_count == 2
+        assert SyncWorker.return_value.sync.call_args_list[-1] == mock.call(
+            conflict_choice='ignore',
+        )
+
+    @pytest.mark.timeout(5)
+    @mock.patch('s4.utils.lower_io_priority')
+    def test_overflow_reconciliation(self, lower_io_priority, INotifyRecursive, SyncWorker, logger):
+        INotifyRecursive.return_value = FakeINotify(
+            events=[Event(wd=-1, mask=flags.Q_OVERFLOW, cookie=None, name="")],
+            wd_map={1: '/home/jon/code/'},
+        )
+
+        args = argparse.Namespace(
+            targets=['foo'], conflicts='ignore', read_delay=0, reconcile_interval=1,
+            watcher='inotify', poll_interval=5, remote_interval=60,
+        )
+        config = {
+            'targets': {
+                'foo': {
+                    'local_folder': '/home/jon/code',
+                    's3_uri': 's3://bucket/code',
+                    'aws_secret_access_key': '23232323',
+                    'aws_access_key_id': '########',
+                    'region_name': 'eu-west-2',
+                },
+            }
+        }
+        # every reading of the clock is 10 seconds after the previous one
+        with mock.patch('time.monotonic', side_effect=itertools.count(step=10)):
+            cli.daemon_command(args, config, logger, terminator=self.single_term)
+
+        assert SyncWorker.call_count == 2
+        assert lower_io_priority.call_count == 1
+
+    @pytest.mark.timeout(5)
+    @mock.patch('s4.utils.lower_io_priority')
+    def test_unwatched_target(self, lower_io_priority, INotifyRecursive, SyncWorker, logger):
+        INotifyRecursive.return_value = FakeINotify(events=[], wd_map={})
+
+        args = argparse.Namespace(
+            targets=['foo'], conflicts='ignore', read_delay=0, reconcile_interval=1,
+            watcher='inotify', poll_interval=5, remote_interval=60,
+        )
+        config = {
+            'targets': {
+                'foo': {
+                    'local_folder': 's3://bucket/code',
+                    's3_uri': 's3://replica/code',
+                    'aws_secret_access_key': '23232323',
+                    'aws_access_key_id': '########',
+                    'region_name': 'eu-west-2',
+                },
+            }
+        }
+        with mock.patch('time.monotonic', side_effect=itertools.count(step=10)):
+            cli.daemon_command(args, config, logger, terminator=self.single_term)
+
+        # nothing can be watched, so it is synced again every reconciliation interval
+        assert SyncWorker.call_count == 2
+        assert lower_io_priority.call_count == 1
+
+    @pytest.mark.timeout(5)
+    @mock.patch('s4.utils.lower_io_priority')
+    @mock.patch('s4.cli.get_client')
+    def test_remote_change(
+        self, get_client, lower_io_priority, INotifyRecursive, SyncWorker, logger,
+    ):
+        INotifyRecursive.return_value = FakeINotify(events=[], wd_map={})
+        SyncWorker.return_value.client_2.get_synced_fingerprint.return_value = '"etag-1"'
+        # another machine synced since
+        get_client.return_value.get_fingerprint.return_value = '"etag-2"'
+
+        args = argparse.Namespace(
+            targets=['foo'], conflicts='ignore', read_delay=0, reconcile_interval=3600,
+            watcher='inotify', poll_interval=5, remote_interval=60,
+        )
+        config = {
+            'targets': {
+                'foo': {
+                    'local_folder': '/home/jon/code',
+                    's3_uri': 's3://bucket/code',
+                    'aws_secret_access_key': '23232323',
+                    'aws_access_key_id': '########',
+                    'region_name': 'eu-west-2',
+                },
+            }
+        }
+        with mock.patch('time.monotonic', side_effect=itertools.count(step=100)):
+            cli.daemon_command(args, config, logger, terminator=self.single_term)
+
+        assert SyncWorker.call_count == 2
+        assert lower_io_priority.call_count == 1
+        assert get_client.return_value.get_fingerprint.call_count == 1
+
+
+class TestGetClients(object):
+    def test_local_and_s3(self):
+        client_1, client_2 = cli.get_clients({
+            'local_folder': '/home/jon/code',
+            's3_uri': 's3://bucket/code',
+            'aws_secret_access_key': '23232323',
+            'aws_access_key_id': '########',
+            'region_name': 'eu-west-2',
+        })
+        assert isinstance(client_1, local.LocalSyncClient)
+        assert client_1.path == '/home/jon/code/'
+        assert isinstance(client_2, s3.S3SyncClient)
+        assert client_2.prefix == 'code/'
+
+    def test_s3_and_s3(self):
+        client_1, client_2 = cli.get_clients({
+            'local_folder': 's3://bucket/code',
+            's3_uri': 's3://replica/backup',
+            'aws_secret_access_key': '23232323',
+            'aws_access_key_id': '########',
+            'region_name': 'eu-west-2',
+        })
+        assert isinstance(client_1, s3.S3SyncClient)
+        assert (client_1.bucket, client_1.prefix) == ('bucket', 'code/')
+        assert isinstance(client_2, s3.S3SyncClient)
+        assert (client_2.bucket, client_2.prefix) == ('replica', 'backup/')
+        assert client_1.boto is client_2.boto
+
+    @mock.patch.dict('s4.clients.s3._boto_clients', clear=True)
+    def test_pool_size_follows_jobs(self):
+        _, client = cli.get_clients({
+            'local_folder': '/home/jon/code',
+            's3_uri': 's3://bucket/code',
+            'aws_secret_access_key': '23232323',
+            'aws_access_key_id': '########',
+            'region_name': 'eu-west-2',
+            'jobs': 4,
+            'download_concurrency': 8,
+        })
+        config = client.boto.meta.config
+        assert config.max_pool_connections == 40
+        assert config.retries['mode'] == 'adaptive'
 
 
 @mock.patch('s4.sync.SyncWorker')
 class TestSyncCommand(object):
     def test_no_targets(self, SyncWorker, logger):
-        args = argparse.Namespace(targets=None, conflicts=None)
+        args = argparse.Namespace(targets=None, conflicts=None, parallel=1)
         cli.sync_command(args, {'targets': {}}, logger)
         assert get_stream_value(logger) == ''
         assert SyncWorker.call_count == 0
 
     def test_wrong_target(self, SyncWorker, logger):
-        args = argparse.Namespace(targets=['foo', 'bar'], conflicts=None)
+        args = argparse.Namespace(targets=['foo', 'bar'], conflicts=None, parallel=1)
         cli.sync_command(args, {'targets': {'baz': {}}}, logger)
         assert get_stream_value(logger) == (
             '"bar" is an unknown target. Choices are: [\'baz\']\n'
@@ -256,7 +511,7 @@ class TestSyncCommand(object):
         assert SyncWorker.call_count == 0
 
     def test_sync_error(self, SyncWorker, logger):
-        args = argparse.Namespace(targets=None, conflicts=None, log_level="INFO")
+        args = argparse.Namespace(targets=None, conflicts=None, log_level="INFO", parallel=1)
         config = {
             'targets': {
                 'foo': {
@@ -285,7 +540,7 @@ class TestSyncCommand(object):
         )
 
     def test_sync_error_debug(self, SyncWorker, logger):
-        args = argparse.Namespace(targets=None, conflicts=None, log_level="DEBUG")
+        args = argparse.Namespace(targets=None, conflicts=None, log_level="DEBUG", parallel=1)
         config = {
             'targets': {
                 'bar': {
@@ -309,7 +564,7 @@ class TestSyncCommand(object):
 
 
     def test_keyboard_interrupt(self, SyncWorker, logger):
-        args = argparse.Namespace(targets=None, conflicts=None)
+        args = argparse.Namespace(targets=None, conflicts=None, parallel=1)
         config = {
             'targets': {
                 'foo': {
@@ -337,7 +592,7 @@ class TestSyncCommand(object):
         )
 
     def test_all_targets(self, SyncWorker, logger):
-        args = argparse.Namespace(targets=None, conflicts=None)
+        args = argparse.Namespace(targets=None, conflicts=None, parallel=1)
         config = {
             'targets': {
                 'foo': {
@@ -364,6 +619,76 @@ class TestSyncCommand(object):
         )
         assert SyncWorker.call_count == 2
 
+    @mock.patch('s4.transfer.job_budget', new_callable=transfer.JobBudget)
+    def test_parallel(self, job_budget, SyncWorker, logger):
+        args = argparse.Namespace(
+            targets=None, conflicts=None, log_level="INFO", parallel=2, total_jobs=3,
+        )
+        config = {
+            'targets': {
+                'foo': {
+                    'local_folder': '/home/mike/docs',
+                    's3_uri': 's3://foobar/docs',
+                    'aws_access_key_id': '3223323',
+                    'aws_secret_access_key': '23#@423#@',
+                    'region_name': 'us-east-1',
+                },
+                'bar': {
+                    'local_folder': '/home/mike/barmil',
+                    's3_uri': 's3://foobar/barrel',
+                    'aws_access_key_id': '3223',
+                    'aws_secret_access_key': '23#eWEa@423#@',
+                    'region_name': 'us-west-2',
+                }
+            }
+        }
+        # both targets have to be syncing at the same time for either to finish
+        barrier = threading.Barrier(2, timeout=5)
+
+        def get_worker(client_1, client_2, show_progress, **kwargs):
+            assert not show_progress
+
+            def sync(conflict_choice):
+                logger.info('%s started', client_1.get_uri())
+                barrier.wait()
+                # messages of the threads a target hands work to are grouped with it
+                with utils_module.ThreadPoolExecutor(2) as executor:
+                    executor.submit(logger.info, '%s working', client_1.get_uri()).result()
+                logger.info('%s done (%s)', client_1.get_uri(), conflict_choice)
+                if 'barmil' in client_1.get_uri():
+                    raise ValueError('something bad happened')
+            return mock.Mock(sync=sync)
+
+        SyncWorker.side_effect = get_worker
+
+        cli.sync_command(args, config, logger)
+        assert SyncWorker.call_count == 2
+        assert job_budget.limit == 3
+
+        lines = get_stream_value(logger).split('\n')
+        assert lines[0] == 'Skipping conflicts, use --conflicts to resolve them'
+
+        # the messages of each target are shown together
+        bar = lines.index('Syncing bar [/home/mike/barmil/ <=> s3://foobar/barrel/]')
+        assert lines[bar + 1:bar + 5] == [
+            '/home/mike/barmil/ started',
+            '/home/mike/barmil/ working',
+            '/home/mike/barmil/ done (ignore)',
+            "There was an error syncing 'bar': something bad happened",
+        ]
+        foo = lines.index('Syncing foo [/home/mike/docs/ <=> s3://foobar/docs/]')
+        assert lines[foo + 1:foo + 4] == [
+            '/home/mike/docs/ started',
+            '/home/mike/docs/ working',
+            '/home/mike/docs/ done (ignore)',
+        ]
+
+        summary = lines[10:]
+        assert summary[0] == ''
+        assert summary[3].split()[:2] == ['bar', 'failed']
+        assert summary[4].split()[:2] == ['foo', 'synced']
+        assert summary[5].startswith('Synced 2 targets in ')
+
 
 @mock.patch('s4.utils.get_input')
 class TestEditCommand(object):
@@ -741,3 +1066,42 @@ class TestRemoveCommand(object):
 
         expected_config = {'targets': {'bar': {}}}
         assert new_config == expected_config
+
+
+class TestGcCommand(object):
+    def test_empty(self, logger):
+        args = argparse.Namespace(target='foo')
+        cli.gc_command(args, {}, logger)
+        assert get_stream_value(logger) == 'You have not added any targets yet\n'
+
+    def test_missing(self, logger):
+        args = argparse.Namespace(target='foo')
+        cli.gc_command(args, {'targets': {'bar': {}}}, logger)
+
+        expected_output = (
+            '"foo" is an unknown target\n'
+            'Choices are: [\'bar\']\n'
+        )
+        assert get_stream_value(logger) == expected_output
+
+    @mock.patch('s4.clients.s3.S3SyncClient.delete_unreferenced_chunks')
+    def test_delete(self, delete_unreferenced_chunks, s3_client, local_client, logger):
+        delete_unreferenced_chunks.return_value = [{'Size': 10}, {'Size': 5}]
+        config = {
+            'targets': {
+                'foo': {
+                    'local_folder': local_client.get_uri(),
+                    's3_uri': s3_client.get_uri(),
+                    'aws_access_key_id': '',
+                    'aws_secret_access_key': '',
+                    'region_name': 'eu-west-2',
+                }
+            }
+        }
+        cli.gc_command(argparse.Namespace(target='foo'), config, logger)
+
+        assert delete_unreferenced_chunks.call_count == 1
+        expected_output = 'Deleted 2 unreferenced chunks (15 bytes) from {}\n'.format(
+            s3_client.get_uri(),
+        )
+        assert get_stream_value(logger) == expected_output
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from inotify_simple import flags
+
+import mock
+
+from s4 import daemon
+
+
+class FakeClock(object):
+    def __init__(self, now=0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestReconciliationPolicy(object):
+    def test_repr(self):
+        assert repr(daemon.ReconciliationPolicy(60)) == 'ReconciliationPolicy<interval=60>'
+
+    def test_not_due_before_interval(self):
+        clock = FakeClock()
+        policy = daemon.ReconciliationPolicy(60, clock=clock)
+        policy.add_target('foo')
+        policy.mark_dirty('foo', daemon.ReconciliationPolicy.OVERFLOW)
+
+        clock.now = 59
+        assert policy.get_due_targets() == []
+        assert policy.get_timeout() == 1000
+
+    def test_skipped_when_nothing_missed(self):
+        clock = FakeClock()
+        policy = daemon.ReconciliationPolicy(60, clock=clock)
+        policy.add_target('foo')
+
+        clock.now = 61
+        assert policy.get_due_targets() == []
+        # timer is reset after skipping
+        assert policy.get_timeout() == 60000
+
+    def test_due_when_dirty(self):
+        clock = FakeClock()
+        policy = daemon.ReconciliationPolicy(60, clock=clock)
+        policy.add_target('foo')
+        policy.add_target('bar')
+        policy.mark_all_dirty(daemon.ReconciliationPolicy.OVERFLOW)
+        policy.mark_dirty('bar', daemon.ReconciliationPolicy.ERROR)
+
+        assert policy.get_reasons('bar') == {'overflow', 'error'}
+
+        clock.now = 60
+        assert policy.get_due_targets() == ['bar', 'foo']
+
+        policy.reconciled('foo')
+        assert not policy.is_dirty('foo')
+        assert policy.is_dirty('bar')
+
+    def test_remote_change(self):
+        clock = FakeClock()
+        policy = daemon.ReconciliationPolicy(3600, clock=clock, remote_interval=60)
+        policy.add_target('foo')
+        policy.synced('foo', '"abc"')
+        fingerprints = {'foo': '"abc"'}
+
+        clock.now = 30
+        assert policy.get_due_targets(fingerprints.get) == []
+        assert policy.get_timeout() == 30000
+
+        clock.now = 60
+        assert policy.get_due_targets(fingerprints.get) == []
+
+        # changed by another machine
+        fingerprints['foo'] = '"def"'
+        clock.now = 120
+        assert policy.get_due_targets(fingerprints.get) == ['foo']
+        assert policy.get_reasons('foo') == {'remote'}
+
+    def test_dirty_target_not_checked_remotely(self):
+        clock = FakeClock()
+        policy = daemon.ReconciliationPolicy(3600, clock=clock, remote_interval=60)
+        policy.add_target('foo')
+        policy.mark_dirty('foo', daemon.ReconciliationPolicy.ERROR)
+
+        clock.now = 61
+        assert policy.get_due_targets(lambda target: '"abc"') == []
+        # waits for the reconciliation instead of spinning on the remote check
+        assert policy.get_timeout() == 3539000
+
+        clock.now = 3600
+        assert policy.get_due_targets(lambda target: '"abc"') == ['foo']
+        policy.reconciled('foo')
+        assert policy.get_timeout() == 60000
+
+    def test_remote_checked_when_due(self):
+        clock = FakeClock()
+        policy = daemon.ReconciliationPolicy(60, clock=clock)
+        policy.add_target('foo')
+        policy.synced('foo', '"abc"')
+
+        clock.now = 60
+        assert policy.get_due_targets(lambda target: '"def"') == ['foo']
+
+        # an unknown fingerprint is no reason to reconcile
+        policy.reconciled('foo')
+        clock.now = 120
+        assert policy.get_due_targets(lambda target: None) == []
+
+    def test_failure_backoff(self):
+        clock = FakeClock()
+        policy = daemon.ReconciliationPolicy(3600, clock=clock, retry_interval=60)
+        policy.add_target('foo')
+        policy.mark_dirty('foo', daemon.ReconciliationPolicy.ERROR)
+
+        policy.failed('foo')
+        assert policy.get_timeout() == 60000
+
+        clock.now = 60
+        assert policy.get_due_targets() == ['foo']
+        policy.failed('foo')
+        assert policy.get_timeout() == 120000
+
+        policy.reconciled('foo')
+        policy.mark_dirty('foo', daemon.ReconciliationPolicy.ERROR)
+        policy.failed('foo')
+        assert policy.get_timeout() == 60000
+
+    def test_disabled(self):
+        policy = daemon.ReconciliationPolicy(0)
+        policy.add_target('foo')
+        policy.mark_dirty('foo', daemon.ReconciliationPolicy.OVERFLOW)
+        assert policy.get_due_targets() == []
+        assert policy.get_timeout() is None
+
+
+class TestGetFilesystemType(object):
+    def test_longest_mount_point(self, tmpdir):
+        mounts = tmpdir.join('mounts')
+        mounts.write(
+            'overlay / overlay rw 0 0\n'
+            'server:/export /mnt/nfs nfs4 rw 0 0\n'
+            'server:/other /mnt/nfs\\040share nfs rw 0 0\n'
+        )
+        assert daemon.get_filesystem_type('/home/foo', str(mounts)) == 'overlay'
+        assert daemon.get_filesystem_type('/mnt/nfs/foo/bar', str(mounts)) == 'nfs4'
+        assert daemon.get_filesystem_type('/mnt/nfs share/bar', str(mounts)) == 'nfs'
+        assert daemon.get_filesystem_type('/mnt/nfsfoo', str(mounts)) == 'overlay'
+
+    def test_missing_mounts(self):
+        assert daemon.get_filesystem_type('/', '/i/dont/exist') is None
+
+
+def set_mtime(path, offset):
+    # move the mtime far enough into the past to not be considered racy
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns - offset))
+
+
+class TestPollingNotifier(object):
+    def test_add_watches(self, tmpdir):
+        tmpdir.mkdir('foo').mkdir('bar')
+        tmpdir.join('hello.txt').write('hello')
+
+        notifier = daemon.PollingNotifier()
+        result = notifier.add_watches(str(tmpdir).encode('utf8'))
+        assert sorted(result.values()) == sorted([
+            str(tmpdir), str(tmpdir.join('foo')), str(tmpdir.join('foo', 'bar')),
+        ])
+        assert notifier.poll() == []
+
+    def test_events(self, tmpdir):
+        foo = tmpdir.mkdir('foo')
+        foo.mkdir('old')
+        tmpdir.join('hello.txt').write('hello')
+        tmpdir.join('deleteme.txt').write('bye')
+
+        notifier = daemon.PollingNotifier()
+        result = notifier.add_watches(str(tmpdir))
+        wds = {path: wd for wd, path in result.items()}
+
+        tmpdir.join('deleteme.txt').remove()
+        tmpdir.join('new.txt').write('new')
+        foo.join('old').remove()
+        foo.mkdir('new')
+
+        events = notifier.poll()
+        actual = sorted((event.wd, event.mask, event.name) for event in events)
+        assert actual == sorted([
+            (wds[str(tmpdir)], flags.DELETE, 'deleteme.txt'),
+            (wds[str(tmpdir)], flags.CREATE, 'new.txt'),
+            (wds[str(foo)], flags.DELETE | flags.ISDIR, 'old'),
+            (wds[str(foo)], flags.CREATE | flags.ISDIR, 'new'),
+        ])
+        # removed directories are no longer watched
+        assert str(foo.join('old')) not in notifier._snapshots
+
+    def test_modified_in_unchanged_directory(self, tmpdir):
+        tmpdir.join('hello.txt').write('hello')
+        set_mtime(str(tmpdir), 10 * 10**9)
+
+        notifier = daemon.PollingNotifier()
+        wd = notifier.add_watch(str(tmpdir))
+
+        tmpdir.join('hello.txt').write('hello world')
+        set_mtime(str(tmpdir), 0)
+
+        events = notifier.poll()
+        assert [(e.wd, e.mask, e.name) for e in events] == [(wd, flags.MODIFY, 'hello.txt')]
+        assert notifier.poll() == []
+
+    def test_unchanged_directories_not_listed(self, tmpdir):
+        tmpdir.mkdir('foo').join('bar.txt').write('bar')
+        for path in (str(tmpdir.join('foo')), str(tmpdir)):
+            set_mtime(path, 10 * 10**9)
+
+        notifier = daemon.PollingNotifier(stat_batch=0)
+        notifier.add_watches(str(tmpdir))
+
+        with mock.patch('s4.daemon.scan_directory') as scan_directory:
+            assert notifier.poll() == []
+        assert scan_directory.call_count == 0
+
+    def test_read_timeout(self, tmpdir):
+        clock = FakeClock()
+
+        def sleep(seconds):
+            clock.now += seconds
+
+        set_mtime(str(tmpdir), 10 * 10**9)
+        notifier = daemon.PollingNotifier(interval=1, clock=clock, sleep=sleep)
+        notifier.add_watch(str(tmpdir))
+
+        assert notifier.read(timeout=2500) == []
+        assert clock.now == 2.5
@@ -1,11 +1,16 @@
 # -*- coding: utf-8 -*-
 
+import os
+import threading
+
+from botocore.exceptions import ClientError
+
 import mock
 
 import pytest
 
 from s4 import sync
-from s4.clients import SyncState, local, s3
+from s4.clients import SyncObject, SyncState, cache, local, s3
 from tests import utils
 
 
@@ -49,6 +54,51 @@ class TestGetStates(object):
         actual_output = list(worker.get_states())
         assert actual_output == []
 
+    def test_specific_keys(self, s3_client, local_client):
+        utils.set_local_contents(local_client, 'foo', timestamp=1000)
+        utils.set_local_contents(local_client, 'bar', timestamp=2000)
+        utils.set_local_contents(local_client, '.index~', timestamp=2000)
+        utils.set_s3_contents(s3_client, 'baz', timestamp=3000)
+
+        worker = sync.SyncWorker(local_client, s3_client)
+        local_client.ignore_files.append('*~')
+        s3_client.ignore_files.append('*~')
+        actual_output = list(worker.get_states(keys=['foo', 'baz', '.index~']))
+        assert actual_output == [
+            (
+                'baz',
+                SyncState(SyncState.DOESNOTEXIST, None, None),
+                SyncState(SyncState.CREATED, 3000, None),
+            ),
+            (
+                'foo',
+                SyncState(SyncState.CREATED, 1000, None),
+                SyncState(SyncState.DOESNOTEXIST, None, None),
+            ),
+        ]
+
+    def test_scans_clients_concurrently(self):
+        # each scan waits for the other one, so this only finishes if they overlap
+        barrier = threading.Barrier(2, timeout=5)
+
+        def get_all_actions():
+            barrier.wait()
+            return {}
+
+        client_1 = mock.MagicMock(get_all_actions=get_all_actions)
+        client_2 = mock.MagicMock(get_all_actions=get_all_actions)
+
+        worker = sync.SyncWorker(client_1, client_2)
+        assert list(worker.get_states()) == []
+
+    def test_scan_error_is_raised(self, local_client):
+        s3_client = mock.MagicMock()
+        s3_client.get_all_actions.side_effect = ValueError('no listing')
+
+        worker = sync.SyncWorker(local_client, s3_client)
+        with pytest.raises(ValueError):
+            list(worker.get_states())
+
 
 class TestGetSyncStates(object):
     def test_empty(self, local_client, s3_client):
@@ -488,6 +538,205 @@ class TestIntegrations(object):
         assert_remote_timestamp(clients, 'foo', 7000)
 
 
+class TestFastPath(object):
+    def test_unchanged(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'foo', timestamp=1000)
+        utils.set_s3_contents(s3_client, 'bar', timestamp=2000, data='bar')
+
+        worker = sync.SyncWorker(local_client, s3_client, fast_path=True)
+        assert not worker.is_unchanged()
+        worker.sync()
+        assert worker.is_unchanged()
+
+        with mock.patch.object(worker, 'get_sync_states') as get_sync_states:
+            worker.sync()
+        assert get_sync_states.call_count == 0
+
+    def test_change_during_sync(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'foo', timestamp=1000)
+        utils.set_local_contents(local_client, 'bar', timestamp=1000)
+
+        worker = sync.SyncWorker(local_client, s3_client, fast_path=True)
+        move = worker.move
+
+        def editing_move(to_client, from_client, key, timestamp):
+            result = move(to_client, from_client, key, timestamp)
+            if key == 'foo':
+                # edited after it was planned but before the sync ended
+                utils.set_local_contents(local_client, 'bar', timestamp=3000, data='edited')
+            return result
+
+        with mock.patch.object(worker, 'move', side_effect=editing_move):
+            worker.sync()
+
+        assert not worker.is_unchanged()
+        worker.sync()
+        assert_contents([s3_client], 'bar', b'edited')
+        assert worker.is_unchanged()
+
+    def test_local_change(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'foo', timestamp=1000)
+
+        worker = sync.SyncWorker(local_client, s3_client, fast_path=True)
+        worker.sync()
+
+        utils.set_local_contents(local_client, 'foo', timestamp=3000, data='changed')
+        assert not worker.is_unchanged()
+        worker.sync()
+        assert_contents([s3_client], 'foo', b'changed')
+
+    def test_remote_change(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'foo', timestamp=1000)
+
+        worker = sync.SyncWorker(local_client, s3_client, fast_path=True)
+        worker.sync()
+
+        # another machine syncing rewrites the index
+        s3_client.set_remote_timestamp('bar', 5000)
+        s3_client.flush_index()
+        assert not worker.is_unchanged()
+
+    def test_save_fingerprints_locked(self, local_client, s3_client):
+        worker = sync.SyncWorker(local_client, s3_client, fast_path=True)
+        other = sync.SyncWorker(local_client, s3.S3SyncClient(
+            s3_client.boto, s3_client.bucket, 'other',
+        ), fast_path=True)
+        write = cache.write_json
+
+        def write_json(path, data):
+            # targets synced in parallel update the same file
+            assert cache.get_state_lock(path).locked()
+            write(path, data)
+
+        with mock.patch.object(cache, 'write_json', side_effect=write_json):
+            worker.save_fingerprints(['a', 'b'])
+            other.save_fingerprints(['c', 'd'])
+            worker.save_jobs(3)
+
+        assert worker.load_fingerprints() == ['a', 'b']
+        assert other.load_fingerprints() == ['c', 'd']
+        assert worker.load_jobs() == 3
+
+    def test_conflicts_disable_fast_path(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'foo', timestamp=2000)
+        utils.set_s3_contents(s3_client, 'foo', timestamp=3000)
+
+        worker = sync.SyncWorker(local_client, s3_client, fast_path=True)
+        worker.sync(conflict_choice='ignore')
+        assert worker.load_fingerprints() is None
+        assert not worker.is_unchanged()
+
+
+class TestVerifyHashes(object):
+    def test_touched_file_not_transferred(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'foo', timestamp=1000, data='hello')
+        utils.set_local_contents(local_client, 'bar', timestamp=1000, data='world')
+
+        worker = sync.SyncWorker(local_client, s3_client, verify_hashes=True)
+        worker.sync()
+
+        utils.set_local_contents(local_client, 'foo', timestamp=5000, data='hello')
+        utils.set_local_contents(local_client, 'bar', timestamp=5000, data='earth')
+
+        deferred_calls, unhandled_events = worker.get_sync_states()
+        assert deferred_calls == {
+            'foo': sync.DeferredFunction(
+                worker.touch_client, s3_client, local_client, 'foo', 5000
+            ),
+            'bar': sync.DeferredFunction(
+                worker.update_client, s3_client, local_client, 'bar', 5000
+            ),
+        }
+
+        with mock.patch.object(s3_client, 'put', wraps=s3_client.put) as put:
+            worker.sync()
+        assert put.call_count == 1
+
+        clients = [local_client, s3_client]
+        assert_remote_timestamp(clients, 'foo', 5000)
+        assert_contents(clients, 'bar', b'earth')
+        assert worker.get_sync_states() == ({}, {})
+
+    def test_identical_conflict_resolved(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'foo', timestamp=2000, data='same')
+        utils.set_s3_contents(s3_client, 'foo', timestamp=3000, data='same')
+        utils.set_local_contents(local_client, 'bar', timestamp=2000, data='this')
+        utils.set_s3_contents(s3_client, 'bar', timestamp=3000, data='that')
+
+        worker = sync.SyncWorker(local_client, s3_client, verify_hashes=True)
+        deferred_calls, unhandled_events = worker.get_sync_states()
+        assert deferred_calls == {
+            'foo': sync.DeferredFunction(
+                worker.touch_client, local_client, s3_client, 'foo', 3000
+            ),
+        }
+        assert list(unhandled_events) == ['bar']
+
+    def test_different_size_not_hashed(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'foo', timestamp=2000, data='short')
+        utils.set_s3_contents(s3_client, 'foo', timestamp=3000, data='much longer')
+
+        worker = sync.SyncWorker(local_client, s3_client)
+        with mock.patch.object(local_client, 'get_hash') as get_hash:
+            assert not worker.has_same_contents('foo')
+        assert get_hash.call_count == 0
+
+
+class TestDetectRenames(object):
+    def test_local_rename(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'photos/a.jpg', timestamp=1000, data='aaaa')
+        utils.set_local_contents(local_client, 'photos/b.jpg', timestamp=1000, data='bbbb')
+        utils.set_local_contents(local_client, 'empty', timestamp=1000)
+
+        worker = sync.SyncWorker(local_client, s3_client, detect_renames=True)
+        worker.sync()
+
+        os.rename(
+            os.path.join(local_client.path, 'photos'),
+            os.path.join(local_client.path, 'pictures'),
+        )
+        utils.set_local_contents(local_client, 'pictures/c.jpg', timestamp=3000, data='cccc')
+        os.rename(os.path.join(local_client.path, 'empty'), os.path.join(local_client.path, 'nil'))
+
+        deferred_calls, _ = worker.get_sync_states()
+        assert deferred_calls['pictures/a.jpg'] == sync.DeferredFunction(
+            worker.rename_client, s3_client, local_client,
+            'photos/a.jpg', 'pictures/a.jpg', 1000, 1000,
+        )
+        assert deferred_calls['pictures/c.jpg'].func == worker.create_client
+        # empty files are never paired up
+        assert deferred_calls['nil'].func == worker.create_client
+        assert deferred_calls['empty'].func == worker.delete_client
+        assert 'photos/a.jpg' not in deferred_calls
+
+        with mock.patch.object(s3_client, 'put', wraps=s3_client.put) as put:
+            worker.sync()
+        assert put.call_count == 2
+
+        clients = [local_client, s3_client]
+        assert_local_keys(clients, ['pictures/a.jpg', 'pictures/b.jpg', 'pictures/c.jpg', 'nil'])
+        assert_contents(clients, 'pictures/a.jpg', b'aaaa')
+        assert_remote_timestamp(clients, 'pictures/a.jpg', 1000)
+        assert worker.get_sync_states() == ({}, {})
+
+    def test_remote_rename(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'a.jpg', timestamp=1000, data='aaaa')
+
+        worker = sync.SyncWorker(local_client, s3_client, detect_renames=True)
+        worker.sync()
+
+        s3_client.rename('a.jpg', 'b.jpg')
+
+        with mock.patch.object(local_client, 'put') as put:
+            worker.sync()
+        assert put.call_count == 0
+
+        clients = [local_client, s3_client]
+        assert_local_keys(clients, ['b.jpg'])
+        assert_contents(clients, 'b.jpg', b'aaaa')
+        assert worker.get_sync_states() == ({}, {})
+
+
 class TestRunDeferredCalls(object):
     def test_empty(self, local_client, s3_client):
         worker = sync.SyncWorker(local_client, s3_client)
@@ -514,6 +763,214 @@ class TestRunDeferredCalls(object):
         assert sorted(success) == sorted(['foo', 'baz'])
         assert_local_keys(clients, ['baz'])
 
+    def test_retries_throttled_calls(self, local_client, s3_client):
+        worker = sync.SyncWorker(local_client, s3_client)
+        utils.set_s3_contents(s3_client, 'baz', timestamp=2000, data='testing')
+
+        error = ClientError({
+            'Error': {'Code': 'SlowDown', 'Message': 'Please reduce your request rate.'},
+            'ResponseMetadata': {'HTTPStatusCode': 503},
+        }, 'GetObject')
+        get = mock.Mock(side_effect=[error, s3_client.get('baz')])
+        with mock.patch.object(s3_client, 'get', get), mock.patch('time.sleep'):
+            success = worker.run_deferred_calls({
+                'baz': sync.DeferredFunction(
+                    worker.create_client, local_client, s3_client, 'baz', 20,
+                ),
+            })
+
+        assert success == ['baz']
+        assert get.call_count == 2
+        assert utils.get_local_contents(local_client, 'baz') == b'testing'
+
+    def test_concurrent_jobs(self, local_client, s3_client):
+        worker = sync.SyncWorker(local_client, s3_client, jobs=4)
+        keys = ['file{}'.format(i) for i in range(10)]
+        for key in keys:
+            utils.set_s3_contents(s3_client, key, timestamp=2000, data=key)
+
+        success = worker.run_deferred_calls({
+            key: sync.DeferredFunction(worker.create_client, local_client, s3_client, key, 20)
+            for key in keys
+        })
+        assert sorted(success) == keys
+        for key in keys:
+            assert utils.get_local_contents(local_client, key) == key.encode()
+            assert local_client.get_remote_timestamp(key) == 20
+
+
+class TestPipeline(object):
+    def test_sync(self, local_client, s3_client):
+        utils.set_s3_contents(s3_client, 'colors/cream', 9999, '#ddeeff')
+        utils.set_local_contents(local_client, 'colors/red', 5000, '#ff0000')
+        utils.set_local_contents(local_client, 'colors/green', 3000, '#00ff00')
+
+        worker = sync.SyncWorker(local_client, s3_client, pipeline=True)
+        with mock.patch.object(
+            worker, 'run_deferred_calls', wraps=worker.run_deferred_calls,
+        ) as run_deferred_calls:
+            worker.sync()
+
+        # everything was run while planning
+        assert run_deferred_calls.call_args[0][0] == {}
+
+        clients = [local_client, s3_client]
+        assert_local_keys(clients, ['colors/red', 'colors/green', 'colors/cream'])
+        assert_contents(clients, 'colors/red', b'#ff0000')
+        assert_contents(clients, 'colors/cream', b'#ddeeff')
+        assert_remote_timestamp(clients, 'colors/green', 3000)
+
+        # the index was flushed
+        reloaded = local.LocalSyncClient(local_client.path)
+        assert reloaded.get_remote_timestamp('colors/cream') == 9999
+
+    def test_transfers_start_while_listing(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'a', 4000, 'old')
+        utils.set_local_contents(local_client, 'b', 4000, 'b')
+        sync.SyncWorker(local_client, s3_client).sync()
+        utils.set_local_contents(local_client, 'a', 5000, 'new')
+
+        updated = threading.Event()
+        listed = []
+        put = s3_client.put
+        listing = s3_client.iter_real_local_timestamps
+
+        def put_and_notify(key, *args, **kwargs):
+            put(key, *args, **kwargs)
+            updated.set()
+
+        def slow_listing():
+            for key, timestamp in listing():
+                listed.append(key)
+                if key == 'b':
+                    # the S3 listing only goes on once the update of a was sent
+                    assert updated.wait(5)
+                yield key, timestamp
+
+        worker = sync.SyncWorker(local_client, s3_client, pipeline=True)
+        with mock.patch.object(s3_client, 'put', side_effect=put_and_notify), \
+                mock.patch.object(s3_client, 'iter_real_local_timestamps', slow_listing):
+            worker.sync()
+
+        assert listed == ['a', 'b']
+        assert_contents([local_client, s3_client], 'a', b'new')
+        assert_remote_timestamp([local_client, s3_client], 'a', 5000)
+
+    def test_listing_error(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'a', 4000, 'a')
+        worker = sync.SyncWorker(local_client, s3_client, pipeline=True)
+        with mock.patch.object(s3_client, 'iter_actions', side_effect=ValueError('oops')):
+            with pytest.raises(ValueError):
+                worker.sync()
+        assert s3_client.get_size('a') is None
+
+    def test_conflicts_run_at_the_end(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'foo', 4000, 'local')
+        utils.set_s3_contents(s3_client, 'foo', 5000, 'remote')
+        utils.set_local_contents(local_client, 'bar', 4000, 'bar')
+
+        worker = sync.SyncWorker(local_client, s3_client, pipeline=True)
+        with mock.patch.object(
+            worker, 'run_deferred_calls', wraps=worker.run_deferred_calls,
+        ) as run_deferred_calls:
+            worker.sync(conflict_choice='2')
+
+        assert list(run_deferred_calls.call_args[0][0]) == ['foo']
+        assert_contents([local_client, s3_client], 'foo', b'remote')
+        assert_contents([local_client, s3_client], 'bar', b'bar')
+
+    def test_later_passes_not_emitted(self, local_client, s3_client):
+        worker = sync.SyncWorker(
+            local_client, s3_client, verify_hashes=True, detect_renames=True,
+        )
+        create = sync.DeferredFunction(worker.create_client, s3_client, local_client, 'a', 1)
+        delete = sync.DeferredFunction(worker.delete_client, s3_client, 'a', 1)
+        update = sync.DeferredFunction(worker.update_client, s3_client, local_client, 'a', 1)
+
+        assert not worker.is_final('a', create, {})
+        assert not worker.is_final('a', delete, {})
+        assert not worker.is_final('a', update, {'a': None})
+        assert worker.is_final('a', update, {})
+
+    def test_planner_error(self, local_client, s3_client):
+        worker = sync.SyncWorker(local_client, s3_client, pipeline=True)
+        with mock.patch.object(worker, 'get_sync_states', side_effect=ValueError('oops')):
+            with pytest.raises(ValueError):
+                worker.run_pipelined()
+
+
+class TestTransferOrder(object):
+    def test_alphabetical(self, local_client, s3_client):
+        worker = sync.SyncWorker(local_client, s3_client)
+        with mock.patch.object(s3_client, 'get_size') as get_size:
+            keys, large_keys = worker.get_transfer_order({
+                'b': sync.DeferredFunction(worker.delete_client, local_client, 'b', 1000),
+                'a': sync.DeferredFunction(worker.delete_client, local_client, 'a', 1000),
+            })
+        assert keys == ['a', 'b']
+        assert large_keys == set()
+        assert not get_size.called
+
+    def test_invalid_policy(self, local_client, s3_client):
+        with pytest.raises(ValueError):
+            sync.SyncWorker(local_client, s3_client, scheduling='random')
+
+    def test_smallest_first(self, local_client, s3_client):
+        worker = sync.SyncWorker(
+            local_client, s3_client, scheduling='smallest', jobs=4, large_file_size=100,
+        )
+        utils.set_s3_contents(s3_client, 'big', timestamp=2000, data='x' * 200)
+        utils.set_s3_contents(s3_client, 'medium', timestamp=2000, data='x' * 50)
+        utils.set_s3_contents(s3_client, 'small', timestamp=2000, data='x')
+
+        deferred_calls = {
+            key: sync.DeferredFunction(worker.create_client, local_client, s3_client, key, 2000)
+            for key in ('big', 'medium', 'small')
+        }
+        deferred_calls['deleted'] = sync.DeferredFunction(
+            worker.delete_client, s3_client, 'deleted', 1000,
+        )
+        keys, large_keys = worker.get_transfer_order(deferred_calls)
+        assert keys == ['deleted', 'small', 'medium', 'big']
+        assert large_keys == {'big'}
+
+    def test_recent_first(self, local_client, s3_client):
+        worker = sync.SyncWorker(local_client, s3_client, scheduling='recent')
+        utils.set_local_contents(local_client, 'old', timestamp=1000)
+        utils.set_local_contents(local_client, 'new', timestamp=3000)
+
+        keys, large_keys = worker.get_transfer_order({
+            key: sync.DeferredFunction(
+                worker.create_client, s3_client, local_client, key, timestamp,
+            )
+            for key, timestamp in (('old', 1000), ('new', 3000))
+        })
+        assert keys == ['new', 'old']
+        assert large_keys == set()
+
+
+class TestJobs(object):
+    def test_no_tuning_by_default(self, local_client, s3_client):
+        worker = sync.SyncWorker(local_client, s3_client, jobs=3)
+        executor = worker.get_executor()
+        assert executor.tuner is None
+        assert executor.jobs == 3
+
+    def test_saved_per_target(self, local_client, local_client_2, s3_client):
+        worker = sync.SyncWorker(local_client, s3_client, jobs=2, max_jobs=8)
+        assert worker.get_executor().tuner.jobs == 2
+
+        utils.set_local_contents(local_client, 'foo')
+        worker.run_deferred_calls({
+            'foo': sync.DeferredFunction(worker.delete_client, local_client, 'foo', 1000),
+        })
+        assert worker.load_jobs() == 2
+
+        worker.save_jobs(6)
+        assert worker.get_executor().tuner.jobs == 6
+        other = sync.SyncWorker(local_client_2, s3_client, jobs=2, max_jobs=8)
+        assert other.get_executor().tuner.jobs == 2
+
 
 class TestMove(object):
     def test_correct_behaviour(self, local_client, s3_client):
@@ -530,3 +987,153 @@ class TestMove(object):
 
         assert utils.get_local_contents(local_client, 'art.txt') == b'swirly abstract objects'
         assert local_client.get_remote_timestamp('art.txt') == 6000
+
+    def test_closes_source_on_failure(self, local_client, s3_client):
+        sync_object = SyncObject(mock.MagicMock(), 23, 4000)
+
+        worker = sync.SyncWorker(local_client, s3_client)
+        with mock.patch.object(s3_client, 'get', return_value=sync_object):
+            with mock.patch.object(local_client, 'put', side_effect=IOError('disk full')):
+                with pytest.raises(IOError):
+                    worker.move(
+                        to_client=local_client,
+                        from_client=s3_client,
+                        key='art.txt',
+                        timestamp=6000,
+                    )
+
+        assert sync_object.fp.close.call_count == 1
+
+    def test_server_side_copy(self, s3_client):
+        s3_client.boto.create_bucket(Bucket='replicabucket')
+        replica_client = s3.S3SyncClient(s3_client.boto, 'replicabucket', 'replica')
+        utils.set_s3_contents(s3_client, 'art.txt', data='swirly abstract objects')
+
+        worker = sync.SyncWorker(replica_client, s3_client)
+
+        with mock.patch.object(s3_client, 'get') as get:
+            worker.move(
+                to_client=replica_client,
+                from_client=s3_client,
+                key='art.txt',
+                timestamp=6000,
+            )
+
+        assert not get.called
+        assert replica_client.get('art.txt').fp.read() == b'swirly abstract objects'
+        assert replica_client.get_remote_timestamp('art.txt') == 6000
+        assert s3_client.get_remote_timestamp('art.txt') == 6000
+
+
+class TestJournal(object):
+    def interrupt(self, worker, key):
+        move = worker.move
+
+        def interrupting_move(to_client, from_client, move_key, timestamp):
+            if move_key == key:
+                raise KeyboardInterrupt()
+            return move(to_client, from_client, move_key, timestamp)
+
+        return mock.patch.object(worker, 'move', side_effect=interrupting_move)
+
+    def reopen(self, local_client, s3_client):
+        # clients of a new process, with nothing but the stored state
+        return (
+            local.LocalSyncClient(local_client.path),
+            s3.S3SyncClient(s3_client.boto, s3_client.bucket, s3_client.prefix),
+        )
+
+    def test_resumes_interrupted_sync(self, local_client, s3_client):
+        for key, timestamp in (('a', 1000), ('b', 2000), ('c', 3000)):
+            utils.set_local_contents(local_client, key, timestamp=timestamp, data=key)
+
+        worker = sync.SyncWorker(local_client, s3_client)
+        with self.interrupt(worker, 'b'):
+            worker.sync()
+        assert worker.get_journal().exists()
+        assert_local_keys([s3_client], ['a'])
+
+        local_client, s3_client = self.reopen(local_client, s3_client)
+        worker = sync.SyncWorker(local_client, s3_client)
+        with mock.patch.object(worker, 'move', wraps=worker.move) as move:
+            with mock.patch.object(worker, 'get_sync_states') as get_sync_states:
+                worker.sync()
+
+        assert get_sync_states.call_count == 0
+        assert [call[0][2] for call in move.call_args_list] == ['b', 'c']
+        assert not worker.get_journal().exists()
+        clients = [local_client, s3_client]
+        assert_local_keys(clients, ['a', 'b', 'c'])
+        assert_remote_timestamp(clients, 'c', 3000)
+
+    def test_resumes_fractional_timestamps(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'a', timestamp=1000.5)
+        utils.set_local_contents(local_client, 'b', timestamp=2000.25)
+
+        worker = sync.SyncWorker(local_client, s3_client)
+        with self.interrupt(worker, 'b'):
+            worker.sync()
+
+        local_client, s3_client = self.reopen(local_client, s3_client)
+        worker = sync.SyncWorker(local_client, s3_client)
+        with mock.patch.object(worker, 'get_sync_states') as get_sync_states:
+            worker.sync()
+
+        assert get_sync_states.call_count == 0
+        assert_local_keys([s3_client], ['a', 'b'])
+        assert_remote_timestamp([local_client, s3_client], 'b', 2000)
+
+    def test_changed_file_is_planned_again(self, local_client, s3_client):
+        utils.set_local_contents(local_client, 'a', timestamp=1000)
+        utils.set_local_contents(local_client, 'b', timestamp=2000, data='old')
+
+        worker = sync.SyncWorker(local_client, s3_client)
+        with self.interrupt(worker, 'b'):
+            worker.sync()
+
+        utils.set_local_contents(local_client, 'b', timestamp=4000, data='new')
+        local_client, s3_client = self.reopen(local_client, s3_client)
+        worker = sync.SyncWorker(local_client, s3_client)
+        worker.sync()
+
+        assert not worker.get_journal().exists()
+        assert_contents([s3_client], 'b', b'new')
+        assert_remote_timestamp([local_client, s3_client], 'b', 4000)
+
+    def test_edited_file_is_not_deleted(self, local_client, local_client_2):
+        utils.set_local_contents(local_client, 'foo', timestamp=1000, data='old')
+        worker = sync.SyncWorker(local_client, local_client_2)
+        worker.sync()
+
+        utils.delete_local(local_client, 'foo')
+        worker = sync.SyncWorker(local_client, local_client_2)
+        with mock.patch.object(local_client_2, 'delete', side_effect=KeyboardInterrupt):
+            worker.sync()
+        assert worker.get_journal().exists()
+
+        utils.set_local_contents(local_client_2, 'foo', timestamp=4000, data='new')
+        local_client = local.LocalSyncClient(local_client.path)
+        local_client_2 = local.LocalSyncClient(local_client_2.path)
+        worker = sync.SyncWorker(local_client, local_client_2)
+        worker.sync(conflict_choice='X')
+
+        # deleted on one side and updated on the other is a conflict for the user
+        assert not worker.get_journal().exists()
+        assert_contents([local_client_2], 'foo', b'new')
+        assert_local_keys([local_client], [])
+
+    def test_checkpoints_index(self, local_client, s3_client):
+        for key in ('a', 'b', 'c'):
+            utils.set_local_contents(local_client, key, timestamp=1000)
+
+        worker = sync.SyncWorker(local_client, s3_client)
+        worker.CHECKPOINT_KEYS = 2
+        with mock.patch.object(s3_client, 'flush_index', wraps=s3_client.flush_index) as flush:
+            with self.interrupt(worker, 'c'):
+                worker.sync()
+
+        # once after two keys and once when interrupted
+        assert flush.call_count == 2
+        records = worker.get_journal().read()
+        assert [record['done'] for record in records if 'done' in record] == ['a', 'b']
+        assert {'planned': True} in records
@@ -0,0 +1,574 @@
+# -*- coding: utf-8 -*-
+import datetime
+import io
+import queue
+import threading
+import time
+
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+import mock
+
+import pytest
+
+from s4 import transfer
+
+MB = transfer.MB
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTransferTuner(object):
+    def test_repr(self):
+        assert repr(transfer.TransferTuner(4)) == 'TransferTuner<max_concurrency=4>'
+
+    def test_no_history(self):
+        tuner = transfer.TransferTuner(max_concurrency=4)
+        assert tuner.get_stream_throughput() is None
+        assert tuner.get_options(100 * MB) == {
+            'multipart_threshold': transfer.DEFAULT_MULTIPART_CHUNKSIZE,
+            'multipart_chunksize': transfer.DEFAULT_MULTIPART_CHUNKSIZE,
+            'max_concurrency': 4,
+        }
+
+    def test_ignores_small_samples(self):
+        tuner = transfer.TransferTuner(min_sample_size=MB)
+        tuner.record(1000, 1)
+        tuner.record(10 * MB, 0)
+        assert tuner.get_stream_throughput() is None
+
+    def test_stream_throughput(self):
+        tuner = transfer.TransferTuner()
+        tuner.record(10 * MB, 1, concurrency=1)
+        tuner.record(40 * MB, 1, concurrency=4)
+        assert tuner.get_stream_throughput() == 10 * MB
+
+    def test_fast_connection_uses_larger_parts(self):
+        tuner = transfer.TransferTuner(max_concurrency=4, part_seconds=5)
+        tuner.record(40 * MB, 1)
+        options = tuner.get_options(1000 * MB)
+        assert options['multipart_chunksize'] == 200 * MB
+        assert options['max_concurrency'] == 4
+
+    def test_splits_across_connections(self):
+        tuner = transfer.TransferTuner(max_concurrency=4)
+        tuner.record(100 * MB, 1)
+        options = tuner.get_options(40 * MB)
+        assert options['multipart_chunksize'] == 10 * MB
+        assert options['max_concurrency'] == 4
+
+    @pytest.mark.parametrize(['size', 'chunksize', 'concurrency'], [
+        (MB, 5 * MB, 1),
+        (12 * MB, 5 * MB, 3),
+        (100000 * 6 * MB, 60 * MB, 4),
+    ])
+    def test_limits(self, size, chunksize, concurrency):
+        tuner = transfer.TransferTuner(max_concurrency=4)
+        tuner.record(MB, 1)
+        options = tuner.get_options(size)
+        assert options['multipart_chunksize'] == chunksize
+        assert options['max_concurrency'] == concurrency
+
+
+class TestTransferTimer(object):
+    def test_records(self):
+        clock = FakeClock()
+        tuner = transfer.TransferTuner(clock=clock)
+        with transfer.TransferTimer(tuner, 10 * MB, 2):
+            clock.now = 2
+        assert tuner.get_stream_throughput() == 2.5 * MB
+
+    def test_failure_not_recorded(self):
+        tuner = transfer.TransferTuner()
+        with pytest.raises(ValueError):
+            with transfer.TransferTimer(tuner, 10 * MB):
+                raise ValueError()
+        assert tuner.get_stream_throughput() is None
+
+    def test_no_tuner(self):
+        with transfer.TransferTimer(None, 10 * MB):
+            pass
+
+
+def test_get_tuner():
+    tuner = transfer.get_tuner('s3://foo/bar/', 4)
+    assert transfer.get_tuner('s3://foo/bar/', 4) is tuner
+    assert transfer.get_tuner('s3://foo/bar/', 8) is not tuner
+    assert transfer.get_tuner('s3://foo/baz/', 8).max_concurrency == 8
+
+
+def get_client_error(code, status=400):
+    return ClientError({
+        'Error': {'Code': code, 'Message': ''},
+        'ResponseMetadata': {'HTTPStatusCode': status},
+    }, 'PutObject')
+
+
+@pytest.mark.parametrize(['error', 'throttling', 'retryable'], [
+    (get_client_error('SlowDown', 503), True, True),
+    (get_client_error('Unknown', 503), True, True),
+    (get_client_error('InternalError', 500), False, True),
+    (get_client_error('AccessDenied', 403), False, False),
+    (EndpointConnectionError(endpoint_url='http://example.com'), False, True),
+    (ValueError(), False, False),
+])
+def test_error_classification(error, throttling, retryable):
+    assert transfer.is_throttling_error(error) == throttling
+    assert transfer.is_retryable_error(error) == retryable
+
+
+class TestRateController(object):
+    def test_additive_increase(self):
+        controller = transfer.RateController(max_concurrency=8)
+        controller.concurrency = 2
+        controller.on_success()
+        controller.on_success()
+        assert controller.concurrency == pytest.approx(2.9, abs=0.05)
+
+        for _ in range(100):
+            controller.on_success()
+        assert controller.limit == 8
+
+    def test_multiplicative_decrease(self):
+        clock = FakeClock()
+        controller = transfer.RateController(max_concurrency=8, clock=clock)
+        for _ in range(11):
+            controller.acquire()
+            clock.now += 0.1
+
+        controller.on_throttle(started_at=clock.now)
+        assert controller.limit == 4
+        assert controller.rate == pytest.approx(5)
+
+    def test_throttles_of_earlier_transfers_ignored(self):
+        clock = FakeClock()
+        controller = transfer.RateController(max_concurrency=8, clock=clock)
+        clock.now = 10
+        controller.on_throttle(started_at=9)
+        controller.on_throttle(started_at=9)
+        assert controller.limit == 4
+
+        controller.on_throttle(started_at=11)
+        assert controller.limit == 2
+
+    def test_acquire_waits_for_rate(self):
+        clock = FakeClock()
+        sleep = mock.Mock(side_effect=lambda seconds: setattr(clock, 'now', clock.now + seconds))
+        controller = transfer.RateController(clock=clock, sleep=sleep)
+        controller.rate = 2
+
+        assert controller.acquire() == 0
+        assert controller.acquire() == 0.5
+        sleep.assert_called_once_with(0.5)
+
+
+class TestTransferExecutor(object):
+    @pytest.fixture
+    def executor(self):
+        executor = transfer.TransferExecutor(backoff_base=0, sleep=mock.Mock())
+        return executor
+
+    def test_inline_order(self, executor):
+        calls = []
+        assert executor.run(['b', 'a', 'c'], calls.append) == ['b', 'a', 'c']
+        assert calls == ['b', 'a', 'c']
+
+    def test_retries_throttled(self, executor):
+        failures = {'a': 2}
+
+        def func(key):
+            if failures.get(key):
+                failures[key] -= 1
+                raise get_client_error('SlowDown', 503)
+
+        on_error = mock.Mock()
+        assert sorted(executor.run(['a', 'b'], func, on_error=on_error)) == ['a', 'b']
+        assert failures == {'a': 0}
+        assert not on_error.called
+        assert executor.controller.rate is not None
+
+    def test_gives_up(self, executor):
+        executor.max_attempts = 3
+        func = mock.Mock(side_effect=get_client_error('SlowDown', 503))
+        on_error = mock.Mock()
+
+        assert executor.run(['a'], func, on_error=on_error) == []
+        assert func.call_count == 3
+        assert on_error.call_args[0][0] == 'a'
+
+    def test_error_not_retried(self, executor):
+        func = mock.Mock(side_effect=ValueError())
+        on_error = mock.Mock()
+        assert executor.run(['a'], func, on_error=on_error) == []
+        assert func.call_count == 1
+        assert on_error.call_count == 1
+
+    def test_keyboard_interrupt(self, executor):
+        func = mock.Mock(side_effect=KeyboardInterrupt())
+        with pytest.raises(KeyboardInterrupt):
+            executor.run(['a', 'b'], func)
+        assert func.call_count == 1
+
+    def test_concurrent(self):
+        executor = transfer.TransferExecutor(jobs=4)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def func(key):
+            with lock:
+                running.append(key)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(key)
+
+        on_success = mock.Mock()
+        keys = [str(i) for i in range(20)]
+        assert sorted(executor.run(keys, func, on_success=on_success)) == sorted(keys)
+        assert on_success.call_count == 20
+        assert 1 < max(peak) <= 4
+
+    @pytest.mark.parametrize('jobs', [1, 3])
+    def test_feed(self, jobs):
+        executor = transfer.TransferExecutor(jobs=jobs)
+        feed = queue.Queue()
+        calls = []
+
+        def producer():
+            for key in ('b', 'c'):
+                time.sleep(0.01)
+                feed.put(key)
+            feed.put(None)
+
+        thread = threading.Thread(target=producer)
+        thread.start()
+        success = executor.run(['a'], calls.append, feed=feed)
+        thread.join()
+
+        assert sorted(success) == ['a', 'b', 'c']
+        assert sorted(calls) == ['a', 'b', 'c']
+
+    def test_concurrent_keyboard_interrupt(self):
+        executor = transfer.TransferExecutor(jobs=2)
+        with pytest.raises(KeyboardInterrupt):
+            executor.run(['a'], mock.Mock(side_effect=KeyboardInterrupt()))
+
+    def test_shared_budget(self):
+        budget = transfer.JobBudget(limit=3)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def func(key):
+            with lock:
+                running.append(key)
+                peak.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(key)
+
+        # e.g. two targets synced in parallel
+        results = {}
+
+        def run(name):
+            executor = transfer.TransferExecutor(jobs=4, budget=budget)
+            keys = ['{}{}'.format(name, i) for i in range(10)]
+            results[name] = executor.run(keys, func)
+
+        threads = [threading.Thread(target=run, args=(name, )) for name in 'ab']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert len(results['a']) == len(results['b']) == 10
+        assert 1 < max(peak) <= 3
+        assert budget.in_flight == 0
+
+    def test_budget_released_on_error(self):
+        budget = transfer.JobBudget(limit=1)
+        executor = transfer.TransferExecutor(budget=budget)
+        with pytest.raises(KeyboardInterrupt):
+            executor.run(['a'], mock.Mock(side_effect=KeyboardInterrupt()))
+        assert executor.run(['b'], mock.Mock(side_effect=ValueError())) == []
+        assert budget.in_flight == 0
+
+
+class TestJobBudget(object):
+    def test_acquire(self):
+        budget = transfer.JobBudget(limit=2)
+        assert budget.acquire()
+        assert budget.acquire()
+        assert not budget.acquire()
+        budget.release()
+        assert budget.acquire()
+        assert repr(budget) == 'JobBudget<2/2>'
+
+    def test_unlimited(self):
+        budget = transfer.JobBudget()
+        assert all(budget.acquire() for _ in range(100))
+
+    def test_invalid_limit(self):
+        with pytest.raises(ValueError):
+            transfer.JobBudget().configure(0)
+
+
+class TestConcurrencyTuner(object):
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    def run_interval(self, tuner, clock, size, latency=1):
+        clock.now += tuner.interval
+        tuner.record(size, latency)
+        return tuner.jobs
+
+    def test_invalid_bounds(self):
+        with pytest.raises(ValueError):
+            transfer.ConcurrencyTuner(4, 2)
+
+    def test_starting_point(self):
+        assert transfer.ConcurrencyTuner(2, 8).jobs == 2
+        assert transfer.ConcurrencyTuner(2, 8, jobs=5).jobs == 5
+        assert transfer.ConcurrencyTuner(2, 8, jobs=50).jobs == 8
+
+    def test_climbs_while_throughput_improves(self, clock):
+        tuner = transfer.ConcurrencyTuner(1, 8, clock=clock)
+        assert self.run_interval(tuner, clock, 100) == 2
+        assert self.run_interval(tuner, clock, 200) == 3
+        assert self.run_interval(tuner, clock, 300) == 4
+
+    def test_turns_around_when_throughput_drops(self, clock):
+        tuner = transfer.ConcurrencyTuner(1, 8, jobs=4, clock=clock)
+        self.run_interval(tuner, clock, 400)
+        assert self.run_interval(tuner, clock, 300) == 4
+
+    def test_steps_down_when_only_latency_grows(self, clock):
+        tuner = transfer.ConcurrencyTuner(1, 8, jobs=4, clock=clock)
+        self.run_interval(tuner, clock, 400, latency=1)
+        assert self.run_interval(tuner, clock, 400, latency=2) == 4
+
+    def test_stays_within_bounds(self, clock):
+        tuner = transfer.ConcurrencyTuner(1, 2, clock=clock)
+        for size in range(100, 1000, 100):
+            assert 1 <= self.run_interval(tuner, clock, size) <= 2
+
+    def test_waits_for_interval(self, clock):
+        tuner = transfer.ConcurrencyTuner(1, 8, clock=clock)
+        tuner.record(100, 1)
+        assert tuner.jobs == 1
+
+    def test_executor_limit(self):
+        tuner = transfer.ConcurrencyTuner(1, 8, jobs=3)
+        executor = transfer.TransferExecutor(tuner=tuner)
+        assert executor.jobs == 8
+        assert executor.limit == 3
+
+
+class TestTokenBucket(object):
+    @pytest.fixture
+    def clock(self):
+        return FakeClock()
+
+    @pytest.fixture
+    def sleep(self, clock):
+        return mock.Mock(side_effect=lambda seconds: setattr(clock, 'now', clock.now + seconds))
+
+    def test_unlimited(self, clock, sleep):
+        bucket = transfer.TokenBucket(clock=clock, sleep=sleep)
+        bucket.consume(10 ** 12)
+        assert not sleep.called
+
+    def test_burst(self, clock, sleep):
+        bucket = transfer.TokenBucket(100, burst=1, clock=clock, sleep=sleep)
+        bucket.consume(100)
+        assert not sleep.called
+
+        bucket.consume(50)
+        sleep.assert_called_once_with(0.5)
+
+    def test_average_rate(self, clock, sleep):
+        bucket = transfer.TokenBucket(100, burst=1, clock=clock, sleep=sleep)
+        for _ in range(10):
+            bucket.consume(100)
+        assert clock.now == pytest.approx(9)
+
+    def test_refills_while_idle(self, clock, sleep):
+        bucket = transfer.TokenBucket(100, burst=1, clock=clock, sleep=sleep)
+        bucket.consume(100)
+        clock.now = 10
+        bucket.consume(100)
+        assert not sleep.called
+
+    def test_paused(self, clock, sleep):
+        bucket = transfer.TokenBucket(0, burst=1, clock=clock, sleep=sleep)
+        # e.g. another thread switching the schedule back to a limit
+        wait = mock.Mock(side_effect=lambda: bucket.set_rate(100))
+
+        bucket.consume(50, wait=wait)
+        assert wait.call_count == 1
+        assert not sleep.called
+
+    def test_paused_without_wait(self, clock, sleep):
+        bucket = transfer.TokenBucket(0, burst=1, clock=clock, sleep=sleep)
+        sleep.side_effect = lambda seconds: bucket.set_rate(None)
+
+        bucket.consume(50)
+        sleep.assert_called_once_with(1)
+
+
+class TestBandwidthWindow(object):
+    def test_contains(self):
+        window = transfer.BandwidthWindow('09:00', '17:30')
+        assert window.contains(datetime.datetime(2017, 1, 2, 9, 0))
+        assert window.contains(datetime.datetime(2017, 1, 2, 17, 29))
+        assert not window.contains(datetime.datetime(2017, 1, 2, 17, 30))
+        assert not window.contains(datetime.datetime(2017, 1, 2, 8, 59))
+
+    def test_days(self):
+        # Monday to Friday
+        window = transfer.BandwidthWindow('09:00', '17:00', days=[0, 1, 2, 3, 4])
+        assert window.contains(datetime.datetime(2017, 1, 6, 10, 0))
+        assert not window.contains(datetime.datetime(2017, 1, 7, 10, 0))
+
+    def test_spans_midnight(self):
+        window = transfer.BandwidthWindow('22:00', '06:00', days=[4])
+        assert window.contains(datetime.datetime(2017, 1, 6, 23, 0))
+        assert window.contains(datetime.datetime(2017, 1, 7, 5, 0))
+        assert not window.contains(datetime.datetime(2017, 1, 6, 5, 0))
+        assert not window.contains(datetime.datetime(2017, 1, 7, 12, 0))
+
+
+class TestBandwidthLimiter(object):
+    def test_defaults(self):
+        limiter = transfer.BandwidthLimiter()
+        limiter.configure(upload=1000)
+        assert limiter.uploads.rate == 1000
+        assert limiter.downloads.rate is None
+
+    def test_schedule(self):
+        clock = FakeClock()
+        now = mock.Mock(return_value=datetime.datetime(2017, 1, 2, 8, 0))
+        limiter = transfer.BandwidthLimiter(clock=clock, now=now, check_interval=60)
+        limiter.configure(upload=1000, schedule=[
+            {'start': '09:00', 'end': '17:00', 'upload': 10, 'download': 20},
+        ])
+        assert (limiter.uploads.rate, limiter.downloads.rate) == (1000, None)
+
+        now.return_value = datetime.datetime(2017, 1, 2, 9, 0)
+        limiter.upload(1)
+        assert limiter.uploads.rate == 1000
+
+        clock.now = 60
+        limiter.upload(1)
+        assert (limiter.uploads.rate, limiter.downloads.rate) == (10, 20)
+
+    def test_pause(self):
+        clock = FakeClock()
+        now = mock.Mock(return_value=datetime.datetime(2017, 1, 2, 9, 0))
+
+        def sleep(seconds):
+            clock.now += seconds
+            if clock.now >= 120:
+                now.return_value = datetime.datetime(2017, 1, 2, 17, 0)
+
+        limiter = transfer.BandwidthLimiter(clock=clock, now=now, sleep=sleep, check_interval=60)
+        limiter.configure(download=1000, schedule=[
+            {'start': '09:00', 'end': '17:00', 'upload': 0},
+        ])
+        assert limiter.uploads.rate == 0
+
+        limiter.upload(10)
+        assert clock.now == 120
+        assert limiter.uploads.rate is None
+
+    def test_invalid_limits(self):
+        limiter = transfer.BandwidthLimiter()
+        with pytest.raises(ValueError):
+            limiter.configure(upload=0)
+        with pytest.raises(ValueError):
+            limiter.configure(schedule=[{'start': '09:00', 'end': '17:00', 'download': -1}])
+
+    def test_limited_reader(self):
+        consume = mock.Mock()
+        reader = transfer.LimitedReader(io.BytesIO(b'hello world'), consume)
+        assert reader.read(5) == b'hello'
+        assert reader.read() == b' world'
+        assert [c[0][0] for c in consume.call_args_list] == [5, 6]
+
+        reader.close()
+        assert reader.closed
+
+
+class TestSchedulingPolicies(object):
+    @pytest.fixture
+    def items(self):
+        now = time.time()
+        return [
+            transfer.TransferItem('a', 10 ** 9, now - 10),
+            transfer.TransferItem('b', 10, now - 10 ** 6),
+            transfer.TransferItem('c', 1000, now - 100),
+            transfer.TransferItem('d', None, None),
+        ]
+
+    def get_order(self, items, policy):
+        return [item.key for item in sorted(items, key=transfer.get_scheduling_policy(policy))]
+
+    def test_alphabetical(self, items):
+        assert self.get_order(items, 'alphabetical') == ['a', 'b', 'c', 'd']
+
+    def test_smallest(self, items):
+        assert self.get_order(items, 'smallest') == ['d', 'b', 'c', 'a']
+
+    def test_recent(self, items):
+        assert self.get_order(items, 'recent') == ['a', 'c', 'b', 'd']
+
+    def test_weighted(self, items):
+        assert self.get_order(items, {'size': 1, 'age': 0}) == ['d', 'b', 'c', 'a']
+        assert self.get_order(items, {'size': 0, 'age': 1})[0] == 'a'
+        assert self.get_order(items, 'weighted')[:2] == ['c', 'b']
+
+    def test_custom(self, items):
+        assert self.get_order(items, lambda item: -ord(item.key)) == ['d', 'c', 'b', 'a']
+
+    def test_unknown(self):
+        with pytest.raises(ValueError):
+            transfer.get_scheduling_policy('biggest')
+
+
+class TestLanes(object):
+    def test_invalid(self):
+        with pytest.raises(ValueError):
+            transfer.TransferExecutor(jobs=4, large_jobs=0)
+
+    def test_get_next_index(self):
+        executor = transfer.TransferExecutor(jobs=4, large_jobs=1)
+        assert executor.get_next_index(['a', 'b'], {'a'}, 0) == 0
+        assert executor.get_next_index(['a', 'b'], {'a'}, 1) == 1
+        assert executor.get_next_index(['a'], {'a'}, 1) is None
+
+    def test_small_keys_keep_moving(self):
+        executor = transfer.TransferExecutor(jobs=2, large_jobs=1)
+        started = []
+        release = threading.Event()
+
+        def func(key):
+            started.append(key)
+            if key.startswith('large'):
+                release.wait(5)
+            elif key == 'small9':
+                release.set()
+
+        keys = ['large1', 'large2'] + ['small{}'.format(i) for i in range(10)]
+        success = executor.run(keys, func, large_keys={'large1', 'large2'})
+
+        assert sorted(success) == sorted(keys)
+        # the second large key waited for the first instead of blocking the small ones
+        assert started.index('large2') > started.index('small9')
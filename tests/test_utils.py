@@ -21,3 +21,26 @@ def test_get_input_secret(getpass, input_fn):
 
     assert getpass.call_count == 0
     assert input_fn.call_count == 1
+
+
+@mock.patch('s4.utils.set_io_priority')
+@mock.patch('s4.utils.get_io_priority')
+def test_lower_io_priority(get_io_priority, set_io_priority):
+    get_io_priority.return_value = 4
+    set_io_priority.return_value = True
+
+    with utils.lower_io_priority():
+        set_io_priority.assert_called_once_with(utils.IOPRIO_CLASS_IDLE << utils.IOPRIO_CLASS_SHIFT)
+
+    set_io_priority.assert_called_with(4)
+
+
+@mock.patch('s4.utils.set_io_priority')
+@mock.patch('s4.utils.get_io_priority')
+def test_lower_io_priority_unsupported(get_io_priority, set_io_priority):
+    get_io_priority.return_value = None
+
+    with utils.lower_io_priority():
+        pass
+
+    assert set_io_priority.call_count == 0